@@ -1,13 +1,49 @@
-from fastapi import FastAPI, status
+import asyncio
+import functools
+from typing import Optional
+
+from fastapi import FastAPI, Request, status
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from contextlib import asynccontextmanager
 from dotenv import load_dotenv
 
-from utils.data_utils import ingest_repo
-from utils.llm_utils import get_answer
-from utils.injectors import initialize
+from utils.data_utils import _is_valid_url
+from utils.vector_utils import migrate_collections, _is_collection_exists
+from utils.tenancy_utils import migrate_to_shared
+from utils.job_utils import (
+    submit_ingest_job,
+    get_job,
+    shutdown,
+    QueueFullError,
+    JobConflictError,
+)
+from utils.snapshot_utils import (
+    export_snapshot,
+    import_snapshot,
+    iter_async_chunks,
+    SnapshotError,
+    CollectionExistsError,
+)
+from utils.llm_utils import (
+    get_answer,
+    stream_answer,
+    retrieval_stats,
+    context_packing_stats,
+)
+from utils.injectors import (
+    initialize,
+    close,
+    embedding_cache_instance,
+    answer_cache_instance,
+    embedding_batcher_instance,
+    config_instance,
+    is_model_ready,
+    check_vector_store,
+    startup_stats,
+)
 from utils.custom_classes import Ingest, Generate
+from utils import metrics
 
 load_dotenv()
 
@@ -16,6 +52,8 @@ load_dotenv()
 async def lifespan(app: FastAPI):
     await initialize()
     yield
+    shutdown()
+    await close()
 
 
 app = FastAPI(lifespan=lifespan)
@@ -30,27 +68,206 @@ app.add_middleware(
 
 @app.get("/healthcheck")
 def read_root():
+    # liveness only, see /ready
     return {"status": "ok"}
 
 
+@app.get("/ready")
+def read_ready():
+    # passes once the models are loaded and warmed up and the vector store answers
+    vector_store_error = check_vector_store()
+    ready = is_model_ready() and vector_store_error is None
+    return JSONResponse(
+        content={
+            "ready": ready,
+            "vector_store_error": vector_store_error,
+            **startup_stats(),
+        },
+        status_code=(
+            status.HTTP_200_OK if ready else status.HTTP_503_SERVICE_UNAVAILABLE
+        ),
+    )
+
+
+def _not_ready_response() -> JSONResponse:
+    return JSONResponse(
+        content={"Error": "The models are still loading, see /ready"},
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+    )
+
+
+@app.get("/stats")
+def read_stats():
+    embedding_cache = embedding_cache_instance()
+    answer_cache = answer_cache_instance()
+    return {
+        "embedding_cache": embedding_cache.stats() if embedding_cache else None,
+        "answer_cache": answer_cache.stats() if answer_cache else None,
+        "query_batcher": embedding_batcher_instance().stats(),
+        "retrieval": retrieval_stats(),
+        "context_packing": context_packing_stats(),
+        "startup": startup_stats(),
+    }
+
+
+@app.get("/metrics")
+def read_metrics():
+    return PlainTextResponse(
+        metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+
 @app.post("/ingest")
 async def ingest_repo_from_url(ingest: Ingest):
     print(ingest)
-    status_flag = ingest_repo(
-        repo_url=ingest.repo_url,
-        insert_custom_embeddings=ingest.insert_custom_embeddings,
-    )
-    if status_flag:
+    if not is_model_ready():
+        return _not_ready_response()
+    if not _is_valid_url(ingest.repo_url):
+        return JSONResponse(
+            content={"Error": "Invalid repo URL!"},
+            status_code=status.HTTP_400_BAD_REQUEST,
+        )
+    try:
+        job = submit_ingest_job(
+            repo_url=ingest.repo_url,
+            insert_custom_embeddings=ingest.insert_custom_embeddings,
+            refresh=ingest.refresh,
+            ref=ingest.ref,
+        )
+    except QueueFullError as e:
+        return JSONResponse(
+            content={"Error": str(e)}, status_code=status.HTTP_429_TOO_MANY_REQUESTS
+        )
+    except JobConflictError as e:
         return JSONResponse(
-            content={"Info": "Ingested to Vector DB"},
-            status_code=status.HTTP_201_CREATED,
+            content={"Error": str(e), "job_id": e.job.job_id},
+            status_code=status.HTTP_409_CONFLICT,
+            headers={"Location": f"/ingest/{e.job.job_id}"},
         )
     return JSONResponse(
-        content={"Error": "Failed to Ingest"}, status_code=status.HTTP_400_BAD_REQUEST
+        content={"job_id": job.job_id, "status": job.status},
+        status_code=status.HTTP_202_ACCEPTED,
+        headers={"Location": f"/ingest/{job.job_id}"},
+    )
+
+
+@app.get("/ingest/{job_id}")
+async def ingest_job_status(job_id: str):
+    job = get_job(job_id)
+    if job is None:
+        return JSONResponse(
+            content={"Error": "Unknown job id"}, status_code=status.HTTP_404_NOT_FOUND
+        )
+    return JSONResponse(content=job.to_dict(), status_code=status.HTTP_200_OK)
+
+
+@app.post("/collections/migrate")
+def migrate_collections_to_profile(collection_name: Optional[str] = None):
+    # applies the [Collection] profile of the config to existing collections
+    if collection_name and not _is_collection_exists(collection_name):
+        return JSONResponse(
+            content={"Error": "Unknown collection"},
+            status_code=status.HTTP_404_NOT_FOUND,
+        )
+    migrated = migrate_collections([collection_name] if collection_name else None)
+    return JSONResponse(content={"migrated": migrated}, status_code=status.HTTP_200_OK)
+
+
+@app.post("/collections/migrate_to_shared")
+def migrate_collection_to_shared(
+    collection_name: str, repo_url: str, delete_source: bool = False
+):
+    # copies a per-repo collection to the repo's tenant in the shared collections
+    if not config_instance().get("Tenancy", {}).get("shared_collections", 0):
+        return JSONResponse(
+            content={"Error": "Shared collections are not enabled"},
+            status_code=status.HTTP_400_BAD_REQUEST,
+        )
+    if "/" in collection_name or not _is_collection_exists(collection_name):
+        return JSONResponse(
+            content={"Error": "Unknown collection"},
+            status_code=status.HTTP_404_NOT_FOUND,
+        )
+    result = migrate_to_shared(collection_name, repo_url, delete_source=delete_source)
+    return JSONResponse(content=result, status_code=status.HTTP_200_OK)
+
+
+@app.get("/snapshot/export")
+def export_collection_snapshot(collection_name: str):
+    # streamed gzip bundle of the chunks, payloads, vectors and commit of the collection
+    if not _is_collection_exists(collection_name):
+        return JSONResponse(
+            content={"Error": "Unknown collection"},
+            status_code=status.HTTP_404_NOT_FOUND,
+        )
+    # "owner/name" with shared collections
+    file_name = collection_name.replace("/", "_")
+    return StreamingResponse(
+        export_snapshot(collection_name),
+        media_type="application/gzip",
+        headers={
+            "Content-Disposition": f'attachment; filename="{file_name}.snapshot.gz"'
+        },
     )
 
 
+@app.post("/snapshot/import")
+async def import_collection_snapshot(
+    request: Request, collection_name: Optional[str] = None, overwrite: bool = False
+):
+    # the body is a bundle of /snapshot/export, loaded as it is uploaded (no model work)
+    loop = asyncio.get_running_loop()
+    try:
+        result = await loop.run_in_executor(
+            None,
+            functools.partial(
+                import_snapshot,
+                iter_async_chunks(request.stream(), loop),
+                collection_name=collection_name,
+                overwrite=overwrite,
+            ),
+        )
+    except CollectionExistsError as e:
+        return JSONResponse(
+            content={"Error": str(e)}, status_code=status.HTTP_409_CONFLICT
+        )
+    except SnapshotError as e:
+        return JSONResponse(
+            content={"Error": str(e)}, status_code=status.HTTP_400_BAD_REQUEST
+        )
+    return JSONResponse(content=result, status_code=status.HTTP_200_OK)
+
+
 @app.post("/generate")
 async def generate_reponse(generate: Generate):
-    response = get_answer(query=generate.query, repo_url=generate.repo_url)
-    return JSONResponse(content=response, status_code=status.HTTP_200_OK)
+    if not is_model_ready():
+        return _not_ready_response()
+    trace = metrics.start_trace()
+    with metrics.span("query", "total"):
+        response = await get_answer(
+            query=generate.query,
+            repo_url=generate.repo_url,
+            repo_urls=generate.repo_urls,
+        )
+    headers = None
+    if config_instance().get("Metrics", {}).get("server_timing", False):
+        # eg: "embed;dur=8.1, dense;dur=4.2, lexical;dur=0.3, ..., llm;dur=812.5"
+        headers = {"Server-Timing": metrics.server_timing(trace)}
+    return JSONResponse(
+        content=response, status_code=status.HTTP_200_OK, headers=headers
+    )
+
+
+@app.post("/generate/stream")
+async def generate_reponse_stream(generate: Generate):
+    if not is_model_ready():
+        return _not_ready_response()
+    # tokens are sent as they are generated (chunked transfer), "Referred Files" last
+    return StreamingResponse(
+        stream_answer(
+            query=generate.query,
+            repo_url=generate.repo_url,
+            repo_urls=generate.repo_urls,
+        ),
+        media_type="text/plain; charset=utf-8",
+    )
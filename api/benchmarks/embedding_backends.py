@@ -0,0 +1,118 @@
+"""
+Parity check and benchmark of the embedding backends (torch fp32, int8, onnx).
+Each backend runs in its own process so its resident memory is measured in isolation.
+
+Run from the api directory:
+    python -m benchmarks.embedding_backends --num-texts 512 --output results.json
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import queue
+import resource
+import time
+from typing import List
+
+import numpy as np
+import toml
+
+from utils.custom_classes import CodeT5PlusEmbeddings
+
+
+def _sample_texts(num_texts: int, source_dir: str, chunk_size: int = 500) -> List[str]:
+    """Chunks of the source files under source_dir, repeated up to num_texts"""
+    chunks = []
+    for root, _, file_names in os.walk(source_dir):
+        for file_name in sorted(file_names):
+            if file_name.endswith((".py", ".md", ".toml")):
+                with open(os.path.join(root, file_name), encoding="utf-8") as f:
+                    content = f.read()
+                chunks.extend(
+                    content[i : i + chunk_size]
+                    for i in range(0, len(content), chunk_size)
+                )
+    if not chunks:
+        raise Exception(f"No source files found in {source_dir}")
+    return [chunks[i % len(chunks)] for i in range(num_texts)]
+
+
+def _run_backend(backend: str, texts: List[str], embeddings_config: dict, results):
+    embeddings_config = dict(embeddings_config, backend=backend)
+    started = time.perf_counter()
+    model = CodeT5PlusEmbeddings(**embeddings_config)
+    load_seconds = time.perf_counter() - started
+    # warmup, the first batches pay for allocations
+    model.embed_documents(texts[: model.batch_size])
+    started = time.perf_counter()
+    embeddings = np.asarray(model.embed_documents(texts), dtype=np.float32)
+    seconds = time.perf_counter() - started
+    results.put(
+        {
+            "backend": backend,
+            "load_seconds": round(load_seconds, 3),
+            "chunks_per_sec": round(len(texts) / seconds, 2),
+            # ru_maxrss is in KB on linux
+            "peak_rss_mb": round(
+                resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1
+            ),
+            "embeddings": embeddings,
+        }
+    )
+
+
+def _wait_for_result(process: multiprocessing.Process, results) -> dict:
+    while True:
+        try:
+            return results.get(timeout=1)
+        except queue.Empty:
+            if not process.is_alive():
+                raise Exception(f"Benchmark process exited with {process.exitcode}")
+
+
+def _cosine_drift(reference: np.ndarray, embeddings: np.ndarray) -> dict:
+    cosine = np.sum(reference * embeddings, axis=1) / (
+        np.linalg.norm(reference, axis=1) * np.linalg.norm(embeddings, axis=1)
+    )
+    return {
+        "mean_cosine": round(float(cosine.mean()), 6),
+        "min_cosine": round(float(cosine.min()), 6),
+        "max_drift": round(float(1 - cosine.min()), 6),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--backends", nargs="+", default=CodeT5PlusEmbeddings.BACKENDS)
+    parser.add_argument("--num-texts", type=int, default=512)
+    parser.add_argument("--source-dir", default=".")
+    parser.add_argument("--config", default="configs/properties.toml")
+    parser.add_argument("--output", help="path of the json report")
+    args = parser.parse_args()
+
+    embeddings_config = toml.load(args.config).get("Embeddings", {})
+    texts = _sample_texts(args.num_texts, args.source_dir)
+    context = multiprocessing.get_context("spawn")
+    reports = []
+    for backend in args.backends:
+        results = context.Queue()
+        process = context.Process(
+            target=_run_backend, args=(backend, texts, embeddings_config, results)
+        )
+        process.start()
+        reports.append(_wait_for_result(process, results))
+        process.join()
+
+    reference = next((r for r in reports if r["backend"] == "torch"), None)
+    for report in reports:
+        if reference is not None:
+            report.update(_cosine_drift(reference["embeddings"], report["embeddings"]))
+        del report["embeddings"]
+        print(json.dumps(report))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"num_texts": len(texts), "results": reports}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
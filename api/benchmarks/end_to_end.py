@@ -0,0 +1,369 @@
+"""
+End-to-end benchmark of ingest and generate with local stand-ins.
+Synthetic fixture repos are served as local git remotes, the vector store runs in-process
+(Qdrant ":memory:" or the local backend) and the LLM is a deterministic fake, so the numbers
+only depend on this code and the machine.
+
+Run from the api directory:
+    python -m benchmarks.end_to_end --num-files 500 --languages py=0.5,js=0.3,md=0.2 \
+        --num-queries 200 --output results.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import resource
+import shutil
+import subprocess
+import tempfile
+import time
+from typing import Any, Dict, List
+
+import numpy as np
+from langchain_core.embeddings import DeterministicFakeEmbedding
+from langchain_core.language_models.fake_chat_models import FakeListChatModel
+
+from utils import injectors
+from utils.data_utils import ingest_repo
+from utils.job_utils import IngestJob, shutdown
+from utils.llm_utils import get_answer, retrieval_stats, context_packing_stats
+from utils.vector_utils import repo_collection_name
+
+_WORDS = """parse load store fetch build render update delete index search merge split
+token chunk vector query cache batch stream commit branch config client server worker
+queue event state model layer score rank filter record""".split()
+# answer of the fake LLM, the symbol lookups that fall through to the RAG chain get it
+_LLM_ANSWER = "The answer is in the referred files."
+# questions that go through retrieval and the LLM
+_RAG_TEMPLATES = [
+    "What does {} return?",
+    "Explain how {} works",
+    "How does {} handle errors?",
+]
+# definition / usage questions, answered from the symbol index when the symbol is known
+_LOOKUP_TEMPLATES = [
+    "Where is {} defined?",
+    "Which functions call {}?",
+]
+
+
+class _FakeChatModel(FakeListChatModel):
+    """Cycles through canned answers, counts tokens without downloading a tokenizer"""
+
+    def get_num_tokens(self, text: str) -> int:
+        return len(re.findall(r"\w+|[^\w\s]", text))
+
+
+def _identifier(rng: random.Random, style: str) -> str:
+    words = rng.sample(_WORDS, 3)
+    if style == "camel":
+        return words[0] + "".join(word.title() for word in words[1:])
+    if style == "pascal":
+        return "".join(word.title() for word in words)
+    return "_".join(words)
+
+
+def _function(rng: random.Random, language: str, name: str, callee: str) -> str:
+    doc = " ".join(rng.choices(_WORDS, k=8))
+    n = rng.randint(1, 100)
+    if language == "py":
+        return (
+            f"def {name}(value):\n"
+            f'    """{doc}"""\n'
+            f"    result = {callee}(value) + {n}\n"
+            f"    return result\n\n\n"
+        )
+    if language == "js":
+        return f"function {name}(value) {{\n  // {doc}\n  return {callee}(value) + {n};\n}}\n\n"
+    if language == "go":
+        return f"// {doc}\nfunc {name}(value int) int {{\n\treturn {callee}(value) + {n}\n}}\n\n"
+    if language == "java":
+        return (
+            f"    // {doc}\n"
+            f"    public static int {name}(int value) {{\n"
+            f"        return {callee}(value) + {n};\n"
+            f"    }}\n\n"
+        )
+    return f"## {name}\n\n{doc.capitalize()}. See `{callee}`.\n\n"
+
+
+_STYLES = {"py": "snake", "js": "camel", "go": "pascal", "java": "camel", "md": "snake"}
+
+
+def _fixture_file(
+    rng: random.Random, language: str, functions_per_file: int, names: List[str]
+) -> str:
+    style = _STYLES[language]
+    body = []
+    for _ in range(functions_per_file):
+        name = _identifier(rng, style)
+        callee = rng.choice(names) if names else name
+        names.append(name)
+        body.append(_function(rng, language, name, callee))
+    content = "".join(body)
+    if language == "go":
+        return "package fixture\n\n" + content
+    if language == "java":
+        return f"public class Fixture{rng.randint(0, 10**6)} {{\n{content}}}\n"
+    return content
+
+
+def build_fixture_repo(
+    path: str,
+    num_files: int,
+    languages: Dict[str, float],
+    functions_per_file: int = 8,
+    seed: int = 0,
+) -> Dict[str, Any]:
+    """Writes a repo of num_files files with the given language mix and commits it"""
+    rng = random.Random(seed)
+    names = []
+    extensions = list(languages)
+    weights = [languages[extension] for extension in extensions]
+    for i in range(num_files):
+        language = rng.choices(extensions, weights=weights)[0]
+        file_path = os.path.join(path, f"pkg{i % 10}", f"module_{i}.{language}")
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with open(file_path, "w", encoding="utf-8") as f:
+            f.write(_fixture_file(rng, language, functions_per_file, names))
+    _git(path, "init", "-q")
+    _git(path, "add", "-A")
+    _git(
+        path,
+        "-c",
+        "user.name=benchmark",
+        "-c",
+        "user.email=benchmark@localhost",
+        "commit",
+        "-qm",
+        "fixture",
+    )
+    return {"path": path, "identifiers": names}
+
+
+def serve_as_remote(repo_path: str, remotes_dir: str) -> str:
+    """Bare copy of the repo that accepts partial clone filters, returns its file:// URL"""
+    bare_path = os.path.join(remotes_dir, os.path.basename(repo_path) + ".git")
+    _git(remotes_dir, "clone", "-q", "--bare", repo_path, bare_path)
+    _git(bare_path, "config", "uploadpack.allowFilter", "true")
+    return "file://" + bare_path
+
+
+def _git(cwd: str, *args: str):
+    subprocess.run(["git", *args], cwd=cwd, check=True, capture_output=True)
+
+
+def _queries(
+    identifiers: List[str], templates: List[str], num_queries: int, seed: int = 0
+) -> List[str]:
+    rng = random.Random(seed)
+    return [
+        rng.choice(templates).format(rng.choice(identifiers))
+        for _ in range(num_queries)
+    ]
+
+
+def _peak_rss_mb() -> float:
+    # ru_maxrss is in KB on linux
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def _percentiles_ms(seconds: List[float]) -> dict:
+    latencies_ms = np.asarray(seconds, dtype=np.float64) * 1000
+    return {
+        "p50_ms": round(float(np.percentile(latencies_ms, 50)), 3),
+        "p99_ms": round(float(np.percentile(latencies_ms, 99)), 3),
+    }
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _benchmark_ingest(repo_url: str) -> dict:
+    job = IngestJob(repo_url)
+    job.start()
+    started = time.perf_counter()
+    ok = ingest_repo(repo_url, on_stage=job.start_stage, stats=job.stats)
+    seconds = time.perf_counter() - started
+    job.finish("done" if ok else "failed")
+    if not ok:
+        raise Exception("Ingestion failed")
+    collection_name = repo_collection_name(repo_url)
+    num_files = job.stats.get("triage", {}).get("kept", {}).get("files", 0)
+    num_chunks = injectors.vector_store_instance().count(collection_name)
+    return {
+        "seconds": round(seconds, 3),
+        "stages": {stage["name"]: round(stage["duration"], 3) for stage in job.stages},
+        "files": num_files,
+        "chunks": num_chunks,
+        "files_per_sec": round(num_files / seconds, 2),
+        "chunks_per_sec": round(num_chunks / seconds, 2),
+        "triage": job.stats.get("triage"),
+    }
+
+
+async def _benchmark_queries(
+    repo_url: str, queries: List[str], concurrency: int
+) -> dict:
+    slots = asyncio.Semaphore(concurrency)
+    latencies = []
+    answers = []
+
+    async def timed_query(query: str):
+        async with slots:
+            started = time.perf_counter()
+            answers.append(await get_answer(query=query, repo_url=repo_url))
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(timed_query(query) for query in queries))
+    seconds = time.perf_counter() - started
+    return {
+        "seconds": round(seconds, 3),
+        "queries": len(queries),
+        "concurrency": concurrency,
+        "queries_per_sec": round(len(queries) / seconds, 2),
+        "latency": _percentiles_ms(latencies),
+        "llm_answers": sum(answer.startswith(_LLM_ANSWER) for answer in answers),
+    }
+
+
+async def run(args: argparse.Namespace) -> dict:
+    languages = {
+        language: float(weight)
+        for language, weight in (item.split("=") for item in args.languages.split(","))
+    }
+    unknown = set(languages) - set(_STYLES)
+    if unknown:
+        raise Exception(f"Unsupported fixture languages: {unknown}")
+    work_dir = tempfile.mkdtemp(prefix="e2e-benchmark-")
+    try:
+        remotes_dir = os.path.join(work_dir, "remotes")
+        os.makedirs(remotes_dir)
+        started = time.perf_counter()
+        fixture = build_fixture_repo(
+            os.path.join(work_dir, "fixture"),
+            num_files=args.num_files,
+            languages=languages,
+            functions_per_file=args.functions_per_file,
+            seed=args.seed,
+        )
+        repo_url = serve_as_remote(fixture["path"], remotes_dir)
+        fixture_seconds = time.perf_counter() - started
+
+        config_overrides = {
+            "VectorStore": {"backend": args.vector_store, "url": ":memory:"},
+            "LocalVectorStore": {"path": os.path.join(work_dir, "vectors")},
+            "Clone": {
+                "repos_dir": os.path.join(work_dir, "repos"),
+                "allow_local_remotes": True,
+            },
+            # every run starts cold
+            "EmbeddingCache": {"path": os.path.join(work_dir, "cache")},
+            "Lexical": {"path": os.path.join(work_dir, "lexical")},
+            "Symbols": {"path": os.path.join(work_dir, "symbols")},
+            "Tenancy": {"shared_collections": args.shared_collections},
+        }
+        if args.vector_store == "qdrant":
+            # the in-process Qdrant is not thread safe for writes
+            config_overrides["Ingest"] = {"upsert_concurrency": 1}
+        started = time.perf_counter()
+        await injectors.initialize(
+            config_overrides=config_overrides,
+            embeddings=(
+                DeterministicFakeEmbedding(size=256)
+                if args.embeddings == "fake"
+                else None
+            ),
+            chat_model=_FakeChatModel(responses=[_LLM_ANSWER]),
+            background_load=False,
+        )
+        startup_seconds = time.perf_counter() - started
+
+        ingest = _benchmark_ingest(repo_url)
+        queries = await _benchmark_queries(
+            repo_url,
+            _queries(
+                fixture["identifiers"], _RAG_TEMPLATES, args.num_queries, args.seed
+            ),
+            concurrency=args.concurrency,
+        )
+        # the stages of the RAG queries only, the lookups run after
+        queries["stages"] = retrieval_stats()
+        queries["context_packing"] = context_packing_stats()
+        lookups = await _benchmark_queries(
+            repo_url,
+            _queries(
+                fixture["identifiers"], _LOOKUP_TEMPLATES, args.num_lookups, args.seed
+            ),
+            concurrency=args.concurrency,
+        )
+        shutdown()
+        await injectors.close()
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return {
+        "commit": _git_commit(),
+        "created_at": time.time(),
+        "params": vars(args),
+        "fixture_seconds": round(fixture_seconds, 3),
+        "startup_seconds": round(startup_seconds, 3),
+        "ingest": ingest,
+        "generate": queries,
+        "symbol_lookups": lookups,
+        "peak_rss_mb": _peak_rss_mb(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--num-files", type=int, default=200)
+    parser.add_argument("--functions-per-file", type=int, default=8)
+    parser.add_argument("--languages", default="py=0.4,js=0.2,go=0.1,java=0.1,md=0.2")
+    parser.add_argument("--num-queries", type=int, default=100)
+    parser.add_argument(
+        "--num-lookups",
+        type=int,
+        default=50,
+        help="definition / usage questions, reported apart (symbol index fast path)",
+    )
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument(
+        "--embeddings",
+        choices=["model", "fake"],
+        default="model",
+        help="the configured embedding model, or deterministic fake vectors",
+    )
+    parser.add_argument(
+        "--vector-store",
+        choices=["qdrant", "local"],
+        default="qdrant",
+        help="in-process Qdrant or the embedded local backend",
+    )
+    parser.add_argument(
+        "--shared-collections",
+        type=int,
+        default=0,
+        help="store the repo as a tenant of N shared Qdrant collections",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="path of the json report")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
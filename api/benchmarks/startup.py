@@ -0,0 +1,123 @@
+"""
+Cold start benchmark: import time of the app and time until /healthcheck and /ready pass.
+Every run starts a fresh process, so nothing is warm in the interpreter.
+
+Run from the api directory (the vector store of the config must be reachable for /ready):
+    python -m benchmarks.startup --runs 5 --output results.json
+"""
+import argparse
+import json
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+from typing import List
+
+import numpy as np
+
+_IMPORT_SCRIPT = """
+import time
+started = time.perf_counter()
+import app
+print(time.perf_counter() - started)
+"""
+
+
+def _import_seconds() -> float:
+    result = subprocess.run(
+        [sys.executable, "-c", _IMPORT_SCRIPT],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return float(result.stdout.strip().splitlines()[-1])
+
+
+def _slowest_imports(top: int) -> List[dict]:
+    """Modules with the largest cumulative import time, from `python -X importtime`"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import app"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    modules = []
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, module = line[len("import time:") :].split("|")
+        modules.append((int(cumulative), module.strip()))
+    return [
+        {"module": module, "cumulative_ms": round(us / 1000, 1)}
+        for us, module in sorted(modules, reverse=True)[:top]
+    ]
+
+
+def _status(url: str) -> int:
+    try:
+        with urllib.request.urlopen(url, timeout=1) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+    except OSError:
+        return None
+
+
+def _time_to_ready(port: int, timeout: float) -> dict:
+    """Starts the server and polls /healthcheck and /ready until they return 200"""
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app:app", "--port", str(port)],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    base_url = f"http://127.0.0.1:{port}"
+    started = time.perf_counter()
+    timings = {"healthcheck": None, "ready": None}
+    try:
+        while time.perf_counter() - started < timeout and timings["ready"] is None:
+            if server.poll() is not None:
+                raise Exception(f"The server exited with code {server.returncode}")
+            for probe in ("healthcheck", "ready"):
+                if timings[probe] is None and _status(f"{base_url}/{probe}") == 200:
+                    timings[probe] = round(time.perf_counter() - started, 3)
+            time.sleep(0.05)
+    finally:
+        server.terminate()
+        server.wait()
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top-imports", type=int, default=15)
+    parser.add_argument("--port", type=int, default=8011)
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument(
+        "--skip-server", action="store_true", help="only measure the import time"
+    )
+    parser.add_argument("--output", help="path of the json report")
+    args = parser.parse_args()
+
+    import_seconds = [_import_seconds() for _ in range(args.runs)]
+    report = {
+        "import_seconds": {
+            "p50": round(float(np.percentile(import_seconds, 50)), 3),
+            "max": round(max(import_seconds), 3),
+        },
+        "slowest_imports": _slowest_imports(args.top_imports),
+    }
+    if not args.skip_server:
+        report["time_to_ready_seconds"] = [
+            _time_to_ready(args.port, args.timeout) for _ in range(args.runs)
+        ]
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,203 @@
+"""
+Latency benchmark of the vector store backends: Qdrant (in-process, or the server at
+--qdrant-url) and the embedded local store (float32 and int8).
+Synthetic clustered vectors are upserted into one collection per backend, then the same
+queries are run on each; recall@k is measured against an exact NumPy search. The two-stage
+search (oversampled cheap candidates reranked in NumPy) is measured the same way, with the
+latency of each stage.
+
+Run from the api directory:
+    python -m benchmarks.vector_stores --num-vectors 20000 --num-queries 500 --output results.json
+"""
+import argparse
+import json
+import shutil
+import tempfile
+import time
+from typing import List
+
+import numpy as np
+from qdrant_client import QdrantClient
+
+from utils.rerank import mmr_rerank
+from utils.vector_stores import LocalVectorStore, QdrantVectorStore, VectorStore
+
+
+def _clustered_vectors(
+    rng: np.random.Generator, num_vectors: int, dim: int, num_clusters: int = 64
+) -> np.ndarray:
+    """Vectors around a few centroids, closer to real embeddings than uniform noise"""
+    centroids = rng.normal(size=(num_clusters, dim))
+    assignments = rng.integers(0, num_clusters, size=num_vectors)
+    vectors = centroids[assignments] + 0.5 * rng.normal(size=(num_vectors, dim))
+    return (vectors / np.linalg.norm(vectors, axis=1, keepdims=True)).astype(np.float32)
+
+
+def _points(vectors: np.ndarray, num_files: int = 1000) -> list:
+    return [
+        (
+            f"00000000-0000-0000-0000-{i:012d}",
+            vector.tolist(),
+            {
+                "metadata": {
+                    "file_level_metadata": {"path": f"pkg/module_{i % num_files}.py"},
+                    "chunk_level_metadata": {"chunk_no": i},
+                },
+                "page_content": f"def function_{i}(value):\n    return value + {i}\n",
+            },
+        )
+        for i, vector in enumerate(vectors)
+    ]
+
+
+def _exact_top_k(vectors: np.ndarray, queries: np.ndarray, k: int) -> List[set]:
+    scores = queries @ vectors.T
+    return [set(np.argsort(-row)[:k]) for row in scores]
+
+
+def _percentiles_ms(seconds: List[float], name: str) -> dict:
+    latencies_ms = np.asarray(seconds) * 1000
+    return {
+        f"{name}_p50_ms": round(float(np.percentile(latencies_ms, 50)), 3),
+        f"{name}_p99_ms": round(float(np.percentile(latencies_ms, 99)), 3),
+    }
+
+
+def _recall(results, expected: set, k: int) -> float:
+    found = {int(doc.metadata["_id"].split("-")[-1]) for doc in results}
+    return len(found & expected) / k
+
+
+def _benchmark_two_stage(
+    vector_store: VectorStore,
+    collection_name: str,
+    queries: np.ndarray,
+    exact: List[set],
+    args: argparse.Namespace,
+) -> dict:
+    candidate_latencies, rerank_latencies, recalls = [], [], []
+    for query, expected in zip(queries, exact):
+        started = time.perf_counter()
+        docs, vectors = vector_store.search_candidates(
+            collection_name,
+            query.tolist(),
+            args.k * args.oversample,
+            hnsw_ef=args.candidate_hnsw_ef,
+        )
+        reranked = time.perf_counter()
+        selected, _ = mmr_rerank(query, vectors, args.k, lambda_mult=args.mmr_lambda)
+        rerank_latencies.append(time.perf_counter() - reranked)
+        candidate_latencies.append(reranked - started)
+        recalls.append(_recall([docs[i] for i in selected], expected, args.k))
+    return {
+        **_percentiles_ms(candidate_latencies, "candidates"),
+        **_percentiles_ms(rerank_latencies, "rerank"),
+        **_percentiles_ms(
+            np.add(candidate_latencies, rerank_latencies).tolist(), "total"
+        ),
+        f"recall@{args.k}": round(float(np.mean(recalls)), 4),
+    }
+
+
+def _benchmark_backend(
+    vector_store: VectorStore,
+    points: list,
+    queries: np.ndarray,
+    exact: List[set],
+    args: argparse.Namespace,
+) -> dict:
+    k = args.k
+    collection_name = "benchmark"
+    vector_store.ensure_collection(collection_name)
+    started = time.perf_counter()
+    for i in range(0, len(points), args.batch_size):
+        vector_store.upsert(collection_name, points[i : i + args.batch_size])
+    # Qdrant upserts are sent with wait=False, the count waits for them
+    vector_store.count(collection_name)
+    upsert_seconds = time.perf_counter() - started
+    # first search maps the matrix / loads the segments
+    vector_store.search(collection_name, queries[0].tolist(), k)
+    latencies, recalls = [], []
+    for query, expected in zip(queries, exact):
+        started = time.perf_counter()
+        results = vector_store.search(collection_name, query.tolist(), k)
+        latencies.append(time.perf_counter() - started)
+        recalls.append(_recall([doc for doc, _ in results], expected, k))
+    return {
+        "upsert_seconds": round(upsert_seconds, 3),
+        "upserts_per_sec": round(len(points) / upsert_seconds, 1),
+        **_percentiles_ms(latencies, "search"),
+        f"recall@{k}": round(float(np.mean(recalls)), 4),
+        "two_stage": _benchmark_two_stage(
+            vector_store, collection_name, queries, exact, args
+        ),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--num-vectors", type=int, default=20000)
+    parser.add_argument("--num-queries", type=int, default=500)
+    parser.add_argument("--dim", type=int, default=256)
+    parser.add_argument("--k", type=int, default=20)
+    parser.add_argument("--batch-size", type=int, default=256)
+    parser.add_argument(
+        "--oversample", type=int, default=4, help="candidates per result, two-stage"
+    )
+    parser.add_argument("--candidate-hnsw-ef", type=int, default=32)
+    parser.add_argument(
+        "--mmr-lambda",
+        type=float,
+        default=1.0,
+        help="1 reranks by exact cosine only, so the recall compares to the exact top k",
+    )
+    parser.add_argument(
+        "--qdrant-url", help="Qdrant server to benchmark, in-process Qdrant otherwise"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="path of the json report")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    vectors = _clustered_vectors(rng, args.num_vectors, args.dim)
+    queries = _clustered_vectors(rng, args.num_queries, args.dim)
+    exact = _exact_top_k(vectors, queries, args.k)
+    points = _points(vectors)
+    work_dir = tempfile.mkdtemp(prefix="vector-store-benchmark-")
+    qdrant_client = (
+        QdrantClient(url=args.qdrant_url, prefer_grpc=True)
+        if args.qdrant_url
+        else QdrantClient(location=":memory:")
+    )
+    backends = {
+        "qdrant": QdrantVectorStore(qdrant_client, dim=args.dim),
+        "local_float32": LocalVectorStore(
+            path=f"{work_dir}/float32", dtype="float32", dim=args.dim
+        ),
+        "local_int8": LocalVectorStore(
+            path=f"{work_dir}/int8", dtype="int8", dim=args.dim
+        ),
+    }
+    report = {
+        "params": vars(args),
+        "qdrant": "server" if args.qdrant_url else "in-process",
+        "backends": {},
+    }
+    try:
+        for name, vector_store in backends.items():
+            print(f"Benchmarking {name}..")
+            report["backends"][name] = _benchmark_backend(
+                vector_store, points, queries, exact, args
+            )
+        if args.qdrant_url:
+            qdrant_client.delete_collection("benchmark")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1 @@
+# puts api/ (the import root of `utils`) on sys.path for the tests
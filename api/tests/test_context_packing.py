@@ -0,0 +1,65 @@
+from langchain_core.documents.base import Document
+
+from utils.context_packing import pack_context
+from utils.llm_utils import _reciprocal_rank_fusion
+
+
+def _doc(doc_id: str, path: str = None, chunk_no: int = 0, **metadata) -> Document:
+    return Document(
+        page_content=f"def {doc_id}_handler(request):\n    return {doc_id}(request)",
+        metadata={
+            "_id": doc_id,
+            "file_level_metadata": {"path": path or f"{doc_id}.py"},
+            "chunk_level_metadata": {"chunk_no": chunk_no},
+            **metadata,
+        },
+    )
+
+
+def _count_tokens(text: str) -> int:
+    return len(text.split())
+
+
+def test_fused_ranking_keeps_more_than_the_top_chunk():
+    docs = {doc_id: _doc(doc_id) for doc_id in "abcde"}
+    # "a" is first in both rankings, "d" and "e" are only found by the lexical search
+    fused = _reciprocal_rank_fusion([["a", "b", "c"], ["a", "d", "e"]])
+    packed, stats = pack_context(
+        [(docs[doc_id], score) for doc_id, score in fused],
+        count_tokens=_count_tokens,
+        min_relative_score=0.5,
+        fused_scores=True,
+    )
+    packed_ids = [doc.metadata["_id"] for doc in packed]
+    assert packed_ids[0] == "a"
+    assert set(packed_ids) == set("abcde")
+    assert stats["chunks_after"] == 5
+
+
+def test_similarity_scores_are_cut_relative_to_the_best():
+    packed, _ = pack_context(
+        [(_doc("a"), 0.9), (_doc("b"), 0.6), (_doc("c"), 0.3)],
+        count_tokens=_count_tokens,
+        min_relative_score=0.5,
+    )
+    assert [doc.metadata["_id"] for doc in packed] == ["a", "b"]
+
+
+def test_adjacent_chunks_of_different_repos_are_not_merged():
+    path = "utils/__init__.py"
+    packed, _ = pack_context(
+        [
+            (_doc("a", path, 0, _collection_name="a/utils"), 0.9),
+            (_doc("b", path, 1, _collection_name="b/utils"), 0.8),
+            (_doc("c", path, 1, _collection_name="a/utils"), 0.7),
+        ],
+        count_tokens=_count_tokens,
+        min_relative_score=0.5,
+    )
+    assert [
+        (
+            doc.metadata["_collection_name"],
+            doc.metadata["chunk_level_metadata"]["chunk_nos"],
+        )
+        for doc in packed
+    ] == [("a/utils", [0, 1]), ("b/utils", [1])]
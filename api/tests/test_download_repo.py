@@ -0,0 +1,89 @@
+import os
+import subprocess
+
+import pytest
+
+from benchmarks.end_to_end import serve_as_remote
+from utils import injectors
+from utils.data_utils import _download_repo, _remove_old_checkouts
+
+
+def _git(cwd: str, *args: str) -> str:
+    return subprocess.run(
+        ["git", "-c", "user.name=test", "-c", "user.email=test@example.com", *args],
+        cwd=cwd,
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout.strip()
+
+
+def _commit(repo_path: str, files: dict) -> str:
+    for path, content in files.items():
+        with open(os.path.join(repo_path, path), "w") as f:
+            f.write(content)
+    _git(repo_path, "add", "-A")
+    _git(repo_path, "commit", "-q", "-m", "update")
+    return _git(repo_path, "rev-parse", "HEAD")
+
+
+@pytest.fixture
+def remote(tmp_path, monkeypatch):
+    """A two commit repo served from a bare copy, and the config to clone it"""
+    source = tmp_path / "demo"
+    source.mkdir()
+    _git(str(source), "init", "-q")
+    _commit(str(source), {"a.py": "def a():\n    return 1\n"})
+    _commit(str(source), {"b.py": "def b():\n    return 2\n"})
+    remotes_dir = tmp_path / "remotes"
+    remotes_dir.mkdir()
+    url = serve_as_remote(str(source), str(remotes_dir))
+    repos_dir = tmp_path / "repos"
+    monkeypatch.setattr(
+        injectors,
+        "config",
+        {"Clone": {"repos_dir": str(repos_dir), "allow_local_remotes": True}},
+    )
+    return {"source": str(source), "url": url, "repo_root": repos_dir / "remotes/demo"}
+
+
+def _push(remote: dict, files: dict) -> str:
+    commit = _commit(remote["source"], files)
+    _git(remote["source"], "push", "-q", remote["url"].removeprefix("file://"), "HEAD")
+    return commit
+
+
+def test_fetches_the_head_commit_at_depth_1(remote):
+    head = _git(remote["source"], "rev-parse", "HEAD")
+    repo = _download_repo(remote["url"])
+    assert repo.working_tree_dir == str(remote["repo_root"] / head)
+    assert repo.head.commit.hexsha == head
+    assert repo.git.rev_list("--count", "HEAD") == "1"
+    assert sorted(os.listdir(repo.working_tree_dir)) == [".git", "a.py", "b.py"]
+    # no fetch directory is left behind
+    assert os.listdir(remote["repo_root"]) == [head]
+
+
+def test_reuses_the_checkout_of_a_downloaded_commit(remote):
+    repo = _download_repo(remote["url"])
+    marker = os.path.join(repo.working_tree_dir, "marker")
+    open(marker, "w").close()
+    for ref in (None, repo.head.commit.hexsha):
+        again = _download_repo(remote["url"], ref=ref)
+        assert again.working_tree_dir == repo.working_tree_dir
+        assert os.path.exists(marker)
+    assert os.listdir(remote["repo_root"]) == [repo.head.commit.hexsha]
+
+
+def test_refresh_fetches_the_new_commit_and_removes_the_old_checkout(remote):
+    old_repo = _download_repo(remote["url"])
+    new_commit = _push(remote, {"a.py": "def a():\n    return 3\n"})
+    new_repo = _download_repo(remote["url"])
+    assert new_repo.working_tree_dir == str(remote["repo_root"] / new_commit)
+    assert sorted(os.listdir(remote["repo_root"])) == sorted(
+        [old_repo.head.commit.hexsha, new_commit]
+    )
+    with open(os.path.join(new_repo.working_tree_dir, "a.py")) as f:
+        assert f.read() == "def a():\n    return 3\n"
+    _remove_old_checkouts(new_repo)
+    assert os.listdir(remote["repo_root"]) == [new_commit]
@@ -0,0 +1,72 @@
+import threading
+
+import pytest
+from fastapi.testclient import TestClient
+
+import app
+from utils import injectors, job_utils
+
+REPO_URL = "https://github.com/owner/demo"
+
+
+def _wait_until_done(job: job_utils.IngestJob):
+    for _ in range(200):
+        if not job.is_active():
+            return
+        threading.Event().wait(0.05)
+
+
+@pytest.fixture
+def release(monkeypatch):
+    """Ingestions block until the returned event is set"""
+    event = threading.Event()
+
+    def ingest_repo(**kwargs):
+        event.wait(timeout=10)
+        return True
+
+    monkeypatch.setattr(injectors, "config", {})
+    monkeypatch.setattr(job_utils, "ingest_repo", ingest_repo)
+    monkeypatch.setattr(app, "is_model_ready", lambda: True)
+    yield event
+    event.set()
+    for job in list(job_utils._jobs.values()):
+        _wait_until_done(job)
+    job_utils.shutdown()
+
+
+def test_requests_at_the_same_ref_share_the_job(release):
+    job = job_utils.submit_ingest_job(REPO_URL, ref="main")
+    assert job_utils.submit_ingest_job(REPO_URL + "/", ref="main") is job
+
+
+def test_another_ref_of_an_active_repo_is_a_conflict(release):
+    client = TestClient(app.app)
+    response = client.post("/ingest", json={"repo_url": REPO_URL})
+    assert response.status_code == 202
+    job_id = response.json()["job_id"]
+    response = client.post("/ingest", json={"repo_url": REPO_URL, "ref": "v1.0"})
+    assert response.status_code == 409
+    assert response.json()["job_id"] == job_id
+    assert response.headers["Location"] == f"/ingest/{job_id}"
+
+
+def test_another_ref_is_accepted_once_the_job_is_done(release):
+    job = job_utils.submit_ingest_job(REPO_URL)
+    release.set()
+    _wait_until_done(job)
+    assert job.status == "done"
+    assert job_utils.submit_ingest_job(REPO_URL, ref="v1.0") is not job
+
+
+def test_jobs_queued_at_shutdown_are_cancelled(release, monkeypatch):
+    monkeypatch.setattr(injectors, "config", {"Ingest": {"max_workers": 1}})
+    running = job_utils.submit_ingest_job(REPO_URL)
+    queued = job_utils.submit_ingest_job("https://github.com/owner/other")
+    while running.status == "queued":
+        threading.Event().wait(0.01)
+    job_utils.shutdown()
+    assert queued.to_dict()["status"] == "cancelled"
+    release.set()
+    _wait_until_done(running)
+    assert running.status == "done"
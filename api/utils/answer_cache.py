@@ -0,0 +1,129 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Optional
+
+import numpy as np
+
+
+class AnswerCache:
+    """
+    Per-repo cache of query embeddings and final answers.
+    A cached answer is reused when a new query's embedding is within `similarity_threshold`
+    (cosine) of the query it was generated for. Entries expire after `ttl_seconds`, each repo
+    keeps at most `max_entries_per_repo` answers and the least recently used repos are dropped
+    beyond `max_repos`. `invalidate` drops a repo's answers when it is re-ingested.
+    """
+
+    def __init__(
+        self,
+        similarity_threshold: float = 0.95,
+        ttl_seconds: float = 86400,
+        max_entries_per_repo: int = 512,
+        max_repos: int = 256,
+        max_query_embeddings: int = 4096,
+    ):
+        self.similarity_threshold = similarity_threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries_per_repo = max_entries_per_repo
+        self.max_repos = max_repos
+        self.max_query_embeddings = max_query_embeddings
+        self._lock = threading.Lock()
+        # repo -> {"embeddings": normalized matrix, "answers": [...], "created_at": [...]}
+        self._answers = OrderedDict()
+        # (repo, query) -> embedding
+        self._query_embeddings = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.query_embedding_hits = 0
+
+    @staticmethod
+    def _query_key(repo_name: str, query: str) -> tuple:
+        return repo_name, " ".join(query.lower().split())
+
+    def get_query_embedding(self, repo_name: str, query: str) -> Optional[List[float]]:
+        key = self._query_key(repo_name, query)
+        with self._lock:
+            embedding = self._query_embeddings.get(key)
+            if embedding is not None:
+                self._query_embeddings.move_to_end(key)
+                self.query_embedding_hits += 1
+            return embedding
+
+    def put_query_embedding(self, repo_name: str, query: str, embedding: List[float]):
+        with self._lock:
+            self._query_embeddings[self._query_key(repo_name, query)] = embedding
+            while len(self._query_embeddings) > self.max_query_embeddings:
+                self._query_embeddings.popitem(last=False)
+
+    def _expire(self, entries: dict, now: float):
+        keep = [
+            i
+            for i, created_at in enumerate(entries["created_at"])
+            if now - created_at < self.ttl_seconds
+        ]
+        if len(keep) != len(entries["answers"]):
+            entries["embeddings"] = entries["embeddings"][keep]
+            entries["answers"] = [entries["answers"][i] for i in keep]
+            entries["created_at"] = [entries["created_at"][i] for i in keep]
+
+    def lookup(self, repo_name: str, query_embedding: List[float]) -> Optional[str]:
+        query_vector = _normalize(np.asarray(query_embedding, dtype=np.float32))
+        with self._lock:
+            entries = self._answers.get(repo_name)
+            if entries is not None:
+                self._answers.move_to_end(repo_name)
+                self._expire(entries, time.time())
+                if entries["answers"]:
+                    similarities = entries["embeddings"] @ query_vector
+                    best = int(np.argmax(similarities))
+                    if similarities[best] >= self.similarity_threshold:
+                        self.hits += 1
+                        return entries["answers"][best]
+            self.misses += 1
+        return None
+
+    def store(self, repo_name: str, query_embedding: List[float], answer: str):
+        query_vector = _normalize(np.asarray(query_embedding, dtype=np.float32))
+        with self._lock:
+            entries = self._answers.setdefault(
+                repo_name,
+                {
+                    "embeddings": np.empty((0, len(query_vector)), dtype=np.float32),
+                    "answers": [],
+                    "created_at": [],
+                },
+            )
+            self._answers.move_to_end(repo_name)
+            entries["embeddings"] = np.vstack([entries["embeddings"], query_vector])[
+                -self.max_entries_per_repo :
+            ]
+            entries["answers"] = (entries["answers"] + [answer])[
+                -self.max_entries_per_repo :
+            ]
+            entries["created_at"] = (entries["created_at"] + [time.time()])[
+                -self.max_entries_per_repo :
+            ]
+            while len(self._answers) > self.max_repos:
+                self._answers.popitem(last=False)
+
+    def invalidate(self, repo_name: str):
+        """Drops the cached answers of a repo, eg: after it was re-ingested"""
+        with self._lock:
+            self._answers.pop(repo_name, None)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "query_embedding_hits": self.query_embedding_hits,
+            "repos": len(self._answers),
+            "entries": sum(len(e["answers"]) for e in self._answers.values()),
+        }
+
+
+def _normalize(vector: np.ndarray) -> np.ndarray:
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
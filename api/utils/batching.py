@@ -0,0 +1,106 @@
+import asyncio
+import time
+from collections import deque
+from concurrent.futures import Executor
+from typing import Callable, List
+
+import numpy as np
+
+
+class EmbeddingBatcher:
+    """
+    Collects concurrent query-embedding requests for up to `max_wait_ms` (or until
+    `max_batch_size` requests are waiting) and runs them as one batched forward pass.
+    At most `max_concurrent_batches` batches run in the executor at the same time.
+    """
+
+    def __init__(
+        self,
+        embed_fn: Callable[[List[str]], List[List[float]]],
+        executor: Executor,
+        max_batch_size: int = 32,
+        max_wait_ms: float = 5,
+        max_concurrent_batches: int = 1,
+        stats_window: int = 10000,
+    ):
+        self.embed_fn = embed_fn
+        self.executor = executor
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.max_concurrent_batches = max_concurrent_batches
+        self.batch_sizes = deque(maxlen=stats_window)
+        self.queue_waits = deque(maxlen=stats_window)
+        self._queue = None
+        self._slots = None
+        self._runner = None
+        self._tasks = set()
+
+    def _start(self):
+        self._queue = asyncio.Queue()
+        self._slots = asyncio.Semaphore(self.max_concurrent_batches)
+        self._runner = asyncio.create_task(self._run())
+
+    async def embed(self, text: str) -> List[float]:
+        if self._runner is None:
+            self._start()
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((text, future, time.perf_counter()))
+        return await future
+
+    async def _collect_batch(self) -> list:
+        batch = [await self._queue.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        while True:
+            batch = await self._collect_batch()
+            await self._slots.acquire()
+            task = asyncio.create_task(self._embed_batch(batch))
+            # keep a reference until the task is done
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _embed_batch(self, batch: list):
+        started = time.perf_counter()
+        self.batch_sizes.append(len(batch))
+        self.queue_waits.extend(started - enqueued_at for _, _, enqueued_at in batch)
+        try:
+            embeddings = await asyncio.get_running_loop().run_in_executor(
+                self.executor, self.embed_fn, [text for text, _, _ in batch]
+            )
+            for (_, future, _), embedding in zip(batch, embeddings):
+                if not future.done():
+                    future.set_result(embedding)
+        except Exception as e:
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+        finally:
+            self._slots.release()
+
+    async def stop(self):
+        if self._runner is not None:
+            self._runner.cancel()
+            self._runner = None
+
+    def stats(self) -> dict:
+        batch_sizes = np.asarray(self.batch_sizes, dtype=np.float64)
+        queue_waits_ms = np.asarray(self.queue_waits, dtype=np.float64) * 1000
+        if not len(batch_sizes):
+            return {"batches": 0}
+        return {
+            "batches": len(batch_sizes),
+            "batch_size_p50": float(np.percentile(batch_sizes, 50)),
+            "batch_size_p99": float(np.percentile(batch_sizes, 99)),
+            "queue_wait_ms_p50": round(float(np.percentile(queue_waits_ms, 50)), 3),
+            "queue_wait_ms_p99": round(float(np.percentile(queue_waits_ms, 99)), 3),
+        }
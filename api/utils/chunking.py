@@ -0,0 +1,134 @@
+"""
+Language detection and splitting of file contents.
+Kept free of heavy imports: the splitting runs in spawned worker processes.
+"""
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from typing import List, Tuple
+
+from langchain_text_splitters import RecursiveCharacterTextSplitter, Language
+
+# language used for files that match no known extension/shebang
+PLAIN_TEXT = "TEXT"
+
+_EXTENSION_LANGUAGES = {
+    ".py": "PYTHON",
+    ".pyi": "PYTHON",
+    ".js": "JS",
+    ".jsx": "JS",
+    ".mjs": "JS",
+    ".cjs": "JS",
+    ".ts": "TS",
+    ".tsx": "TS",
+    ".java": "JAVA",
+    ".kt": "KOTLIN",
+    ".kts": "KOTLIN",
+    ".go": "GO",
+    ".rs": "RUST",
+    ".rb": "RUBY",
+    ".php": "PHP",
+    ".c": "C",
+    ".h": "C",
+    ".cc": "CPP",
+    ".cpp": "CPP",
+    ".cxx": "CPP",
+    ".hpp": "CPP",
+    ".hh": "CPP",
+    ".cs": "CSHARP",
+    ".scala": "SCALA",
+    ".swift": "SWIFT",
+    ".lua": "LUA",
+    ".pl": "PERL",
+    ".pm": "PERL",
+    ".hs": "HASKELL",
+    ".sol": "SOL",
+    ".cob": "COBOL",
+    ".cbl": "COBOL",
+    ".proto": "PROTO",
+    ".md": "MARKDOWN",
+    ".markdown": "MARKDOWN",
+    ".rst": "RST",
+    ".tex": "LATEX",
+    ".html": "HTML",
+    ".htm": "HTML",
+}
+
+_SHEBANG_LANGUAGES = {
+    "python": "PYTHON",
+    "node": "JS",
+    "ruby": "RUBY",
+    "perl": "PERL",
+    "php": "PHP",
+    "lua": "LUA",
+}
+
+
+def detect_language(path: str, content: str) -> str:
+    """Returns the name of the `Language` of the file, PLAIN_TEXT if unknown"""
+    language = _EXTENSION_LANGUAGES.get(os.path.splitext(path)[1].lower())
+    if language is None and content.startswith("#!"):
+        shebang = content[: content.find("\n")] if "\n" in content else content
+        language = next(
+            (lang for name, lang in _SHEBANG_LANGUAGES.items() if name in shebang),
+            None,
+        )
+    # older langchain versions may not know every language
+    if language is None or language not in Language._member_map_:
+        return PLAIN_TEXT
+    return language
+
+
+@lru_cache(maxsize=None)
+def _get_splitter(
+    language: str, chunk_size: int, chunk_overlap: int
+) -> RecursiveCharacterTextSplitter:
+    """One splitter per (language, size) in each process"""
+    if language == PLAIN_TEXT:
+        return RecursiveCharacterTextSplitter(
+            chunk_size=chunk_size, chunk_overlap=chunk_overlap
+        )
+    return RecursiveCharacterTextSplitter.from_language(
+        language=Language._member_map_[language],
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap,
+    )
+
+
+def split_text(
+    content: str, language: str, chunk_size: int, chunk_overlap: int
+) -> List[str]:
+    return _get_splitter(language, chunk_size, chunk_overlap).split_text(content)
+
+
+def split_text_timed(
+    content: str, language: str, chunk_size: int, chunk_overlap: int
+) -> Tuple[List[str], float]:
+    """split_text and its duration, measured inside the worker process"""
+    started = time.perf_counter()
+    chunk_texts = split_text(content, language, chunk_size, chunk_overlap)
+    return chunk_texts, time.perf_counter() - started
+
+
+_executor: ProcessPoolExecutor = None
+
+
+def get_executor(num_workers: int = 0) -> ProcessPoolExecutor:
+    """Process pool for splitting, 0 workers means one per core"""
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(
+            max_workers=num_workers or os.cpu_count(),
+            # fork is unsafe next to the threads of torch and the ingest pool
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+    return _executor
+
+
+def shutdown():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
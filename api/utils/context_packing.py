@@ -0,0 +1,116 @@
+"""
+Packs the retrieved chunks into the LLM context: relevance cutoff, near-duplicate removal,
+merging of adjacent chunks of the same file and a greedy token budget.
+"""
+import copy
+from typing import Callable, List, Tuple
+
+from langchain_core.documents.base import Document
+
+from utils.lexical_index import tokenize
+
+
+def _collection(doc: Document) -> str:
+    # set by the vector store, repos searched together may have files of the same path
+    return doc.metadata.get("_collection_name", "")
+
+
+def _path(doc: Document) -> str:
+    return doc.metadata.get("file_level_metadata", {}).get("path")
+
+
+def _chunk_no(doc: Document) -> int:
+    return doc.metadata.get("chunk_level_metadata", {}).get("chunk_no", 0)
+
+
+def _jaccard(a: set, b: set) -> float:
+    return len(a & b) / len(a | b) if a or b else 1.0
+
+
+def _drop_near_duplicates(
+    scored_docs: List[Tuple[Document, float]], threshold: float
+) -> List[Tuple[Document, float]]:
+    """Keeps the best scored of the chunks whose token sets overlap by >= threshold"""
+    kept, kept_tokens = [], []
+    for doc, score in sorted(scored_docs, key=lambda item: item[1], reverse=True):
+        tokens = set(tokenize(doc.page_content))
+        if any(_jaccard(tokens, other) >= threshold for other in kept_tokens):
+            continue
+        kept.append((doc, score))
+        kept_tokens.append(tokens)
+    return kept
+
+
+def _merge_adjacent_chunks(
+    scored_docs: List[Tuple[Document, float]],
+) -> List[Tuple[Document, float]]:
+    """Merges consecutive chunks (by chunk_no) of the same file, scored by their best chunk"""
+    by_position = sorted(
+        scored_docs,
+        key=lambda item: (_collection(item[0]), _path(item[0]), _chunk_no(item[0])),
+    )
+    merged = []
+    for doc, score in by_position:
+        if merged:
+            last_doc, last_score = merged[-1]
+            chunk_nos = last_doc.metadata["chunk_level_metadata"]["chunk_nos"]
+            if (
+                _collection(last_doc) == _collection(doc)
+                and _path(last_doc) == _path(doc)
+                and _chunk_no(doc) == chunk_nos[-1] + 1
+            ):
+                last_doc.page_content += "\n" + doc.page_content
+                chunk_nos.append(_chunk_no(doc))
+                merged[-1] = (last_doc, max(last_score, score))
+                continue
+        chunk_no = _chunk_no(doc)
+        doc = Document(
+            page_content=doc.page_content, metadata=copy.deepcopy(doc.metadata)
+        )
+        doc.metadata.setdefault("chunk_level_metadata", {})["chunk_nos"] = [chunk_no]
+        merged.append((doc, score))
+    return merged
+
+
+def pack_context(
+    scored_docs: List[Tuple[Document, float]],
+    count_tokens: Callable[[str], int],
+    token_budget: int = 2000,
+    min_relative_score: float = 0.5,
+    duplicate_threshold: float = 0.9,
+    fused_scores: bool = False,
+) -> Tuple[List[Document], dict]:
+    """
+    Returns the docs to put in the context (best first) and the token counts before and
+    after packing. Chunks scored below `min_relative_score` * the best score are dropped,
+    unless the scores are reciprocal rank fusion scores (`fused_scores`): a chunk ranked
+    first by both retrievers scores about twice any chunk found by one of them, the
+    ratio says nothing about relevance.
+    """
+    tokens_before = sum(count_tokens(doc.page_content) for doc, _ in scored_docs)
+    chunks_before = len(scored_docs)
+    if scored_docs and not fused_scores:
+        best_score = max(score for _, score in scored_docs)
+        if best_score > 0:
+            scored_docs = [
+                (doc, score)
+                for doc, score in scored_docs
+                if score >= min_relative_score * best_score
+            ]
+    scored_docs = _drop_near_duplicates(scored_docs, duplicate_threshold)
+    scored_docs = _merge_adjacent_chunks(scored_docs)
+    packed, tokens_after = [], 0
+    for doc, _ in sorted(scored_docs, key=lambda item: item[1], reverse=True):
+        num_tokens = count_tokens(doc.page_content)
+        # a chunk that does not fit is skipped (smaller ones may still fit), but the best
+        # one always goes in
+        if packed and tokens_after + num_tokens > token_budget:
+            continue
+        packed.append(doc)
+        tokens_after += num_tokens
+    return packed, {
+        "chunks_before": chunks_before,
+        "chunks_after": len(packed),
+        "tokens_before": tokens_before,
+        "tokens_after": tokens_after,
+    }
@@ -1,6 +1,7 @@
-from typing import List, Any
+import os
+from typing import List, Any, Optional
 
-from transformers import AutoModel, AutoTokenizer
+import numpy as np
 from langchain_core.embeddings import Embeddings
 from pydantic import BaseModel
 
@@ -9,11 +10,17 @@ from pydantic import BaseModel
 class Ingest(BaseModel):
     repo_url: str = "https://github.com/zpqrtbnk/test-repo.git"
     insert_custom_embeddings: bool = False
+    # re-ingest only the files that changed since the last ingestion
+    refresh: bool = False
+    # branch, tag or commit to ingest, defaults to the configured ref / remote HEAD
+    ref: Optional[str] = None
 
 
 class Generate(BaseModel):
     query: str = "What is the repo about?"
     repo_url: str = "https://github.com/zpqrtbnk/test-repo.git"
+    # more repos searched in the same query (with shared collections, or not)
+    repo_urls: Optional[List[str]] = None
 
 
 # Used for data processing
@@ -50,29 +57,134 @@ CodeT5+
 
 
 class CodeT5PlusEmbeddings(Embeddings):
+    """
+    Backends (all CPU):
+    - torch: fp32 PyTorch weights
+    - int8: dynamic int8 quantization of the Linear layers
+    - onnx: ONNX Runtime session over a model exported once to `onnx_path`
+    """
+
+    BACKENDS = ("torch", "int8", "onnx")
+
     # model: "Salesforce/codet5p-110m-embedding"
     def __init__(
         self,
         model_path: str = "models/codet5p-110m-embedding/snapshots/94f88f95672b1d4b0cc715c6011001a74f892bdd",
+        batch_size: int = 32,
+        num_threads: int = 0,
+        max_length: int = 512,
+        backend: str = "torch",
+        onnx_path: str = "models/codet5p-110m-embedding/onnx/model.onnx",
     ) -> None:
-        # @TODO accept config from properties file
         # model_name = "Salesforce/codet5p-110m-embedding"
+        if backend not in self.BACKENDS:
+            raise Exception(f"Unknown embedding backend {backend}")
+        # heavy imports, deferred until a model is actually loaded
+        import torch
+        from transformers import AutoModel, AutoTokenizer
+
         self.device = "cpu"
+        self.backend = backend
+        self.batch_size = batch_size
+        self.max_length = max_length
+        if num_threads > 0:
+            # intra-op parallelism of the forward pass
+            torch.set_num_threads(num_threads)
         self.tokenizer = AutoTokenizer.from_pretrained(
             model_path, trust_remote_code=True
         )
         self.model = AutoModel.from_pretrained(model_path, trust_remote_code=True).to(
             self.device
         )
+        self.model.eval()
+        self.onnx_session = None
+        if backend == "int8":
+            self.model = torch.quantization.quantize_dynamic(
+                self.model, {torch.nn.Linear}, dtype=torch.qint8
+            )
+        elif backend == "onnx":
+            self.onnx_session = self._load_onnx_session(onnx_path, num_threads)
+            # the session replaces the torch weights
+            self.model = None
         super().__init__()
 
+    def _export_onnx(self, onnx_path: str):
+        import torch
+
+        print(f"Exporting the embedding model to {onnx_path}..")
+        os.makedirs(os.path.dirname(onnx_path), exist_ok=True)
+        dummy = self.tokenizer(["def f(): pass"], return_tensors="pt")
+        with torch.inference_mode():
+            torch.onnx.export(
+                self.model,
+                (dummy["input_ids"], dummy["attention_mask"]),
+                onnx_path,
+                input_names=["input_ids", "attention_mask"],
+                output_names=["embedding"],
+                dynamic_axes={
+                    "input_ids": {0: "batch", 1: "sequence"},
+                    "attention_mask": {0: "batch", 1: "sequence"},
+                    "embedding": {0: "batch"},
+                },
+                opset_version=14,
+            )
+
+    def _load_onnx_session(self, onnx_path: str, num_threads: int):
+        import onnxruntime
+
+        if not os.path.exists(onnx_path):
+            self._export_onnx(onnx_path)
+        options = onnxruntime.SessionOptions()
+        if num_threads > 0:
+            options.intra_op_num_threads = num_threads
+        return onnxruntime.InferenceSession(
+            onnx_path, sess_options=options, providers=["CPUExecutionProvider"]
+        )
+
+    def _forward(self, input_ids: List[List[int]]) -> List[List[float]]:
+        if self.onnx_session is not None:
+            inputs = self.tokenizer.pad({"input_ids": input_ids}, return_tensors="np")
+            return self.onnx_session.run(
+                None,
+                {
+                    "input_ids": inputs["input_ids"].astype(np.int64),
+                    "attention_mask": inputs["attention_mask"].astype(np.int64),
+                },
+            )[0].tolist()
+        inputs = self.tokenizer.pad({"input_ids": input_ids}, return_tensors="pt").to(
+            self.device
+        )
+        return self.model(
+            inputs["input_ids"], attention_mask=inputs["attention_mask"]
+        ).tolist()
+
     def embed_documents(self, texts: List[str]) -> List[List[float]]:
-        inputs = self.tokenizer.batch_encode_plus(
-            texts, return_tensors="pt", truncation=True, padding=True
-        ).to(self.device)
-        return self.model(inputs["input_ids"]).tolist()
+        """
+        Embeds the texts in micro-batches of `batch_size`.
+        Texts are sorted by token length so each batch pads to similar lengths,
+        and the embeddings are returned in the original order.
+        """
+        import torch
+
+        if not texts:
+            return []
+        encoded = self.tokenizer(texts, truncation=True, max_length=self.max_length)
+        input_ids = encoded["input_ids"]
+        order = sorted(range(len(texts)), key=lambda i: len(input_ids[i]))
+        embeddings = [None] * len(texts)
+        with torch.inference_mode():
+            for start in range(0, len(order), self.batch_size):
+                batch_order = order[start : start + self.batch_size]
+                batch_embeddings = self._forward([input_ids[i] for i in batch_order])
+                for i, embedding in zip(batch_order, batch_embeddings):
+                    embeddings[i] = embedding
+        return embeddings
 
     def embed_query(self, query: str) -> List[float]:
-        return self.model(
-            self.tokenizer.encode(query, return_tensors="pt").to(self.device)
-        ).tolist()[0]
+        import torch
+
+        input_ids = self.tokenizer.encode(
+            query, truncation=True, max_length=self.max_length
+        )
+        with torch.inference_mode():
+            return self._forward([input_ids])[0]
@@ -1,162 +1,719 @@
+import copy
+import json
 import os
-from typing import List
+import shutil
+import tempfile
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, Iterator, List
 import re
 
 from git import Repo
-from langchain_text_splitters import RecursiveCharacterTextSplitter, Language
+from langchain_core.documents.base import Document
 
+from utils import chunking, metrics
 from utils.custom_classes import RepoFile
-from utils.vector_utils import embed_and_store, _is_collection_exists
+from utils.injectors import (
+    answer_cache_instance,
+    config_instance,
+    lexical_index_instance,
+    lexical_index_path,
+    symbol_index_instance,
+    symbol_index_path,
+    vector_store_instance,
+)
+from utils.lexical_index import LexicalIndexBuilder
+from utils.symbol_index import SymbolIndexBuilder, chunk_symbols, extract_symbols
+from utils.vector_utils import (
+    embed_and_store,
+    _is_collection_exists,
+    _get_stored_blob_shas,
+    _delete_file_points,
+    _iter_stored_chunks,
+    _point_id,
+    _ParallelUpserter,
+    repo_collection_name,
+)
+from utils.vector_stores import Point
 
 
 def _is_valid_url(repo_url: str):
+    clone_config = config_instance().get("Clone", {})
+    if clone_config.get("allow_local_remotes", False) and (
+        repo_url.startswith("file://") or os.path.isabs(repo_url)
+    ):
+        return True
     return re.match(
         r"https?:\/\/(?:www\.)?github\.com\/[a-zA-Z0-9-]+\/[a-zA-Z0-9-]+(?:\/)?(?:\w+)?(?:\/)?(?:\w+)?",
         repo_url,
     )
 
 
-def _download_repo(url: str):
-    repo = None
-    repo_dir = url.split("/")[-1].split(".")[0]
+def _repo_owner_and_name(url: str):
+    parts = url.rstrip("/").removesuffix(".git").split("/")
+    return parts[-2] or "local", parts[-1]
+
+
+def _is_partial_clone(repo: Repo) -> bool:
+    return repo.config_reader().has_option('remote "origin"', "promisor")
+
+
+def _get_missing_blobs(repo: Repo) -> set:
+    """SHAs of the blobs left out by the partial clone filter"""
+    if not _is_partial_clone(repo):
+        return set()
+    objects = repo.git.rev_list("--objects", "--missing=print", "HEAD")
+    return {line[1:] for line in objects.splitlines() if line.startswith("?")}
+
+
+def _checkout(repo: Repo):
+    """Checks out HEAD, only the fetched blobs in case of a partial clone"""
+    missing_blobs = _get_missing_blobs(repo)
+    if not missing_blobs:
+        repo.git.reset("--hard")
+        return
+    # a plain checkout would lazily fetch the filtered out blobs from the remote
+    paths = [
+        item.path
+        for item in repo.tree().traverse()
+        if item.type == "blob" and item.hexsha not in missing_blobs
+    ]
+    if not paths:
+        return
+    pathspec_file = os.path.join(repo.git_dir, "ingest-pathspec")
+    with open(pathspec_file, "w") as f:
+        f.write("\0".join(paths))
+    repo.git.checkout(
+        "HEAD",
+        f"--pathspec-from-file={pathspec_file}",
+        "--pathspec-file-nul",
+        env={"GIT_LITERAL_PATHSPECS": "1"},
+    )
+
+
+def _download_repo(url: str, ref: str = None) -> Repo:
+    """
+    Fetches a single ref (branch, tag or commit, the remote HEAD by default) with the
+    configured depth and blob filter into <repos_dir>/<owner>/<repo>/<commit>.
+    A commit that was already downloaded is reused as is.
+    """
+    clone_config = config_instance().get("Clone", {})
+    owner, name = _repo_owner_and_name(url)
+    repo_root = os.path.join(clone_config.get("repos_dir", "repos"), owner, name)
+    ref = ref or clone_config.get("ref") or "HEAD"
+    if re.fullmatch(r"[0-9a-f]{40}", ref) and os.path.exists(
+        os.path.join(repo_root, ref)
+    ):
+        print("Repo already downloaded..")
+        return Repo(os.path.join(repo_root, ref))
+    os.makedirs(repo_root, exist_ok=True)
+    # fetched next to the final location, then renamed once the commit is known
+    fetch_dir = tempfile.mkdtemp(dir=repo_root, prefix=".fetch-")
     try:
-        if not os.path.exists(repo_dir):
-            os.makedirs(repo_dir)
-            print("Downloading Repo..")
-            repo = Repo.clone_from(url, repo_dir)
-        else:
+        repo = Repo.init(fetch_dir)
+        repo.create_remote("origin", url)
+        fetch_args = []
+        if clone_config.get("depth", 1):
+            fetch_args.append(f"--depth={clone_config.get('depth', 1)}")
+        if clone_config.get("blob_filter"):
+            fetch_args.append(f"--filter={clone_config.get('blob_filter')}")
+        print(f"Downloading Repo.. ({ref})")
+        repo.git.fetch("origin", ref, *fetch_args)
+        commit = repo.git.rev_parse("FETCH_HEAD")
+        repo.git.update_ref("--no-deref", "HEAD", commit)
+        repo_dir = os.path.join(repo_root, commit)
+        if os.path.exists(repo_dir):
             print("Repo already downloaded..")
-            repo = Repo.init(repo_dir)
-    except Exception as e:
-        print(e)
-    return repo
+            shutil.rmtree(fetch_dir)
+        else:
+            _checkout(repo)
+            os.rename(fetch_dir, repo_dir)
+    except Exception:
+        shutil.rmtree(fetch_dir, ignore_errors=True)
+        raise
+    return Repo(repo_dir)
+
+
+def _remove_old_checkouts(repo: Repo):
+    """Deletes the checkouts of the other commits of the repo, once it is ingested"""
+    repo_root, commit = os.path.split(repo.working_tree_dir.rstrip(os.sep))
+    for entry in os.listdir(repo_root):
+        if entry != commit and re.fullmatch(r"[0-9a-f]{40}", entry):
+            print(f"Removing the checkout of {entry}..")
+            shutil.rmtree(os.path.join(repo_root, entry), ignore_errors=True)
+
+
+def _get_tree_blob_shas(repo: Repo) -> Dict[str, str]:
+    # cheap: only walks the tree objects, no blob is read
+    return {
+        item.path: item.hexsha for item in repo.tree().traverse() if item.type == "blob"
+    }
+
+
+def _diff_blob_shas(stored: Dict[str, str], current: Dict[str, str]):
+    """Returns paths of (changed i.e added or modified, removed) files"""
+    changed = {path for path, sha in current.items() if stored.get(path) != sha}
+    removed = set(stored) - set(current)
+    return changed, removed
+
+
+# extensions that are never worth reading: binaries, assets, archives, lockfiles, bundles
+_DENY_EXTENSIONS = tuple(
+    """
+    .png .jpg .jpeg .gif .bmp .ico .webp .tiff .psd .mp3 .mp4 .wav .ogg .avi .mov
+    .webm .flac .zip .tar .gz .tgz .bz2 .xz .7z .rar .jar .war .whl .egg .so .dll
+    .dylib .exe .bin .o .a .class .pyc .pyd .wasm .pdf .doc .docx .xls .xlsx .ppt
+    .pptx .ttf .otf .woff .woff2 .eot .npy .npz .pkl .pt .pth .onnx .h5 .ckpt
+    .safetensors .parquet .db .sqlite .lock .min.js .min.css .map
+    """.split()
+)
+_DENY_FILE_NAMES = ("package-lock.json", "yarn.lock", "pnpm-lock.yaml", "go.sum")
+_SYMLINK_MODE = 0o120000
 
 
-def _filter_text_files(repo: Repo) -> List[RepoFile]:
-    # @TODO add additional processing steps for each file
+def _triage_by_name(blob, deny_extensions: tuple) -> str:
+    """Cheap checks on the tree entry only, returns the reason to skip it (if any)"""
+    path = blob.path.lower()
+    if path.startswith("."):
+        return "hidden"
+    if path.endswith(".ipynb"):
+        return "notebook"
+    if blob.mode == _SYMLINK_MODE:
+        return "symlink"
+    if path.endswith(deny_extensions) or path.split("/")[-1] in _DENY_FILE_NAMES:
+        return "denied_extension"
+    return None
+
+
+def _read_text_file(file_path: str, max_file_bytes: int, sniff_bytes: int):
+    """
+    Returns (content, skip reason, size in bytes) of a checked out file.
+    Large files are skipped on their size and binaries on a null byte in the
+    first `sniff_bytes`, before the whole file is read.
+    """
+    with metrics.span("ingest", "decode"):
+        try:
+            size = os.lstat(file_path).st_size
+            if size == 0:
+                return None, "empty", size
+            if size > max_file_bytes:
+                return None, "too_large", size
+            with open(file_path, "rb") as f:
+                head = f.read(sniff_bytes)
+                if b"\0" in head:
+                    return None, "binary", size
+                data = head + f.read()
+        except OSError:
+            return None, "unreadable", 0
+        try:
+            return data.decode("utf-8"), None, size
+        except UnicodeDecodeError:
+            return None, "not_utf8", size
+
+
+def _filter_text_files(
+    repo: Repo, only_paths: set = None, triage_stats: dict = None
+) -> Iterator[RepoFile]:
+    """
+    Yields the text files of the repo.
+    Blobs are triaged by name first; the surviving ones are sniffed and decoded in a
+    thread pool from the checked out working tree. Counts and bytes of the skipped files
+    per reason are collected in `triage_stats`.
+    """
     print("Filtering files that has text..")
-    is_hidden_dir = lambda path: path.startswith(".")
     get_file_name = lambda path: path.split("/")[-1]
-    is_notebook = lambda path: path.endswith(".ipynb")
     repo_name = repo.remotes.origin.url.split(".git")[0].split("/")[-1]
-    files = []
-    names = []
-    for blob in repo.tree().traverse():
-        if (
-            not is_hidden_dir(blob.path)
-            and not is_notebook(blob.path)
-            and blob.type == "blob"
-        ):
-            try:
-                data = blob.data_stream.read().decode("utf-8")
-                if len(data) == 0:
-                    continue
-                print(f"Adding contents of the file {blob.path}")
-                files.append(
-                    RepoFile(
-                        content=data,
-                        repo_name=repo_name,
-                        # metadata can be at the doc level or the chunk level
-                        file_level_metadata={
-                            "file_name": get_file_name(blob.path),
-                            "path": blob.path,
-                        },
-                    )
-                )
-                names.append(get_file_name(blob.path))
-            except Exception:
-                print(f"Could not parse {blob.path}")
-    print(f"Files parsed: {names}")
-    return files
+    triage_config = config_instance().get("Triage", {})
+    deny_extensions = tuple(triage_config.get("deny_extensions", _DENY_EXTENSIONS))
+    max_file_bytes = triage_config.get("max_file_bytes", 1000000)
+    sniff_bytes = triage_config.get("sniff_bytes", 8192)
+    num_workers = triage_config.get("decode_workers", 8)
+    triage_stats = triage_stats if triage_stats is not None else {}
+
+    def skip(reason: str, size: int = 0):
+        reason_stats = triage_stats.setdefault(reason, {"files": 0, "bytes": 0})
+        reason_stats["files"] += 1
+        reason_stats["bytes"] += size
+        metrics.INGEST_FILES.inc(reason=reason)
+        metrics.INGEST_BYTES.inc(size, reason=reason)
 
+    def to_repo_file(blob, future) -> RepoFile:
+        data, reason, size = future.result()
+        if reason is not None:
+            skip(reason, size)
+            return None
+        skip("kept", size)
+        return RepoFile(
+            content=data,
+            repo_name=repo_name,
+            # metadata can be at the doc level or the chunk level
+            file_level_metadata={
+                "file_name": get_file_name(blob.path),
+                "path": blob.path,
+                "blob_sha": blob.hexsha,
+            },
+        )
+
+    missing_blobs = _get_missing_blobs(repo)
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        for blob in repo.tree().traverse():
+            if blob.type != "blob" or (
+                only_paths is not None and blob.path not in only_paths
+            ):
+                continue
+            if blob.hexsha in missing_blobs:
+                # above the size limit of the clone filter, never fetched
+                skip("filtered_out")
+                continue
+            reason = _triage_by_name(blob, deny_extensions)
+            if reason is not None:
+                skip(reason)
+                continue
+            future = executor.submit(
+                _read_text_file,
+                os.path.join(repo.working_tree_dir, blob.path),
+                max_file_bytes,
+                sniff_bytes,
+            )
+            pending.append((blob, future))
+            # bounded read-ahead, files are yielded in tree order
+            if len(pending) >= 4 * num_workers:
+                repo_file = to_repo_file(*pending.popleft())
+                if repo_file is not None:
+                    yield repo_file
+        while pending:
+            repo_file = to_repo_file(*pending.popleft())
+            if repo_file is not None:
+                yield repo_file
+    print(f"File triage: {triage_stats}")
 
-def _clean_scripts(repo_files: List[Repo]):
+
+def _clean_scripts(repo_files: Iterable[RepoFile]) -> Iterator[RepoFile]:
     # @TODO add additional cleaning steps
-    print("Cleaning scripts..")
     for repo_file in repo_files:
         # remove trailing spaces and new lines
         repo_file.set("content", repo_file.get("content").rstrip())
-    return repo_files
+        yield repo_file
 
 
-def _update_file_level_metadata(repo_files: List[RepoFile]) -> List[RepoFile]:
-    """@TODO add additional file_level_metadata such as functions names in script, comments etc"""
-    print("Updating File level metadata..")
+def _update_file_level_metadata(
+    repo_files: Iterable[RepoFile],
+) -> Iterator[RepoFile]:
+    """
+    Length and language of the file, and its symbols (definitions and call references)
+    when the symbol index is enabled.
+    @TODO add additional file_level_metadata such as comments etc
+    """
+    extract = config_instance().get("Symbols", {}).get("enabled", False)
     for repo_file in repo_files:
         # length of whole script
         content = repo_file.get("content")
-        repo_file.get("file_level_metadata", {}).update({"length": len(content)})
-    return repo_files
+        file_level_metadata = repo_file.get("file_level_metadata", {})
+        language = chunking.detect_language(file_level_metadata.get("path"), content)
+        file_level_metadata.update(
+            {"length": len(content), "language": language.lower()}
+        )
+        if extract:
+            with metrics.span("ingest", "symbols"):
+                repo_file.set("symbols", extract_symbols(content, language))
+        yield repo_file
+
+
+def _chunk_lines(content: str, chunk_texts: List[str]) -> List[tuple]:
+    """(first line, last line) of each chunk, the chunks are ordered substrings"""
+    lines = []
+    start = 0
+    line = 1
+    for chunk_text in chunk_texts:
+        position = content.find(chunk_text, start)
+        if position < 0:
+            # not a verbatim substring, the previous location is kept
+            position = start
+        line += content.count("\n", start, position)
+        start = position
+        lines.append((line, line + chunk_text.count("\n")))
+    return lines
+
+
+def _attach_chunks(file: RepoFile, chunk_texts: List[str]) -> RepoFile:
+    file_metadata = {"file_level_metadata": file.get("file_level_metadata")}
+    chunk_docs = [
+        Document(page_content=chunk_text, metadata=copy.deepcopy(file_metadata))
+        for chunk_text in chunk_texts
+    ]
+    symbols = file.get("symbols")
+    if symbols is not None:
+        # chunks are tagged with the names they define, for filtered searches
+        definitions, _ = symbols
+        chunk_lines = _chunk_lines(file.get("content"), chunk_texts)
+        for chunk_doc, (start_line, end_line) in zip(chunk_docs, chunk_lines):
+            chunk_doc.metadata["chunk_level_metadata"] = {
+                "start_line": start_line,
+                "end_line": end_line,
+                "symbols": chunk_symbols(definitions, start_line, end_line),
+            }
+    file.set("chunks", chunk_docs)
+    # the chunks carry the content from here on, no need to hold the whole file
+    file.set("content", None)
+    return file
+
+
+def _attach_timed_chunks(file: RepoFile, timed_chunks: tuple) -> RepoFile:
+    chunk_texts, seconds = timed_chunks
+    # the split ran in a worker process, its duration is recorded here
+    metrics.STAGE_SECONDS.observe(seconds, pipeline="ingest", stage="chunk")
+    return _attach_chunks(file, chunk_texts)
 
 
 def _chunk_repo_files(
-    repo_files: List[RepoFile],
-    prog_language: str = "PYTHON",
+    repo_files: Iterable[RepoFile],
     chunk_size: int = 500,
     chunk_overlap: int = 0,
-) -> List[RepoFile]:
-    print("Chunking files..")
-    splitter_for_lang = RecursiveCharacterTextSplitter.from_language(
-        language=Language._member_map_[prog_language],
-        chunk_overlap=chunk_overlap,
-        chunk_size=chunk_size,
-    )
+) -> Iterator[RepoFile]:
+    """
+    Splits every file with the splitter of its detected language.
+    The splitting fans out over a process pool; at most `max_in_flight` files are
+    pending at a time so the stream stays bounded, and files are yielded in order.
+    """
+    ingest_config = config_instance().get("Ingest", {})
+    num_workers = ingest_config.get("chunking_workers", 0)
+    executor = chunking.get_executor(num_workers) if num_workers != 1 else None
+    max_in_flight = 4 * (num_workers or os.cpu_count())
+    pending = deque()
     for file in repo_files:
-        # @TODO detect the programing language type based on the file content to get better chunking
         content = file.get("content")
-        file_metadata = {"file_level_metadata": file.get("file_level_metadata")}
-        chunked_docs = splitter_for_lang.create_documents(
-            [content], metadatas=[file_metadata]
+        # detected by _update_file_level_metadata
+        language = file.get("file_level_metadata")["language"].upper()
+        if executor is None:
+            with metrics.span("ingest", "chunk"):
+                chunk_texts = chunking.split_text(
+                    content, language, chunk_size, chunk_overlap
+                )
+            yield _attach_chunks(file, chunk_texts)
+            continue
+        pending.append(
+            (
+                file,
+                executor.submit(
+                    chunking.split_text_timed,
+                    content,
+                    language,
+                    chunk_size,
+                    chunk_overlap,
+                ),
+            )
         )
-        file.set("chunks", chunked_docs)
-    return repo_files
+        if len(pending) >= max_in_flight:
+            file, future = pending.popleft()
+            yield _attach_timed_chunks(file, future.result())
+    while pending:
+        file, future = pending.popleft()
+        yield _attach_timed_chunks(file, future.result())
 
 
-def _update_chunk_level_metadata(repo_files: List[RepoFile]) -> List[RepoFile]:
+def _update_chunk_level_metadata(
+    repo_files: Iterable[RepoFile],
+) -> Iterator[RepoFile]:
     """#@TODO add additional chunk_level_metadata if needed"""
-    print("Updating chunk level metadata..")
     for repo_file in repo_files:
         chunks = repo_file.get("chunks", [])
         for chunk_no, chunk_doc in enumerate(chunks):
-            chunk_doc.metadata.update(
-                {
-                    "chunk_level_metadata": {
-                        "chunk_no": chunk_no,
-                        "length": len(chunk_doc.page_content),
-                    }
-                }
+            chunk_doc.metadata.setdefault("chunk_level_metadata", {}).update(
+                {"chunk_no": chunk_no, "length": len(chunk_doc.page_content)}
             )
-    return repo_files
+        yield repo_file
 
 
-def _store_chunks(repo_files: List[RepoFile], insert_custom_embeddings: bool):
-    print("Embedding and storing in Qdrant..")
+def _store_chunks(
+    repo_files: Iterable[RepoFile],
+    repo_name: str,
+    insert_custom_embeddings: bool,
+    resume: bool = False,
+):
+    print("Embedding and storing in the vector store..")
     return embed_and_store(
-        repo_files, insert_custom_embeddings=insert_custom_embeddings
+        repo_files,
+        repo_name=repo_name,
+        insert_custom_embeddings=insert_custom_embeddings,
+        resume=resume,
+    )
+
+
+def _index_chunks_lexically(
+    repo_files: Iterable[RepoFile], repo_name: str, builder: LexicalIndexBuilder
+) -> Iterator[RepoFile]:
+    """Adds the chunks of the streamed files to the lexical index as they go by"""
+    for repo_file in repo_files:
+        for chunk_doc in repo_file.get("chunks", []):
+            builder.add(
+                _point_id(repo_name, chunk_doc),
+                chunk_doc.metadata.get("file_level_metadata", {}).get("path"),
+                chunk_doc.page_content,
+            )
+        yield repo_file
+
+
+def _save_lexical_index(
+    repo_name: str, builder: LexicalIndexBuilder, drop_paths: Iterable[str] = None
+):
+    """
+    Without drop_paths the builder holds every chunk of the repo. Otherwise it only holds
+    the re-ingested files, and the other files are copied from the stored index (or from
+    the collection, for repos ingested before the lexical index existed).
+    """
+    lexical_config = config_instance().get("Lexical", {})
+    if drop_paths is not None:
+        drop_paths = set(drop_paths)
+        stored_index = lexical_index_instance(repo_name)
+        if stored_index is not None:
+            builder.add_index(stored_index, drop_paths=drop_paths)
+        else:
+            print("Building the lexical index from the stored chunks..")
+            for point_id, path, content in _iter_stored_chunks(repo_name):
+                # re-ingested files are already in the builder
+                if path not in drop_paths:
+                    builder.add(point_id, path, content)
+    lexical_index = builder.build(
+        k1=lexical_config.get("k1", 1.2), b=lexical_config.get("b", 0.75)
+    )
+    lexical_index.save(lexical_index_path(repo_name))
+    print(f"Lexical index saved with {len(lexical_index)} chunks")
+
+
+def _index_symbols(
+    repo_files: Iterable[RepoFile], builder: SymbolIndexBuilder
+) -> Iterator[RepoFile]:
+    """Adds the symbols of the streamed files to the symbol index as they go by"""
+    for repo_file in repo_files:
+        symbols = repo_file.get("symbols")
+        if symbols is not None:
+            builder.add_file(repo_file.get("file_level_metadata")["path"], *symbols)
+            # the chunks carry what the vector store needs from here on
+            repo_file.set("symbols", None)
+        yield repo_file
+
+
+def _save_symbol_index(
+    repo_name: str,
+    builder: SymbolIndexBuilder,
+    drop_paths: Iterable[str] = None,
+    repo: Repo = None,
+):
+    """
+    Like _save_lexical_index: with drop_paths the other files are copied from the stored
+    index, or parsed again from the checkout of `repo` when there is none (eg: repos
+    ingested before the symbol index existed, or imported from a snapshot).
+    """
+    if drop_paths is not None:
+        drop_paths = set(drop_paths)
+        stored_index = symbol_index_instance(repo_name)
+        if stored_index is not None:
+            builder.add_index(stored_index, drop_paths=drop_paths)
+        elif repo is not None:
+            print("Building the symbol index from the checkout..")
+            triage_config = config_instance().get("Triage", {})
+            for path in _get_stored_blob_shas(repo_name):
+                if path in drop_paths:
+                    continue
+                content, _, _ = _read_text_file(
+                    os.path.join(repo.working_tree_dir, path),
+                    triage_config.get("max_file_bytes", 1000000),
+                    triage_config.get("sniff_bytes", 8192),
+                )
+                if content is None:
+                    continue
+                # as cleaned by _clean_scripts
+                content = content.rstrip()
+                language = chunking.detect_language(path, content)
+                builder.add_file(path, *extract_symbols(content, language))
+    symbol_index = builder.build()
+    symbol_index.save(symbol_index_path(repo_name))
+    print(f"Symbol index saved with {len(symbol_index)} definitions")
+
+
+def _ingest_state_path(repo_name: str) -> str:
+    repos_dir = config_instance().get("Clone", {}).get("repos_dir", "repos")
+    return os.path.join(repos_dir, ".ingest_state", f"{repo_name}.json")
+
+
+def _read_ingest_state(repo_name: str) -> dict:
+    try:
+        with open(_ingest_state_path(repo_name)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        # collections ingested before the state was recorded are complete
+        return {"status": "done"}
+
+
+def _write_ingest_state(repo_name: str, status: str, commit: str = None):
+    state_path = _ingest_state_path(repo_name)
+    os.makedirs(os.path.dirname(state_path), exist_ok=True)
+    with open(state_path, "w") as f:
+        json.dump({"status": status, "commit": commit, "updated_at": time.time()}, f)
+
+
+def _finish_ingest(repo_name: str, commit: str):
+    """Tags the stored points with the ingested commit and marks the ingest done"""
+    vector_store_instance().tag_commit(repo_name, commit)
+    _write_ingest_state(repo_name, "done", commit)
+
+
+def _load_points(repo_name: str, batches: Iterable[List[Point]], commit: str) -> int:
+    """
+    Bulk loads stored points (vectors included, nothing is embedded) into the collection
+    of the repo and rebuilds its lexical index. A failed load deletes what it stored.
+    """
+    vector_store = vector_store_instance()
+    _write_ingest_state(repo_name, "running", commit)
+    vector_store.ensure_collection(repo_name)
+    lexical_builder = None
+    if config_instance().get("Lexical", {}).get("enabled", False):
+        lexical_builder = LexicalIndexBuilder()
+    ingest_config = config_instance().get("Ingest", {})
+    upserter = _ParallelUpserter(
+        repo_name,
+        concurrency=ingest_config.get("upsert_concurrency", 4),
+        max_retries=ingest_config.get("upsert_retries", 3),
     )
+    count = 0
+    try:
+        for points in batches:
+            upserter.submit(points)
+            if lexical_builder is not None:
+                for point_id, _, payload in points:
+                    lexical_builder.add(
+                        point_id,
+                        payload["metadata"].get("file_level_metadata", {}).get("path"),
+                        payload["page_content"],
+                    )
+            count += len(points)
+        upserter.close()
+    except Exception:
+        # a partial collection is of no use
+        vector_store.delete_collection(repo_name)
+        raise
+    finally:
+        upserter.executor.shutdown(wait=False, cancel_futures=True)
+    if lexical_builder is not None:
+        _save_lexical_index(repo_name, lexical_builder)
+    if os.path.exists(symbol_index_path(repo_name)):
+        # the files are not in the points, the next refresh rebuilds it from a checkout
+        os.remove(symbol_index_path(repo_name))
+    _invalidate_cached_answers(repo_name)
+    _finish_ingest(repo_name, commit)
+    return count
 
 
-def _preprocess_data(repo: Repo) -> List[RepoFile]:
-    repo_files = _filter_text_files(repo)
+def _preprocess_data(
+    repo: Repo, only_paths: set = None, triage_stats: dict = None
+) -> Iterator[RepoFile]:
+    repo_files = _filter_text_files(
+        repo, only_paths=only_paths, triage_stats=triage_stats
+    )
     repo_files = _clean_scripts(repo_files=repo_files)
     return repo_files
 
 
+def _invalidate_cached_answers(repo_name: str):
+    answer_cache = answer_cache_instance()
+    if answer_cache is not None:
+        answer_cache.invalidate(repo_name)
+
+
 def ingest_repo(
-    repo_url: str, prog_language: str = "PYTHON", insert_custom_embeddings: bool = False
+    repo_url: str,
+    insert_custom_embeddings: bool = False,
+    on_stage: Callable[[str], None] = None,
+    refresh: bool = False,
+    stats: dict = None,
+    ref: str = None,
 ) -> bool:
-    repo_dir = repo_url.split("/")[-1].split(".")[0]
+    """
+    Ingests the repo at `ref` (the configured ref or the remote HEAD by default) into the
+    vector store.
+    With refresh, an already ingested repo is fetched again and only the files whose
+    blob SHA changed are re-embedded; points of modified and removed files are deleted.
+    """
+    # on_stage is notified with the name of each stage as it starts (used for job progress)
+    on_stage = on_stage or (lambda stage: None)
+    # filled with the ingestion statistics as they are collected
+    stats = stats if stats is not None else {}
+    repo_dir = repo_collection_name(repo_url)
     if not _is_valid_url(repo_url):
         raise Exception("Invalid repo URL!")
-    elif _is_collection_exists(repo_dir):
+    collection_exists = _is_collection_exists(repo_dir)
+    # an ingest that did not complete (failure, restart) is resumed
+    resume = collection_exists and _read_ingest_state(repo_dir)["status"] != "done"
+    if collection_exists and not refresh and not resume:
         return True
+    lexical_builder = None
+    if config_instance().get("Lexical", {}).get("enabled", False):
+        lexical_builder = LexicalIndexBuilder()
+    symbol_builder = None
+    if config_instance().get("Symbols", {}).get("enabled", False):
+        symbol_builder = SymbolIndexBuilder()
+    # paths whose chunks are replaced in the stored lexical index, None rebuilds it
+    lexical_drop_paths = None
     try:
-        repo: Repo = _download_repo(repo_url)
-        repo_files: List[RepoFile] = _preprocess_data(repo)
-        repo_files: List[RepoFile] = _update_file_level_metadata(repo_files)
-        repo_files: List[RepoFile] = _chunk_repo_files(repo_files, prog_language)
-        repo_files: List[RepoFile] = _update_chunk_level_metadata(repo_files)
-        status_flag = _store_chunks(repo_files, insert_custom_embeddings)
+        on_stage("download")
+        repo: Repo = _download_repo(repo_url, ref=ref)
+        _write_ingest_state(repo_dir, "running", repo.head.commit.hexsha)
+        only_paths = None
+        if collection_exists:
+            on_stage("diff")
+            changed, removed = _diff_blob_shas(
+                _get_stored_blob_shas(repo_dir), _get_tree_blob_shas(repo)
+            )
+            print(f"Files changed: {len(changed)}, removed: {len(removed)}")
+            _delete_file_points(repo_dir, changed | removed)
+            if changed or removed:
+                _invalidate_cached_answers(repo_dir)
+            if not resume:
+                lexical_drop_paths = changed | removed
+            if not changed and not resume:
+                if lexical_builder is not None and (
+                    removed or lexical_index_instance(repo_dir) is None
+                ):
+                    _save_lexical_index(repo_dir, lexical_builder, lexical_drop_paths)
+                if symbol_builder is not None and (
+                    removed or symbol_index_instance(repo_dir) is None
+                ):
+                    _save_symbol_index(repo_dir, symbol_builder, removed, repo)
+                _finish_ingest(repo_dir, repo.head.commit.hexsha)
+                _remove_old_checkouts(repo)
+                return True
+            # when resuming every file is processed, its stored chunks are skipped
+            only_paths = None if resume else changed
+        # files stream lazily through decode -> clean -> chunk -> embed -> upsert
+        on_stage("process")
+        repo_files: Iterator[RepoFile] = _preprocess_data(
+            repo, only_paths=only_paths, triage_stats=stats.setdefault("triage", {})
+        )
+        repo_files: Iterator[RepoFile] = _update_file_level_metadata(repo_files)
+        repo_files: Iterator[RepoFile] = _chunk_repo_files(repo_files)
+        repo_files: Iterator[RepoFile] = _update_chunk_level_metadata(repo_files)
+        if lexical_builder is not None:
+            repo_files: Iterator[RepoFile] = _index_chunks_lexically(
+                repo_files, repo_dir, lexical_builder
+            )
+        if symbol_builder is not None:
+            repo_files: Iterator[RepoFile] = _index_symbols(repo_files, symbol_builder)
+        status_flag = _store_chunks(
+            repo_files, repo_dir, insert_custom_embeddings, resume=resume
+        )
+        _invalidate_cached_answers(repo_dir)
+        if status_flag and lexical_builder is not None:
+            on_stage("lexical_index")
+            _save_lexical_index(repo_dir, lexical_builder, lexical_drop_paths)
+        if status_flag and symbol_builder is not None:
+            on_stage("symbol_index")
+            _save_symbol_index(repo_dir, symbol_builder, lexical_drop_paths, repo)
+        if status_flag:
+            _finish_ingest(repo_dir, repo.head.commit.hexsha)
+            # the ingest state points at this commit, older checkouts are of no use
+            _remove_old_checkouts(repo)
         print(f"Status {status_flag}")
     except Exception as e:
         print(e)
@@ -0,0 +1,153 @@
+import hashlib
+import os
+import threading
+from typing import List, Optional
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+
+class EmbeddingCache:
+    """
+    On-disk, content addressed cache of embeddings keyed by hash(model id + text).
+    Vectors live in a memory-mapped matrix, the key and the LRU clock of every slot in
+    two memory-mapped arrays next to it, so lookups and inserts are batched numpy ops.
+    Once `capacity` is reached the least recently used slots are overwritten.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        model_id: str,
+        dim: int = 256,
+        capacity: int = 200000,
+    ):
+        os.makedirs(path, exist_ok=True)
+        self.model_id = model_id
+        self.capacity = capacity
+        self._lock = threading.Lock()
+        self.vectors = self._open(
+            os.path.join(path, "vectors.npy"), np.float32, (capacity, dim)
+        )
+        self.keys = self._open(os.path.join(path, "keys.npy"), "S32", (capacity,))
+        self.last_used = self._open(
+            os.path.join(path, "last_used.npy"), np.int64, (capacity,)
+        )
+        occupied = np.flatnonzero(self.keys != b"")
+        self.slots = {self.keys[slot].decode(): int(slot) for slot in occupied}
+        self.free_slots = np.flatnonzero(self.keys == b"").tolist()[::-1]
+        self.clock = int(self.last_used.max()) if capacity else 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _open(file_path: str, dtype, shape: tuple) -> np.memmap:
+        if os.path.exists(file_path):
+            array = np.lib.format.open_memmap(file_path, mode="r+")
+            if array.shape == shape and array.dtype == np.dtype(dtype):
+                return array
+            # config changed (dim/capacity), start over
+            del array
+        return np.lib.format.open_memmap(file_path, mode="w+", dtype=dtype, shape=shape)
+
+    def _key(self, text: str) -> str:
+        return hashlib.blake2b(
+            f"{self.model_id}\0{text}".encode("utf-8"), digest_size=16
+        ).hexdigest()
+
+    def get_many(self, texts: List[str]) -> List[Optional[List[float]]]:
+        """Returns the cached embedding of each text, None for misses"""
+        keys = [self._key(text) for text in texts]
+        with self._lock:
+            slots = [self.slots.get(key) for key in keys]
+            hit_slots = [slot for slot in slots if slot is not None]
+            self.hits += len(hit_slots)
+            self.misses += len(slots) - len(hit_slots)
+            if not hit_slots:
+                return [None] * len(texts)
+            self.clock += 1
+            self.last_used[hit_slots] = self.clock
+            hit_vectors = iter(self.vectors[hit_slots].tolist())
+        return [None if slot is None else next(hit_vectors) for slot in slots]
+
+    def _take_slots(self, count: int) -> List[int]:
+        """Returns `count` slots to write to, evicting the least recently used if needed"""
+        num_evict = count - len(self.free_slots)
+        if num_evict > 0:
+            occupied = np.fromiter(self.slots.values(), dtype=np.int64)
+            lru = occupied[
+                np.argpartition(self.last_used[occupied], num_evict - 1)[:num_evict]
+            ]
+            for slot in lru.tolist():
+                del self.slots[self.keys[slot].decode()]
+                self.keys[slot] = b""
+                self.free_slots.append(slot)
+            self.evictions += num_evict
+        return [self.free_slots.pop() for _ in range(count)]
+
+    def put_many(self, texts: List[str], vectors: List[List[float]]):
+        new_entries = {}
+        for text, vector in zip(texts, vectors):
+            new_entries.setdefault(self._key(text), vector)
+        with self._lock:
+            new_entries = {
+                key: vector
+                for key, vector in new_entries.items()
+                if key not in self.slots
+            }
+            if not new_entries or not self.capacity:
+                return
+            # more new entries than the whole cache can hold, keep the last ones
+            keys = list(new_entries)[-self.capacity :]
+            slots = self._take_slots(len(keys))
+            self.clock += 1
+            self.vectors[slots] = np.asarray(
+                [new_entries[key] for key in keys], dtype=np.float32
+            )
+            self.keys[slots] = keys
+            self.last_used[slots] = self.clock
+            self.slots.update(zip(keys, slots))
+            self.vectors.flush()
+            self.keys.flush()
+            self.last_used.flush()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "size": len(self.slots),
+            "capacity": self.capacity,
+        }
+
+
+class CachedEmbeddings(Embeddings):
+    """Wraps an embeddings model so that only cache misses reach the model"""
+
+    def __init__(self, embeddings: Embeddings, cache: EmbeddingCache) -> None:
+        self.embeddings = embeddings
+        self.cache = cache
+        super().__init__()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        embeddings = self.cache.get_many(texts)
+        misses = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        if misses:
+            # identical texts (eg: license headers) are embedded once
+            missed_texts = list(dict.fromkeys(texts[i] for i in misses))
+            missed_embeddings = self.embeddings.embed_documents(missed_texts)
+            self.cache.put_many(missed_texts, missed_embeddings)
+            by_text = dict(zip(missed_texts, missed_embeddings))
+            for i in misses:
+                embeddings[i] = by_text[texts[i]]
+        return embeddings
+
+    def embed_query(self, query: str) -> List[float]:
+        embedding = self.cache.get_many([query])[0]
+        if embedding is None:
+            embedding = self.embeddings.embed_query(query)
+            self.cache.put_many([query], [embedding])
+        return embedding
@@ -1,27 +1,238 @@
+from __future__ import annotations
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Dict, Optional, Tuple
+import os
+import threading
+import time
+
 import toml
 
-from qdrant_client import QdrantClient
-from langchain.chat_models import ChatOpenAI
-from langchain_core.language_models.chat_models import BaseChatModel
+from qdrant_client import QdrantClient, AsyncQdrantClient
+from langchain_core.embeddings import Embeddings
 
+from utils import metrics
 from utils.custom_classes import CodeT5PlusEmbeddings
+from utils.embedding_cache import EmbeddingCache, CachedEmbeddings
+from utils.answer_cache import AnswerCache
+from utils.batching import EmbeddingBatcher
+from utils.lexical_index import LexicalIndex
+from utils.symbol_index import SymbolIndex
+from utils.vector_stores import VectorStore, QdrantVectorStore, LocalVectorStore
+
+if TYPE_CHECKING:
+    # imported lazily at runtime, they are slow to import
+    from langchain_core.language_models.chat_models import BaseChatModel
+    from langchain_core.runnables import Runnable
 
-qdrant_client = None
+vector_store = None
+inference_executor = None
+embedding_batcher = None
+rag_chain = None
+# collection name -> (mtime of the file, lexical index), reloaded when re-ingested
+lexical_indexes: Dict[str, Tuple[float, LexicalIndex]] = {}
+lexical_indexes_lock = threading.Lock()
+# collection name -> (mtime of the file, symbol index)
+symbol_indexes: Dict[str, Tuple[float, SymbolIndex]] = {}
+symbol_indexes_lock = threading.Lock()
 code_embeddings_model = None
+embedding_cache = None
+answer_cache = None
 llm = None
 config = None
 prompt_config = None
+# not_loaded -> loading -> ready | failed
+model_status = "not_loaded"
+model_error = None
+# seconds spent in each step of the startup, see startup_stats
+startup_timings: Dict[str, float] = {}
 
+_WARMUP_TEXT = """def embed_documents(self, texts):
+    # warmup input, the lengths vary so the first batches allocate every shape
+    return [self.embed_query(text) for text in texts]
+"""
 
-async def initialize():
-    global qdrant_client, code_embeddings_model, config, llm, prompt_config
-    code_embeddings_model = CodeT5PlusEmbeddings()
+
+async def initialize(
+    config_overrides: Dict[str, dict] = None,
+    embeddings: Embeddings = None,
+    chat_model: BaseChatModel = None,
+    background_load: bool = None,
+):
+    """
+    Loads the config (`config_overrides` are merged into its sections) and builds the
+    clients and models. `embeddings` and `chat_model` replace the configured ones, eg: with
+    stand-ins for the benchmarks.
+    With background_load (`Startup.background_load` by default) the models are loaded
+    and warmed up in a thread and this returns right away, see `is_model_ready`.
+    """
+    global vector_store, answer_cache, inference_executor
+    global embedding_batcher, config, prompt_config
+    started = time.perf_counter()
     config = toml.load("configs/properties.toml")
-    qdrant_client = QdrantClient(
-        url=config.get("VectorStore").get("url"), prefer_grpc=True
+    for section, values in (config_overrides or {}).items():
+        config.setdefault(section, {}).update(values)
+    answer_cache_config = dict(config.get("AnswerCache", {}))
+    if answer_cache_config.pop("enabled", False):
+        answer_cache = AnswerCache(**answer_cache_config)
+    # model inference of the query path runs here, off the event loop
+    query_config = config.get("Query", {})
+    inference_executor = ThreadPoolExecutor(
+        max_workers=query_config.get("inference_workers", 4),
+        thread_name_prefix="inference",
+    )
+    vector_store = _build_vector_store()
+    # concurrent query embeddings are grouped into one forward pass
+    embedding_batcher = EmbeddingBatcher(
+        # resolved per batch, the model may still be loading at this point
+        lambda texts: code_embeddings_model.embed_documents(texts),
+        executor=inference_executor,
+        max_batch_size=query_config.get("max_batch_size", 32),
+        max_wait_ms=query_config.get("batch_window_ms", 5),
+        max_concurrent_batches=query_config.get("inference_workers", 4),
     )
-    llm = ChatOpenAI(model_name=config.get("LLM").get("model_name"))
     prompt_config = toml.load("configs/prompts.toml")
+    record_startup_timing("initialize", time.perf_counter() - started)
+    if background_load is None:
+        background_load = config.get("Startup", {}).get("background_load", False)
+    if background_load:
+        threading.Thread(
+            target=_load_models,
+            args=(embeddings, chat_model, started),
+            name="model-loader",
+            daemon=True,
+        ).start()
+    else:
+        _load_models(embeddings, chat_model, started)
+        if model_status != "ready":
+            raise Exception(f"Loading the models failed: {model_error}")
+
+
+def _build_vector_store() -> VectorStore:
+    vector_store_config = config.get("VectorStore")
+    tenancy_config = config.get("Tenancy", {})
+    if vector_store_config.get("backend", "qdrant") == "local":
+        if tenancy_config.get("shared_collections", 0):
+            raise Exception("Shared collections are only supported by Qdrant")
+        return LocalVectorStore(
+            executor=inference_executor, **config.get("LocalVectorStore", {})
+        )
+    if vector_store_config.get("url") == ":memory:":
+        # in-process Qdrant: its storage cannot be shared with an async client, the
+        # sync client is used from threads instead
+        client = QdrantClient(location=":memory:")
+        async_client = None
+    else:
+        client = QdrantClient(url=vector_store_config.get("url"), prefer_grpc=True)
+        async_client = AsyncQdrantClient(
+            url=vector_store_config.get("url"), prefer_grpc=True
+        )
+    return QdrantVectorStore(
+        client,
+        async_client,
+        vector_name=vector_store_config.get("vector_col_name"),
+        collection_config=config.get("Collection", {}),
+        executor=inference_executor,
+        shared_collections=tenancy_config.get("shared_collections", 0),
+        shared_prefix=tenancy_config.get("collection_prefix", "repos"),
+    )
+
+
+def record_startup_timing(step: str, seconds: float):
+    """Seconds spent in a startup step, served in startup_stats and the metrics"""
+    startup_timings[step] = round(seconds, 3)
+    metrics.STAGE_SECONDS.observe(seconds, pipeline="startup", stage=step)
+
+
+def _warmup(embeddings: Embeddings):
+    """First forward passes pay for allocations and lazy init, not the first queries"""
+    batch_size = config.get("Startup", {}).get("warmup_batch_size", 8)
+    embeddings.embed_documents([_WARMUP_TEXT * (i + 1) for i in range(batch_size)])
+    embeddings.embed_query("What does embed_documents do?")
+
+
+def _load_models(embeddings: Embeddings, chat_model: BaseChatModel, started: float):
+    """Loads and warms up the embedding model, then builds the LLM and the RAG chain"""
+    global code_embeddings_model, embedding_cache, llm, rag_chain
+    global model_status, model_error
+    model_status = "loading"
+    try:
+        step_started = time.perf_counter()
+        model = embeddings or CodeT5PlusEmbeddings(**config.get("Embeddings", {}))
+        record_startup_timing("model_load", time.perf_counter() - step_started)
+        if config.get("Startup", {}).get("warmup", True):
+            step_started = time.perf_counter()
+            # before the cache wraps it, cached warmup texts would skip the model
+            _warmup(model)
+            record_startup_timing("warmup", time.perf_counter() - step_started)
+        cache_config = config.get("EmbeddingCache", {})
+        if cache_config.get("enabled", False):
+            # vectors of different backends (eg: int8) are not interchangeable
+            backend = getattr(model, "backend", type(model).__name__)
+            embedding_cache = EmbeddingCache(
+                path=cache_config.get("path"),
+                model_id=f"{backend}:{config.get('Embeddings').get('model_path')}",
+                dim=cache_config.get("dim", 256),
+                capacity=cache_config.get("capacity", 200000),
+            )
+            model = CachedEmbeddings(model, embedding_cache)
+        code_embeddings_model = model
+        if chat_model is None:
+            from langchain.chat_models import ChatOpenAI
+
+            chat_model = ChatOpenAI(model_name=config.get("LLM").get("model_name"))
+        llm = chat_model
+        rag_chain = _build_rag_chain()
+    except Exception as e:
+        print(f"Loading the models failed: {e}")
+        model_error = str(e)
+        model_status = "failed"
+        return
+    model_status = "ready"
+    record_startup_timing("time_to_ready", time.perf_counter() - started)
+    print(f"Models ready in {startup_timings['time_to_ready']}s")
+
+
+def is_model_ready() -> bool:
+    return model_status == "ready"
+
+
+def check_vector_store() -> Optional[str]:
+    """None if the vector store answers, the error otherwise"""
+    try:
+        vector_store.ping()
+    except Exception as e:
+        return str(e)
+    return None
+
+
+def startup_stats() -> dict:
+    return {
+        "model_status": model_status,
+        "model_error": model_error,
+        "timings": dict(startup_timings),
+    }
+
+
+async def close():
+    if embedding_batcher is not None:
+        await embedding_batcher.stop()
+    if vector_store is not None:
+        await vector_store.aclose()
+    if inference_executor is not None:
+        inference_executor.shutdown(wait=False)
+
+
+def _build_rag_chain() -> Runnable:
+    from langchain.chains.combine_documents import create_stuff_documents_chain
+    from langchain.prompts import ChatPromptTemplate
+    from langchain.schema.output_parser import StrOutputParser
+
+    messages = prompt_config.get("RAG").get("CHAT")
+    prompt = ChatPromptTemplate.from_messages(
+        [(role, content) for msg in messages for role, content in msg.items()]
+    )
+    return create_stuff_documents_chain(llm, prompt) | StrOutputParser()
 
 
 def prompts() -> dict:
@@ -32,13 +243,89 @@ def llm_instance() -> BaseChatModel:
     return llm
 
 
-def qdrant_client_instance() -> QdrantClient:
-    return qdrant_client
+def vector_store_instance() -> VectorStore:
+    return vector_store
+
+
+def inference_executor_instance() -> ThreadPoolExecutor:
+    return inference_executor
+
+
+def embedding_batcher_instance() -> EmbeddingBatcher:
+    return embedding_batcher
+
+
+def rag_chain_instance() -> Runnable:
+    return rag_chain
+
+
+def lexical_index_path(collection_name: str) -> str:
+    lexical_config = config.get("Lexical", {})
+    return os.path.join(
+        lexical_config.get("path", "cache/lexical"), f"{collection_name}.npz"
+    )
+
+
+def lexical_index_instance(collection_name: str) -> Optional[LexicalIndex]:
+    """The lexical index of the collection, None if disabled or not built"""
+    lexical_config = config.get("Lexical", {})
+    if not lexical_config.get("enabled", False):
+        return None
+    path = lexical_index_path(collection_name)
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return None
+    with lexical_indexes_lock:
+        cached = lexical_indexes.get(collection_name)
+        if cached is None or cached[0] != mtime:
+            cached = (
+                mtime,
+                LexicalIndex.load(
+                    path,
+                    k1=lexical_config.get("k1", 1.2),
+                    b=lexical_config.get("b", 0.75),
+                ),
+            )
+            lexical_indexes[collection_name] = cached
+    return cached[1]
+
+
+def symbol_index_path(collection_name: str) -> str:
+    symbols_config = config.get("Symbols", {})
+    return os.path.join(
+        symbols_config.get("path", "cache/symbols"), f"{collection_name}.npz"
+    )
+
+
+def symbol_index_instance(collection_name: str) -> Optional[SymbolIndex]:
+    """The symbol index of the collection, None if disabled or not built"""
+    if not config.get("Symbols", {}).get("enabled", False):
+        return None
+    path = symbol_index_path(collection_name)
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return None
+    with symbol_indexes_lock:
+        cached = symbol_indexes.get(collection_name)
+        if cached is None or cached[0] != mtime:
+            cached = (mtime, SymbolIndex.load(path))
+            symbol_indexes[collection_name] = cached
+    return cached[1]
 
 
 def config_instance() -> dict:
     return config
 
 
-def embeddings_model_instance() -> CodeT5PlusEmbeddings:
+def embeddings_model_instance() -> Embeddings:
     return code_embeddings_model
+
+
+def embedding_cache_instance() -> EmbeddingCache:
+    return embedding_cache
+
+
+def answer_cache_instance() -> AnswerCache:
+    return answer_cache
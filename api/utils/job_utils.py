@@ -0,0 +1,212 @@
+import copy
+import functools
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, Optional
+
+from utils import chunking, metrics
+from utils.data_utils import ingest_repo
+from utils.injectors import config_instance
+from utils.vector_utils import repo_collection_name
+
+
+class QueueFullError(Exception):
+    """Raised when the ingestion queue has no free slots left"""
+
+
+class JobConflictError(Exception):
+    """Raised when the repo is already being ingested at another ref"""
+
+    def __init__(self, message: str, job: "IngestJob"):
+        super().__init__(message)
+        self.job = job
+
+
+class IngestJob:
+    """To track the state, stage progress and timings of a single ingestion"""
+
+    def __init__(
+        self,
+        repo_url: str,
+        insert_custom_embeddings: bool = False,
+        refresh: bool = False,
+        ref: Optional[str] = None,
+    ):
+        self.job_id = uuid.uuid4().hex
+        self.repo_url = repo_url
+        self.ref = ref
+        self.insert_custom_embeddings = insert_custom_embeddings
+        self.refresh = refresh
+        self.status = "queued"
+        self.error = None
+        self.stages = []
+        self.stats = {}
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            self.status = "running"
+            self.started_at = time.time()
+
+    def start_stage(self, name: str):
+        """Closes the running stage (if any) and opens a new one"""
+        with self._lock:
+            now = time.time()
+            self._close_stage(now)
+            self.stages.append({"name": name, "started_at": now, "duration": None})
+
+    def finish(self, status: str, error: Optional[str] = None):
+        with self._lock:
+            now = time.time()
+            self._close_stage(now)
+            self.status = status
+            self.error = error
+            self.finished_at = now
+        metrics.INGEST_JOBS.inc(status=status)
+
+    def is_active(self) -> bool:
+        return self.status in ("queued", "running")
+
+    def _close_stage(self, now: float):
+        if self.stages and self.stages[-1]["duration"] is None:
+            stage = self.stages[-1]
+            stage["duration"] = round(now - stage["started_at"], 3)
+            metrics.STAGE_SECONDS.observe(
+                now - stage["started_at"], pipeline="ingest", stage=stage["name"]
+            )
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            end = self.finished_at or time.time()
+            return {
+                "job_id": self.job_id,
+                "repo_url": self.repo_url,
+                "ref": self.ref,
+                "refresh": self.refresh,
+                "status": self.status,
+                "error": self.error,
+                "current_stage": self.stages[-1]["name"] if self.stages else None,
+                "stages": [dict(stage) for stage in self.stages],
+                "stats": copy.deepcopy(self.stats),
+                "queued_for": round((self.started_at or end) - self.created_at, 3),
+                "elapsed": round(end - self.started_at, 3) if self.started_at else 0,
+            }
+
+
+_executor: ThreadPoolExecutor = None
+_jobs: Dict[str, IngestJob] = OrderedDict()
+_active_jobs_by_key: Dict[str, str] = {}
+_lock = threading.Lock()
+
+
+def _ingest_config() -> dict:
+    return (config_instance() or {}).get("Ingest", {})
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=_ingest_config().get("max_workers", 2),
+            thread_name_prefix="ingest",
+        )
+    return _executor
+
+
+def _job_key(repo_url: str) -> str:
+    # the collection (and its indexes and ingest state) written by the ingestion
+    return repo_collection_name(repo_url.strip())
+
+
+def _evict_finished_jobs():
+    """Keeps only the most recent finished jobs around for status lookups"""
+    max_finished = _ingest_config().get("max_finished_jobs", 100)
+    finished = [job_id for job_id, job in _jobs.items() if not job.is_active()]
+    for job_id in finished[: max(0, len(finished) - max_finished)]:
+        del _jobs[job_id]
+
+
+def _run_job(job: IngestJob):
+    job.start()
+    error = None
+    try:
+        status_flag = ingest_repo(
+            repo_url=job.repo_url,
+            insert_custom_embeddings=job.insert_custom_embeddings,
+            on_stage=job.start_stage,
+            refresh=job.refresh,
+            stats=job.stats,
+            ref=job.ref,
+        )
+    except Exception as e:
+        print(e)
+        status_flag, error = False, str(e)
+    # released first: once the job reads as finished, another ref can be submitted
+    with _lock:
+        _active_jobs_by_key.pop(_job_key(job.repo_url), None)
+    job.finish("done" if status_flag else "failed", error=error)
+
+
+def _on_job_done(job: IngestJob, future: Future):
+    # jobs still queued at shutdown never run
+    if future.cancelled():
+        with _lock:
+            _active_jobs_by_key.pop(_job_key(job.repo_url), None)
+        job.finish("cancelled", error="The server shut down before the job started")
+
+
+def submit_ingest_job(
+    repo_url: str,
+    insert_custom_embeddings: bool = False,
+    refresh: bool = False,
+    ref: Optional[str] = None,
+) -> IngestJob:
+    """
+    Enqueues an ingestion in the worker pool and returns its job.
+    Requests for a repo that is already queued or being ingested share the same job, one
+    ingestion at a time writes a collection: a request for another ref is rejected.
+    """
+    key = _job_key(repo_url)
+    with _lock:
+        active_job_id = _active_jobs_by_key.get(key)
+        if active_job_id is not None:
+            active_job = _jobs[active_job_id]
+            if (active_job.ref or None) != (ref or None):
+                raise JobConflictError(
+                    f"{key} is already being ingested at {active_job.ref or 'HEAD'}",
+                    active_job,
+                )
+            return active_job
+        pending = sum(1 for job in _jobs.values() if job.is_active())
+        if pending >= _ingest_config().get("max_pending", 16):
+            raise QueueFullError("Ingestion queue is full, please retry later")
+        job = IngestJob(
+            repo_url,
+            insert_custom_embeddings=insert_custom_embeddings,
+            refresh=refresh,
+            ref=ref,
+        )
+        _jobs[job.job_id] = job
+        _active_jobs_by_key[key] = job.job_id
+        _evict_finished_jobs()
+    future = _get_executor().submit(_run_job, job)
+    future.add_done_callback(functools.partial(_on_job_done, job))
+    return job
+
+
+def get_job(job_id: str) -> Optional[IngestJob]:
+    return _jobs.get(job_id)
+
+
+def shutdown():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+    chunking.shutdown()
@@ -0,0 +1,195 @@
+"""
+Identifier-aware BM25 index over the chunks of a repo, persisted per repo as a compressed npz.
+Identifiers are indexed whole and split into their snake_case/camelCase parts, so both
+`_batch_insert` and "batch insert" match the chunks that mention `_batch_insert`.
+"""
+import math
+import os
+import re
+from array import array
+from collections import Counter
+from typing import Iterable, List, Tuple
+
+import numpy as np
+
+_TOKEN = re.compile(r"[A-Za-z_][A-Za-z0-9_]*|\d+")
+_CAMEL_CASE_PART = re.compile(r"[A-Z]+(?![a-z])|[A-Z]?[a-z]+|\d+")
+# longer tokens (eg: base64 blobs, hashes) are not worth indexing
+_MAX_TOKEN_LENGTH = 64
+_STOPWORDS = frozenset(
+    """a an and are as at be by can do does for from how i if in is it its of on or so that
+    the this to was what when where which who why will with""".split()
+)
+
+
+def tokenize(text: str) -> List[str]:
+    tokens = []
+    for identifier in _TOKEN.findall(text):
+        if len(identifier) > _MAX_TOKEN_LENGTH:
+            continue
+        parts = [
+            part.lower()
+            for word in identifier.split("_")
+            for part in _CAMEL_CASE_PART.findall(word)
+        ]
+        lowered = identifier.lower()
+        if len(lowered) > 1 and lowered not in _STOPWORDS:
+            tokens.append(lowered)
+        if len(parts) > 1:
+            tokens.extend(
+                part for part in parts if len(part) > 1 and part not in _STOPWORDS
+            )
+    return tokens
+
+
+class LexicalIndex:
+    """
+    Inverted index in CSR form: the postings of term t are
+    `postings_docs[indptr[t]:indptr[t + 1]]` with their term frequencies in `postings_tfs`.
+    Documents are identified by the id of their point in the vector store.
+    """
+
+    def __init__(
+        self,
+        terms: np.ndarray,
+        indptr: np.ndarray,
+        postings_docs: np.ndarray,
+        postings_tfs: np.ndarray,
+        doc_ids: np.ndarray,
+        paths: np.ndarray,
+        doc_lengths: np.ndarray,
+        k1: float = 1.2,
+        b: float = 0.75,
+    ):
+        self.terms = terms
+        self.indptr = indptr
+        self.postings_docs = postings_docs
+        self.postings_tfs = postings_tfs
+        self.doc_ids = doc_ids
+        self.paths = paths
+        self.doc_lengths = doc_lengths
+        self.k1 = k1
+        self.b = b
+        self.term_ids = {term: i for i, term in enumerate(terms.tolist())}
+        avg_doc_length = float(doc_lengths.mean()) if len(doc_lengths) else 0.0
+        # document length normalisation of BM25, the same for every query
+        self.length_norm = k1 * (1 - b + b * doc_lengths / max(avg_doc_length, 1e-9))
+
+    def __len__(self) -> int:
+        return len(self.doc_ids)
+
+    def search(self, query: str, k: int = 10) -> List[Tuple[str, float]]:
+        """Top-k (doc id, BM25 score) of the documents that share a term with the query"""
+        if not len(self.doc_ids):
+            return []
+        scores = np.zeros(len(self.doc_ids), dtype=np.float32)
+        for term in set(tokenize(query)):
+            term_id = self.term_ids.get(term)
+            if term_id is None:
+                continue
+            start, end = self.indptr[term_id], self.indptr[term_id + 1]
+            docs = self.postings_docs[start:end]
+            tfs = self.postings_tfs[start:end].astype(np.float32)
+            num_docs = len(self.doc_ids)
+            idf = math.log(1 + (num_docs - len(docs) + 0.5) / (len(docs) + 0.5))
+            scores[docs] += idf * tfs * (self.k1 + 1) / (tfs + self.length_norm[docs])
+        matched = np.flatnonzero(scores)
+        if len(matched) > k:
+            matched = matched[np.argpartition(-scores[matched], k - 1)[:k]]
+        matched = matched[np.argsort(-scores[matched], kind="stable")]
+        return [(str(self.doc_ids[i]), float(scores[i])) for i in matched]
+
+    def save(self, path: str):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_path = f"{path}.tmp.npz"
+        np.savez_compressed(
+            tmp_path,
+            terms=self.terms,
+            indptr=self.indptr,
+            postings_docs=self.postings_docs,
+            postings_tfs=self.postings_tfs,
+            doc_ids=self.doc_ids,
+            paths=self.paths,
+            doc_lengths=self.doc_lengths,
+        )
+        # readers never see a partially written index
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str, k1: float = 1.2, b: float = 0.75) -> "LexicalIndex":
+        with np.load(path) as data:
+            return cls(**{name: data[name] for name in data.files}, k1=k1, b=b)
+
+
+class LexicalIndexBuilder:
+    """Accumulates documents (optionally on top of an existing index) and builds the CSR index"""
+
+    def __init__(self):
+        self.doc_ids = []
+        self.paths = []
+        self.doc_lengths = array("I")
+        self.term_ids = {}
+        # postings in COO form, sorted by term in `build`
+        self.coo_terms = array("I")
+        self.coo_docs = array("I")
+        self.coo_tfs = array("I")
+
+    def _add_counts(self, doc_id: str, path: str, counts: Iterable[Tuple[str, int]]):
+        doc = len(self.doc_ids)
+        self.doc_ids.append(doc_id)
+        self.paths.append(path)
+        doc_length = 0
+        for term, tf in counts:
+            self.coo_terms.append(self.term_ids.setdefault(term, len(self.term_ids)))
+            self.coo_docs.append(doc)
+            self.coo_tfs.append(tf)
+            doc_length += tf
+        self.doc_lengths.append(doc_length)
+
+    def add(self, doc_id: str, path: str, text: str):
+        self._add_counts(doc_id, path, Counter(tokenize(text)).items())
+
+    def add_index(self, index: LexicalIndex, drop_paths: Iterable[str] = ()):
+        """Copies the documents of `index`, except the ones of `drop_paths`"""
+        keep = ~np.isin(index.paths, list(drop_paths))
+        # term of every posting, in the CSR order of the index
+        posting_terms = np.repeat(
+            np.arange(len(index.terms)), np.diff(index.indptr).astype(np.int64)
+        )
+        order = np.argsort(index.postings_docs, kind="stable")
+        doc_starts = np.searchsorted(
+            index.postings_docs[order], np.arange(len(index.doc_ids) + 1)
+        )
+        terms = index.terms.tolist()
+        for doc in np.flatnonzero(keep):
+            postings = order[doc_starts[doc] : doc_starts[doc + 1]]
+            self._add_counts(
+                str(index.doc_ids[doc]),
+                str(index.paths[doc]),
+                (
+                    (terms[term], int(tf))
+                    for term, tf in zip(
+                        posting_terms[postings], index.postings_tfs[postings]
+                    )
+                ),
+            )
+
+    def build(self, k1: float = 1.2, b: float = 0.75) -> LexicalIndex:
+        coo_terms = np.frombuffer(self.coo_terms, dtype=np.uint32)
+        order = np.argsort(coo_terms, kind="stable")
+        indptr = np.zeros(len(self.term_ids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(coo_terms, minlength=len(self.term_ids)), out=indptr[1:])
+        terms = sorted(self.term_ids, key=self.term_ids.get)
+        return LexicalIndex(
+            terms=np.array(terms, dtype=str),
+            indptr=indptr,
+            postings_docs=np.frombuffer(self.coo_docs, dtype=np.uint32)[order],
+            postings_tfs=np.minimum(
+                np.frombuffer(self.coo_tfs, dtype=np.uint32)[order], 65535
+            ).astype(np.uint16),
+            doc_ids=np.array(self.doc_ids, dtype=str),
+            paths=np.array(self.paths, dtype=str),
+            doc_lengths=np.frombuffer(self.doc_lengths, dtype=np.uint32).copy(),
+            k1=k1,
+            b=b,
+        )
@@ -1,17 +1,71 @@
-from typing import List
+import asyncio
+import contextvars
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import AsyncIterator, Dict, List, Optional, Tuple
 
-from langchain_community.vectorstores import Qdrant
-from langchain.chains.combine_documents import create_stuff_documents_chain
-from langchain.prompts import ChatPromptTemplate
-from langchain.schema.output_parser import StrOutputParser
+import numpy as np
+from langchain_core.documents.base import Document
 
 from utils.injectors import (
-    embeddings_model_instance,
-    qdrant_client_instance,
     config_instance,
+    answer_cache_instance,
+    embedding_batcher_instance,
+    inference_executor_instance,
+    lexical_index_instance,
     llm_instance,
-    prompts,
+    rag_chain_instance,
+    symbol_index_instance,
+    vector_store_instance,
 )
+from utils import metrics
+from utils.context_packing import pack_context
+from utils.rerank import mmr_rerank
+from utils.symbol_index import parse_lookup
+from utils.vector_utils import repo_collection_name
+
+# stage -> latencies (seconds) of the last queries
+_retrieval_latencies: Dict[str, deque] = {
+    stage: deque(maxlen=10000)
+    for stage in (
+        "symbols",
+        "embed",
+        "dense",
+        "ann",
+        "rerank",
+        "lexical",
+        "fusion",
+        "packing",
+        "llm",
+    )
+}
+# token counts of the context before/after packing, of the last requests
+_packing_stats: deque = deque(maxlen=10000)
+
+
+@contextmanager
+def _timed(stage: str):
+    started = time.perf_counter()
+    try:
+        with metrics.span("query", stage):
+            yield
+    finally:
+        _retrieval_latencies[stage].append(time.perf_counter() - started)
+
+
+def retrieval_stats() -> dict:
+    """p50/p99 latency (ms) of each retrieval stage"""
+    stats = {}
+    for stage, latencies in _retrieval_latencies.items():
+        if latencies:
+            latencies_ms = np.asarray(latencies, dtype=np.float64) * 1000
+            stats[stage] = {
+                "count": len(latencies_ms),
+                "p50_ms": round(float(np.percentile(latencies_ms, 50)), 3),
+                "p99_ms": round(float(np.percentile(latencies_ms, 99)), 3),
+            }
+    return stats
 
 
 def _add_source_info_to_result(result: str, doc_objs: List):
@@ -26,28 +80,340 @@ def _add_source_info_to_result(result: str, doc_objs: List):
     return result
 
 
-def get_answer(query: str, repo_url: str) -> str:
-    repo_name = repo_url.split(".git")[0].split("/")[-1]
+def _repo_names(repo_url: str, repo_urls: Optional[List[str]]) -> List[str]:
+    """Collection names of the repos a query searches, without duplicates"""
+    repo_names = [repo_collection_name(url) for url in [repo_url, *(repo_urls or [])]]
+    return list(dict.fromkeys(repo_names))
+
+
+def _lookup_cached_answer(repo_names: List[str], query_embedding: List[float]):
+    answer_cache = answer_cache_instance()
+    # answers are cached and invalidated per repo, multi-repo answers are not cached
+    if answer_cache is None or len(repo_names) > 1:
+        return None
+    return answer_cache.lookup(repo_names[0], query_embedding)
+
+
+def _store_answer(repo_names: List[str], query_embedding: List[float], response: str):
+    answer_cache = answer_cache_instance()
+    if answer_cache is not None and len(repo_names) == 1:
+        answer_cache.store(repo_names[0], query_embedding, response)
+
+
+async def _aembed_query(repo_name: str, query: str) -> List[float]:
+    answer_cache = answer_cache_instance()
+    if answer_cache is not None:
+        query_embedding = answer_cache.get_query_embedding(repo_name, query)
+        if query_embedding is not None:
+            return query_embedding
+    # batched with the other in-flight queries, the forward pass runs in the inference pool
+    query_embedding = await embedding_batcher_instance().embed(query)
+    if answer_cache is not None:
+        answer_cache.put_query_embedding(repo_name, query, query_embedding)
+    return query_embedding
+
+
+async def _atwo_stage_search(
+    repo_names: List[str],
+    query_embedding: List[float],
+    k: int,
+    rerank_config: dict,
+) -> List[Tuple[Document, float]]:
+    """
+    oversample * k candidates per repo from the cheap approximate search, reranked by
+    exact cosine and maximal marginal relevance down to k
+    """
+    with _timed("ann"):
+        candidates = await asyncio.gather(
+            *(
+                vector_store_instance().asearch_candidates(
+                    repo_name,
+                    query_embedding,
+                    k * rerank_config.get("oversample", 4),
+                    hnsw_ef=rerank_config.get("candidate_hnsw_ef"),
+                )
+                for repo_name in repo_names
+            )
+        )
+    with _timed("rerank"):
+        docs = [doc for repo_docs, _ in candidates for doc in repo_docs]
+        if not docs:
+            return []
+        selected, scores = mmr_rerank(
+            np.asarray(query_embedding, dtype=np.float32),
+            np.concatenate([vectors for _, vectors in candidates]),
+            k,
+            lambda_mult=rerank_config.get("mmr_lambda", 0.7),
+        )
+    return [(docs[i], float(score)) for i, score in zip(selected, scores)]
+
+
+async def _adense_search(
+    repo_names: List[str], query_embedding: List[float], k: int
+) -> List[Tuple[Document, float]]:
+    rerank_config = config_instance().get("Rerank", {})
+    with _timed("dense"):
+        if rerank_config.get("enabled", False):
+            return await _atwo_stage_search(
+                repo_names, query_embedding, k, rerank_config
+            )
+        return await vector_store_instance().asearch_many(
+            repo_names,
+            query_embedding,
+            k=k,
+            search_type=config_instance().get("VectorStore").get("search_type"),
+        )
+
+
+def _lexical_search(repo_name: str, query: str, k: int) -> List[Tuple[str, float]]:
+    with _timed("lexical"):
+        lexical_index = lexical_index_instance(repo_name)
+        if lexical_index is None:
+            return []
+        return lexical_index.search(query, k=k)
+
+
+def _reciprocal_rank_fusion(
+    rankings: List[List[str]], rrf_k: int = 60
+) -> List[Tuple[str, float]]:
+    """(id, sum(1 / (rrf_k + rank)) over the rankings it appears in), best first"""
+    scores = {}
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking, start=1):
+            scores[doc_id] = scores.get(doc_id, 0.0) + 1 / (rrf_k + rank)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+
+async def _afetch_docs(repo_name: str, ids: List[str]) -> Dict[str, Document]:
+    """Documents of the given point ids (the lexical-only hits)"""
+    if not ids:
+        return {}
+    return await vector_store_instance().aretrieve(repo_name, ids)
+
+
+async def _aretrieve_docs(
+    repo_names: List[str], query: str, query_embedding: List[float]
+) -> Tuple[List[Tuple[Document, float]], bool]:
+    """
+    Dense search of the repos fused with their lexical (BM25) searches by reciprocal
+    rank fusion, dense only when no repo has a lexical index. Docs come with their
+    retrieval score: a cosine similarity, or their fused score when the second value is
+    True.
+    """
     config = config_instance()
-    llm = llm_instance()
-    embedding_model = embeddings_model_instance()
-    qdrant = Qdrant(
-        client=qdrant_client_instance(),
-        collection_name=repo_name,
-        vector_name=config.get("VectorStore").get("vector_col_name"),
-        embeddings=embedding_model,
-    )
-    similar_doc_objects = qdrant.search(
-        query=query,
-        k=config.get("VectorStore").get("top_k"),
-        search_type=config.get("VectorStore").get("search_type"),
-    )
-
-    messages = prompts().get("RAG").get("CHAT")
-    prompt = ChatPromptTemplate.from_messages(
-        [(role, content) for msg in messages for role, content in msg.items()]
-    )
-    chain = create_stuff_documents_chain(llm, prompt) | StrOutputParser()
-    response = chain.invoke({"question": query, "context": similar_doc_objects})
+    top_k = config.get("VectorStore").get("top_k")
+    lexical_config = config.get("Lexical", {})
+    if not lexical_config.get("enabled", False):
+        return await _adense_search(repo_names, query_embedding, top_k), False
+    candidates = max(lexical_config.get("candidates", 20), top_k)
+    loop = asyncio.get_running_loop()
+    # all the searches run concurrently, BM25 in the inference pool
+    dense_docs, *lexical_hits = await asyncio.gather(
+        _adense_search(repo_names, query_embedding, candidates),
+        *(
+            loop.run_in_executor(
+                inference_executor_instance(),
+                # the span of the lexical search belongs to the trace of this request
+                contextvars.copy_context().run,
+                _lexical_search,
+                repo_name,
+                query,
+                candidates,
+            )
+            for repo_name in repo_names
+        ),
+    )
+    if not any(lexical_hits):
+        return dense_docs[:top_k], False
+    with _timed("fusion"):
+        docs_by_id = {str(doc.metadata.get("_id")): doc for doc, _ in dense_docs}
+        fused = _reciprocal_rank_fusion(
+            [
+                list(docs_by_id),
+                *([doc_id for doc_id, _ in hits] for hits in lexical_hits),
+            ],
+            rrf_k=lexical_config.get("rrf_k", 60),
+        )[:top_k]
+        missing = {doc_id for doc_id, _ in fused if doc_id not in docs_by_id}
+        for fetched in await asyncio.gather(
+            *(
+                _afetch_docs(
+                    repo_name, [doc_id for doc_id, _ in hits if doc_id in missing]
+                )
+                for repo_name, hits in zip(repo_names, lexical_hits)
+            )
+        ):
+            docs_by_id.update(fetched)
+    return [
+        (docs_by_id[doc_id], score) for doc_id, score in fused if doc_id in docs_by_id
+    ], True
+
+
+def _pack_context(
+    scored_docs: List[Tuple[Document, float]], fused_scores: bool = False
+) -> List[Document]:
+    """Fits the retrieved chunks into the token budget of the context"""
+    packing_config = config_instance().get("ContextPacking", {})
+    if not packing_config.get("enabled", False):
+        return [doc for doc, _ in scored_docs]
+    with _timed("packing"):
+        docs, stats = pack_context(
+            scored_docs,
+            count_tokens=llm_instance().get_num_tokens,
+            token_budget=packing_config.get("token_budget", 2000),
+            min_relative_score=packing_config.get("min_relative_score", 0.5),
+            duplicate_threshold=packing_config.get("duplicate_threshold", 0.9),
+            fused_scores=fused_scores,
+        )
+    _packing_stats.append(stats)
+    metrics.CONTEXT_TOKENS.inc(stats["tokens_before"], packing="before")
+    metrics.CONTEXT_TOKENS.inc(stats["tokens_after"], packing="after")
+    print(
+        f"Context packed: {stats['chunks_before']} -> {stats['chunks_after']} chunks, "
+        f"{stats['tokens_before']} -> {stats['tokens_after']} tokens"
+    )
+    return docs
+
+
+def context_packing_stats() -> dict:
+    """Prompt tokens saved by the context packing over the last requests"""
+    if not _packing_stats:
+        return {"requests": 0}
+    tokens_before = sum(stats["tokens_before"] for stats in _packing_stats)
+    tokens_after = sum(stats["tokens_after"] for stats in _packing_stats)
+    return {
+        "requests": len(_packing_stats),
+        "tokens_before": tokens_before,
+        "tokens_after": tokens_after,
+        "tokens_saved": tokens_before - tokens_after,
+        "tokens_saved_per_request": round(
+            (tokens_before - tokens_after) / len(_packing_stats), 1
+        ),
+    }
+
+
+def _symbol_lookup(repo_names: List[str], query: str) -> Optional[str]:
+    """
+    Answer of a definition / usage question (eg: "where is X defined", "who calls X")
+    from the symbol indexes of the repos, None for other questions or unknown symbols.
+    """
+    lookup = parse_lookup(query)
+    if lookup is None:
+        return None
+    kind, symbol = lookup
+    with _timed("symbols"):
+        locations = []
+        for repo_name in repo_names:
+            symbol_index = symbol_index_instance(repo_name)
+            if symbol_index is None:
+                continue
+            # the repo is named when several are searched
+            prefix = f"{repo_name}: " if len(repo_names) > 1 else ""
+            if kind == "definition":
+                locations.extend(
+                    (
+                        definition["path"],
+                        f"{prefix}{definition['path']}:{definition['line']}"
+                        f" ({definition['kind']} {definition['qualname']})",
+                    )
+                    for definition in symbol_index.definitions(symbol)
+                )
+            else:
+                locations.extend(
+                    (
+                        reference["path"],
+                        f"{prefix}{reference['path']}:{reference['line']}"
+                        f" in {reference['caller'] or 'module level code'}",
+                    )
+                    for reference in symbol_index.references(symbol)
+                )
+    if not locations:
+        # eg: a symbol of an unsupported language, the RAG chain may still know
+        return None
+    metrics.SYMBOL_LOOKUPS.inc(kind=kind)
+    max_results = config_instance().get("Symbols", {}).get("max_results", 20)
+    header = "is defined in" if kind == "definition" else "is called from"
+    lines = [f"- {location}" for _, location in locations[:max_results]]
+    if len(locations) > max_results:
+        lines.append(f"- ... and {len(locations) - max_results} more")
+    sources = "\n".join(dict.fromkeys(path.split("/")[-1] for path, _ in locations))
+    answer = f"`{symbol}` {header}:\n" + "\n".join(lines)
+    return f"{answer}\n\nReferred Files: {sources}"
+
+
+async def _asymbol_lookup(repo_names: List[str], query: str) -> Optional[str]:
+    if parse_lookup(query) is None:
+        return None
+    # loading an index reads a file, kept off the event loop
+    return await asyncio.get_running_loop().run_in_executor(
+        inference_executor_instance(),
+        contextvars.copy_context().run,
+        _symbol_lookup,
+        repo_names,
+        query,
+    )
+
+
+async def get_answer(
+    query: str, repo_url: str, repo_urls: Optional[List[str]] = None
+) -> str:
+    """Answer from the chunks of the repo, and of the other repo_urls when given"""
+    repo_names = _repo_names(repo_url, repo_urls)
+    # definition / usage questions are answered without any model
+    symbol_answer = await _asymbol_lookup(repo_names, query)
+    if symbol_answer is not None:
+        return symbol_answer
+    with _timed("embed"):
+        query_embedding = await _aembed_query(repo_names[0], query)
+    cached_answer = _lookup_cached_answer(repo_names, query_embedding)
+    metrics.GENERATE_REQUESTS.inc(
+        answer_cache="hit" if cached_answer is not None else "miss"
+    )
+    if cached_answer is not None:
+        return cached_answer
+    scored_docs, fused_scores = await _aretrieve_docs(
+        repo_names, query, query_embedding
+    )
+    similar_doc_objects = _pack_context(scored_docs, fused_scores)
+    with _timed("llm"):
+        response = await rag_chain_instance().ainvoke(
+            {"question": query, "context": similar_doc_objects}
+        )
     response = _add_source_info_to_result(response, similar_doc_objects)
+    _store_answer(repo_names, query_embedding, response)
     return response
+
+
+async def stream_answer(
+    query: str, repo_url: str, repo_urls: Optional[List[str]] = None
+) -> AsyncIterator[str]:
+    """Same as get_answer, but yields the tokens as the LLM produces them, sources last"""
+    repo_names = _repo_names(repo_url, repo_urls)
+    symbol_answer = await _asymbol_lookup(repo_names, query)
+    if symbol_answer is not None:
+        yield symbol_answer
+        return
+    with _timed("embed"):
+        query_embedding = await _aembed_query(repo_names[0], query)
+    cached_answer = _lookup_cached_answer(repo_names, query_embedding)
+    metrics.GENERATE_REQUESTS.inc(
+        answer_cache="hit" if cached_answer is not None else "miss"
+    )
+    if cached_answer is not None:
+        yield cached_answer
+        return
+    scored_docs, fused_scores = await _aretrieve_docs(
+        repo_names, query, query_embedding
+    )
+    similar_doc_objects = _pack_context(scored_docs, fused_scores)
+    tokens = []
+    # until the last token is sent
+    with _timed("llm"):
+        async for token in rag_chain_instance().astream(
+            {"question": query, "context": similar_doc_objects}
+        ):
+            tokens.append(token)
+            yield token
+    sources = _add_source_info_to_result("", similar_doc_objects)
+    yield sources
+    _store_answer(repo_names, query_embedding, "".join(tokens) + sources)
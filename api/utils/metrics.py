@@ -0,0 +1,174 @@
+"""
+Timing spans and counters of the ingest and query pipelines, exported in the Prometheus
+text format at /metrics (no client library needed for this handful of metrics).
+"""
+import contextvars
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple
+
+_DEFAULT_BUCKETS = (
+    0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300
+)  # fmt: skip
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(label_names: Tuple[str, ...], label_values: tuple, **extra) -> str:
+    pairs = list(zip(label_names, label_values)) + list(extra.items())
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+class Counter:
+    def __init__(
+        self, name: str, documentation: str, label_names: Tuple[str, ...] = ()
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self._values: Dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.label_names)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} counter",
+        ]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(
+                    f"{self.name}{_format_labels(self.label_names, key)} {value}"
+                )
+        return lines
+
+
+class Histogram:
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        label_names: Tuple[str, ...] = (),
+        buckets: Tuple[float, ...] = _DEFAULT_BUCKETS,
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self.buckets = buckets
+        # labels -> [count per bucket (+Inf last), sum]
+        self._values: Dict[tuple, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.label_names)
+        with self._lock:
+            bucket_counts, _ = self._values.setdefault(
+                key, [[0] * (len(self.buckets) + 1), 0.0]
+            )
+            bucket_counts[bisect_left(self.buckets, value)] += 1
+            self._values[key][1] += value
+
+    def render(self) -> List[str]:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} histogram",
+        ]
+        with self._lock:
+            for key, (bucket_counts, total) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, count in zip(
+                    [*map(str, self.buckets), "+Inf"], bucket_counts
+                ):
+                    cumulative += count
+                    labels = _format_labels(self.label_names, key, le=bound)
+                    lines.append(f"{self.name}_bucket{labels} {cumulative}")
+                labels = _format_labels(self.label_names, key)
+                lines.append(f"{self.name}_sum{labels} {total}")
+                lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+STAGE_SECONDS = Histogram(
+    "codeqa_stage_duration_seconds",
+    "Wall time of the stages of the ingest and query pipelines",
+    ("pipeline", "stage"),
+)
+INGEST_FILES = Counter(
+    "codeqa_ingest_files_total", "Files seen by the ingest triage", ("reason",)
+)
+INGEST_BYTES = Counter(
+    "codeqa_ingest_bytes_total",
+    "Bytes of the files seen by the ingest triage",
+    ("reason",),
+)
+INGEST_CHUNKS = Counter("codeqa_ingest_chunks_total", "Chunks embedded and upserted")
+INGEST_JOBS = Counter("codeqa_ingest_jobs_total", "Finished ingest jobs", ("status",))
+GENERATE_REQUESTS = Counter(
+    "codeqa_generate_requests_total", "Answered queries", ("answer_cache",)
+)
+CONTEXT_TOKENS = Counter(
+    "codeqa_context_tokens_total",
+    "Tokens of the retrieved context, before and after packing",
+    ("packing",),
+)
+SYMBOL_LOOKUPS = Counter(
+    "codeqa_symbol_lookups_total",
+    "Definition / usage questions answered from the symbol index",
+    ("kind",),
+)
+_METRICS = (
+    STAGE_SECONDS,
+    INGEST_FILES,
+    INGEST_BYTES,
+    INGEST_CHUNKS,
+    INGEST_JOBS,
+    GENERATE_REQUESTS,
+    CONTEXT_TOKENS,
+    SYMBOL_LOOKUPS,
+)
+
+# stage -> seconds of the current request, see start_trace
+_trace: contextvars.ContextVar = contextvars.ContextVar("trace", default=None)
+
+
+@contextmanager
+def span(pipeline: str, stage: str):
+    """Times the block into STAGE_SECONDS, and into the trace of the request if any"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - started
+        STAGE_SECONDS.observe(seconds, pipeline=pipeline, stage=stage)
+        trace = _trace.get()
+        if trace is not None:
+            trace[stage] = trace.get(stage, 0.0) + seconds
+
+
+def start_trace() -> Dict[str, float]:
+    """Collects the spans of the current request (and of the tasks it starts)"""
+    trace = {}
+    _trace.set(trace)
+    return trace
+
+
+def server_timing(trace: Optional[Dict[str, float]]) -> str:
+    """Value of a Server-Timing header, durations in ms"""
+    return ", ".join(
+        f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in (trace or {}).items()
+    )
+
+
+def render() -> str:
+    """All the metrics in the Prometheus text exposition format"""
+    return "\n".join(line for metric in _METRICS for line in metric.render()) + "\n"
@@ -0,0 +1,46 @@
+"""
+Second stage of the dense retrieval: the candidates of a cheap approximate search are
+rescored by exact cosine and diversified by maximal marginal relevance, in NumPy.
+"""
+from typing import Tuple
+
+import numpy as np
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def mmr_rerank(
+    query: np.ndarray, vectors: np.ndarray, k: int, lambda_mult: float = 0.5
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Indices of the k selected candidates (in selection order) and their exact cosine with
+    the query. Each step picks the argmax of
+        lambda_mult * cosine(query) - (1 - lambda_mult) * max cosine(selected)
+    where the max over the selected candidates is updated with one matrix-vector product
+    per step, the pairwise similarity matrix is never built. lambda_mult=1 is a plain
+    exact top k.
+    """
+    vectors = _normalize(np.asarray(vectors, dtype=np.float32))
+    query = _normalize(np.asarray(query, dtype=np.float32))
+    k = min(k, len(vectors))
+    if k <= 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+    relevance = vectors @ query
+    if lambda_mult >= 1:
+        top = np.argpartition(-relevance, k - 1)[:k]
+        top = top[np.argsort(-relevance[top])]
+        return top, relevance[top]
+    selected = np.empty(k, dtype=np.int64)
+    # the most relevant candidate goes first
+    selected[0] = np.argmax(relevance)
+    redundancy = vectors @ vectors[selected[0]]
+    weighted_relevance = lambda_mult * relevance
+    for i in range(1, k):
+        scores = weighted_relevance - (1 - lambda_mult) * redundancy
+        scores[selected[:i]] = -np.inf
+        selected[i] = np.argmax(scores)
+        np.maximum(redundancy, vectors @ vectors[selected[i]], out=redundancy)
+    return selected, relevance[selected]
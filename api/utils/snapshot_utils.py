@@ -0,0 +1,328 @@
+"""
+Portable snapshots of an ingested repo: its chunks, payloads, vectors and source commit in
+one compressed bundle, imported into the vector store without any model work.
+
+A bundle is a gzip stream of frames. A frame is a u32 (little endian) length, a JSON header
+of that length and the sections the header lists:
+    manifest  {"type": "manifest", "format", "collection", "commit", "dim", ...}
+    block     {"type": "block", "count", "sections": [{"name", "encoding", "bytes"}]}
+              the ids and the page contents as "strings" (u32 offsets + utf-8 blob), every
+              flattened metadata field as a "json" column, the vectors as a raw
+              little-endian float32 (count, dim) array
+    end       {"type": "end", "count"}
+"""
+import asyncio
+import json
+import re
+import struct
+import time
+import zlib
+from typing import AsyncIterator, Dict, Iterable, Iterator, List, Optional
+
+import numpy as np
+
+from utils.data_utils import _load_points, _read_ingest_state
+from utils.injectors import config_instance, vector_store_instance
+from utils.vector_stores import Point
+from utils.vector_utils import _rekey_points
+
+FORMAT_VERSION = 1
+_MAGIC = b"CODEQA-SNAPSHOT\n"
+_FRAME_LENGTH = struct.Struct("<I")
+# payload fields stored as their own "strings" column
+_CONTENT_KEY = "page_content"
+_METADATA_KEY = "metadata"
+# what repo_collection_name produces: "name", or "owner/name" with shared collections
+_REPO_NAME = r"[\w][\w.-]*"
+
+
+class SnapshotError(Exception):
+    """Raised when a bundle cannot be imported"""
+
+
+class CollectionExistsError(Exception):
+    """Raised when importing into an existing collection without overwrite"""
+
+
+def _snapshot_config() -> dict:
+    return config_instance().get("Snapshot", {})
+
+
+def _embedding_model() -> str:
+    return config_instance().get("Embeddings", {}).get("model_path")
+
+
+def _flatten(metadata: dict, prefix: str = "") -> Dict[str, object]:
+    """{"a": {"b": 1}} -> {"a.b": 1}, only dicts are flattened"""
+    flat = {}
+    for key, value in metadata.items():
+        if isinstance(value, dict) and value:
+            flat.update(_flatten(value, f"{prefix}{key}."))
+        else:
+            flat[f"{prefix}{key}"] = value
+    return flat
+
+
+def _unflatten(flat: Dict[str, object]) -> dict:
+    nested = {}
+    for key, value in flat.items():
+        *parents, leaf = key.split(".")
+        node = nested
+        for part in parents:
+            node = node.setdefault(part, {})
+        node[leaf] = value
+    return nested
+
+
+def _encode_strings(values: List[str]) -> bytes:
+    encoded = [value.encode("utf-8") for value in values]
+    offsets = np.zeros(len(encoded) + 1, dtype="<u4")
+    offsets[1:] = np.cumsum([len(value) for value in encoded])
+    return offsets.tobytes() + b"".join(encoded)
+
+
+def _decode_strings(data: bytes, count: int) -> List[str]:
+    offsets = np.frombuffer(data, dtype="<u4", count=count + 1)
+    blob = memoryview(data)[offsets.nbytes :]
+    return [
+        bytes(blob[start:end]).decode("utf-8")
+        for start, end in zip(offsets[:-1], offsets[1:])
+    ]
+
+
+def _check_collection_name(collection_name) -> str:
+    # the name is also a path under repos_dir (ingest state, lexical and symbol indexes)
+    pattern = _REPO_NAME
+    if config_instance().get("Tenancy", {}).get("shared_collections", 0):
+        pattern = f"{_REPO_NAME}/{_REPO_NAME}"
+    if (
+        not isinstance(collection_name, str)
+        or not re.fullmatch(pattern, collection_name)
+        or ".." in collection_name
+    ):
+        raise SnapshotError(f"Invalid collection name: {collection_name!r}")
+    return collection_name
+
+
+def _frame(header: dict, sections: List[bytes] = ()) -> bytes:
+    header = json.dumps(header).encode("utf-8")
+    return b"".join([_FRAME_LENGTH.pack(len(header)), header, *sections])
+
+
+def _block_frame(points: List[Point], dim: int) -> bytes:
+    """Columnar encoding of a batch of points"""
+    # a metadata field missing from a point is stored as null, and dropped on import
+    rows = [_flatten(payload.get(_METADATA_KEY) or {}) for _, _, payload in points]
+    names = sorted({name for row in rows for name in row})
+    sections = [
+        ("id", "strings", _encode_strings([point_id for point_id, _, _ in points])),
+        (
+            _CONTENT_KEY,
+            "strings",
+            _encode_strings(
+                [payload.get(_CONTENT_KEY) or "" for _, _, payload in points]
+            ),
+        ),
+        *(
+            (
+                f"{_METADATA_KEY}.{name}",
+                "json",
+                json.dumps([row.get(name) for row in rows]).encode("utf-8"),
+            )
+            for name in names
+        ),
+        (
+            "vector",
+            "float32",
+            np.asarray([vector for _, vector, _ in points], dtype="<f4")
+            .reshape(len(points), dim)
+            .tobytes(),
+        ),
+    ]
+    return _frame(
+        {
+            "type": "block",
+            "count": len(points),
+            "sections": [
+                {"name": name, "encoding": encoding, "bytes": len(data)}
+                for name, encoding, data in sections
+            ],
+        },
+        [data for _, _, data in sections],
+    )
+
+
+def export_snapshot(collection_name: str) -> Iterator[bytes]:
+    """Streams the compressed bundle of the collection"""
+    vector_store = vector_store_instance()
+    snapshot_config = _snapshot_config()
+    block_size = snapshot_config.get("block_size", 4096)
+    compressor = zlib.compressobj(
+        snapshot_config.get("compression_level", 6), zlib.DEFLATED, wbits=31
+    )
+    dim = vector_store.dim
+    manifest = {
+        "type": "manifest",
+        "format": FORMAT_VERSION,
+        "collection": collection_name,
+        "commit": _read_ingest_state(collection_name).get("commit"),
+        "dim": dim,
+        "embedding_model": _embedding_model(),
+        "created_at": time.time(),
+    }
+    yield compressor.compress(_MAGIC + _frame(manifest))
+    count = 0
+    for points in vector_store.scroll_points(collection_name, batch_size=block_size):
+        count += len(points)
+        yield compressor.compress(_block_frame(points, dim))
+    yield compressor.compress(_frame({"type": "end", "count": count}))
+    yield compressor.flush()
+    print(f"Exported {count} points of {collection_name}")
+
+
+class _BundleReader:
+    """Decompresses the chunks of the bundle as they arrive, reads exact byte counts"""
+
+    def __init__(self, chunks: Iterable[bytes]):
+        self.chunks = iter(chunks)
+        self.decompressor = zlib.decompressobj(wbits=31)
+        self.buffer = bytearray()
+
+    def read(self, size: int) -> bytes:
+        while len(self.buffer) < size:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                chunk = self.decompressor.flush()
+                if not chunk:
+                    raise SnapshotError("The bundle is truncated")
+                self.buffer += chunk
+                continue
+            try:
+                self.buffer += self.decompressor.decompress(chunk)
+            except zlib.error as e:
+                raise SnapshotError(f"The bundle is not a valid gzip stream: {e}")
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def read_frame(self) -> dict:
+        (header_length,) = _FRAME_LENGTH.unpack(self.read(_FRAME_LENGTH.size))
+        try:
+            header = json.loads(self.read(header_length))
+        except ValueError:
+            raise SnapshotError("The bundle has an invalid frame header")
+        if not isinstance(header, dict):
+            raise SnapshotError("The bundle has an invalid frame header")
+        return header
+
+
+def _decode_block(reader: _BundleReader, header: dict, dim: int) -> List[Point]:
+    try:
+        return _decode_columns(reader, header, dim)
+    except (KeyError, IndexError, ValueError, TypeError) as e:
+        # framed correctly, but not as export_snapshot writes it
+        raise SnapshotError(f"The bundle has an invalid block: {e!r}") from e
+
+
+def _decode_columns(reader: _BundleReader, header: dict, dim: int) -> List[Point]:
+    count = header["count"]
+    columns = {}
+    for section in header["sections"]:
+        data = reader.read(section["bytes"])
+        if section["encoding"] == "strings":
+            columns[section["name"]] = _decode_strings(data, count)
+        elif section["encoding"] == "json":
+            columns[section["name"]] = json.loads(data)
+        elif section["encoding"] == "float32":
+            if len(data) != count * dim * 4:
+                raise ValueError(f"{len(data)} vector bytes for {count} x {dim}")
+            columns[section["name"]] = np.frombuffer(data, dtype="<f4").reshape(
+                count, dim
+            )
+        else:
+            raise SnapshotError(f"Unknown section encoding: {section['encoding']}")
+    metadata_names = [name for name in columns if name.startswith(f"{_METADATA_KEY}.")]
+    points = []
+    for i in range(count):
+        flat = {
+            name[len(_METADATA_KEY) + 1 :]: columns[name][i]
+            for name in metadata_names
+            if columns[name][i] is not None
+        }
+        payload = {
+            _METADATA_KEY: _unflatten(flat),
+            _CONTENT_KEY: columns[_CONTENT_KEY][i],
+        }
+        points.append((columns["id"][i], columns["vector"][i].tolist(), payload))
+    return points
+
+
+def _iter_blocks(reader: _BundleReader, dim: int) -> Iterator[List[Point]]:
+    """The points of the block frames, checked against the end frame"""
+    count = 0
+    while (header := reader.read_frame()).get("type") == "block":
+        points = _decode_block(reader, header, dim)
+        count += len(points)
+        yield points
+    if header.get("type") != "end" or header.get("count") != count:
+        raise SnapshotError(f"The bundle is incomplete: {count} points read")
+
+
+def import_snapshot(
+    chunks: Iterable[bytes],
+    collection_name: Optional[str] = None,
+    overwrite: bool = False,
+) -> dict:
+    """
+    Bulk loads a bundle into the vector store (in the collection it was exported from by
+    default) and rebuilds the lexical index of its chunks. An existing collection is only
+    replaced with overwrite.
+    """
+    started = time.perf_counter()
+    vector_store = vector_store_instance()
+    reader = _BundleReader(chunks)
+    if reader.read(len(_MAGIC)) != _MAGIC:
+        raise SnapshotError("Not a snapshot bundle")
+    manifest = reader.read_frame()
+    if manifest.get("type") != "manifest" or manifest.get("format") != FORMAT_VERSION:
+        raise SnapshotError(f"Unsupported bundle format: {manifest.get('format')}")
+    if manifest.get("dim") != vector_store.dim:
+        raise SnapshotError(
+            f"The bundle has vectors of dim {manifest.get('dim')}, not {vector_store.dim}"
+        )
+    if manifest.get("embedding_model") != _embedding_model():
+        raise SnapshotError(
+            f"The bundle was embedded with {manifest.get('embedding_model')}"
+        )
+    collection_name = _check_collection_name(
+        collection_name or manifest.get("collection")
+    )
+    if vector_store.collection_exists(collection_name):
+        if not overwrite:
+            raise CollectionExistsError(f"Collection {collection_name} already exists")
+        vector_store.delete_collection(collection_name)
+    commit = manifest.get("commit")
+    blocks = _iter_blocks(reader, vector_store.dim)
+    if collection_name != manifest.get("collection"):
+        # the ids derive from the repo name, the source repo may share the collection
+        blocks = (_rekey_points(collection_name, points) for points in blocks)
+    count = _load_points(collection_name, blocks, commit)
+    seconds = time.perf_counter() - started
+    print(f"Imported {count} points into {collection_name} in {seconds:.2f}s")
+    return {
+        "collection": collection_name,
+        "commit": commit,
+        "points": count,
+        "seconds": round(seconds, 3),
+    }
+
+
+def iter_async_chunks(
+    chunks: AsyncIterator[bytes], loop: asyncio.AbstractEventLoop
+) -> Iterator[bytes]:
+    """Sync view of an async stream (eg: a request body), for a worker thread"""
+    while True:
+        try:
+            yield asyncio.run_coroutine_threadsafe(chunks.__anext__(), loop).result()
+        except StopAsyncIteration:
+            return
@@ -0,0 +1,508 @@
+"""
+Symbol table of a repo: the definitions (functions, classes, methods) of its files with
+their location and the call references to them, persisted per repo as a compressed npz.
+Python files are parsed with `ast`, the other languages with per-language patterns of
+their definitions. Lookup questions ("where is X defined", "who calls X") are answered
+from it without any model.
+"""
+import ast
+import os
+import re
+from typing import Iterable, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+KINDS = ("function", "method", "class")
+
+
+class Definition(NamedTuple):
+    name: str
+    # eg: "Class.method"
+    qualname: str
+    kind: str
+    line: int
+    end_line: int
+
+
+class Reference(NamedTuple):
+    # name of the called function / method
+    name: str
+    line: int
+    # qualname of the enclosing definition, "" at module level
+    caller: str
+
+
+class _PythonVisitor(ast.NodeVisitor):
+    def __init__(self):
+        self.definitions: List[Definition] = []
+        self.references: List[Reference] = []
+        self.scope: List[Definition] = []
+
+    def _visit_definition(self, node, kind: str):
+        parent = self.scope[-1] if self.scope else None
+        if kind == "function" and parent is not None and parent.kind == "class":
+            kind = "method"
+        definition = Definition(
+            node.name,
+            f"{parent.qualname}.{node.name}" if parent else node.name,
+            kind,
+            node.lineno,
+            node.end_lineno or node.lineno,
+        )
+        self.definitions.append(definition)
+        self.scope.append(definition)
+        self.generic_visit(node)
+        self.scope.pop()
+
+    def visit_FunctionDef(self, node):
+        self._visit_definition(node, "function")
+
+    visit_AsyncFunctionDef = visit_FunctionDef
+
+    def visit_ClassDef(self, node):
+        self._visit_definition(node, "class")
+
+    def visit_Call(self, node):
+        name = None
+        if isinstance(node.func, ast.Name):
+            name = node.func.id
+        elif isinstance(node.func, ast.Attribute):
+            name = node.func.attr
+        if name is not None:
+            caller = self.scope[-1].qualname if self.scope else ""
+            self.references.append(Reference(name, node.lineno, caller))
+        self.generic_visit(node)
+
+
+_MODIFIERS = (
+    r"(?:(?:export|default|public|private|protected|internal|static|final|abstract|"
+    r"sealed|open|override|virtual|async|synchronized|partial|data|inline|suspend|"
+    r"unsafe|const|pub(?:\([^)]*\))?)\s+)*"
+)
+_CLASS = (
+    rf"^\s*{_MODIFIERS}(?:class|interface|struct|enum|trait|record|object)\s+"
+    r"(?P<name>\w+)"
+)
+# (kind, pattern) per language, the name is in the "name" group and the type of a Go
+# receiver in the "owner" group; a function defined in a class is a method
+_DEFINITION_PATTERNS = {
+    "JS": [
+        ("class", rf"^\s*{_MODIFIERS}class\s+(?P<name>[\w$]+)"),
+        ("function", rf"^\s*{_MODIFIERS}function\s*\*?\s*(?P<name>[\w$]+)\s*\("),
+        (
+            "function",
+            rf"^\s*{_MODIFIERS}(?:const|let|var)\s+(?P<name>[\w$]+)\s*=\s*"
+            r"(?:async\s+)?(?:function\b|\([^)]*\)\s*=>|[\w$]+\s*=>)",
+        ),
+        (
+            "method",
+            r"^\s+(?:(?:public|private|protected|static|async|get|set|readonly)\s+)*"
+            r"(?P<name>[\w$]+)\s*\([^)]*\)\s*(?::\s*[^{;=]+)?\{",
+        ),
+    ],
+    "GO": [
+        ("class", r"^type\s+(?P<name>\w+)\s+(?:struct|interface)\b"),
+        (
+            "method",
+            r"^func\s+\(\s*\w*\s*\*?\s*(?P<owner>\w+)[^)]*\)\s*(?P<name>\w+)\s*[\[(]",
+        ),
+        ("function", r"^func\s+(?P<name>\w+)\s*[\[(]"),
+    ],
+    "JAVA": [
+        ("class", _CLASS),
+        (
+            "function",
+            rf"^\s*{_MODIFIERS}(?:<[^>]*>\s+)?[\w<>\[\]?,.]+\s+(?P<name>\w+)\s*"
+            r"\([^)]*\)\s*(?:throws\s+[\w.,\s]+)?\{",
+        ),
+    ],
+    "KOTLIN": [
+        ("class", _CLASS),
+        (
+            "function",
+            rf"^\s*{_MODIFIERS}(?:fun|def|func)\s+(?:<[^>]*>\s*)?(?:\w+\.)?"
+            r"(?P<name>\w+)\s*[\[(<]",
+        ),
+    ],
+    "RUST": [
+        ("class", _CLASS),
+        ("function", rf"^\s*{_MODIFIERS}(?:extern\s+\"\w+\"\s+)?fn\s+(?P<name>\w+)"),
+    ],
+    "RUBY": [
+        ("class", r"^\s*(?:class|module)\s+(?:\w+::)*(?P<name>\w+)"),
+        ("function", r"^\s*def\s+(?:self\.)?(?P<name>\w+[?!=]?)"),
+    ],
+    "PHP": [
+        ("class", rf"^\s*{_MODIFIERS}(?:class|interface|trait|enum)\s+(?P<name>\w+)"),
+        ("function", rf"^\s*{_MODIFIERS}function\s+&?(?P<name>\w+)\s*\("),
+    ],
+    "C": [
+        ("class", r"^\s*(?:typedef\s+)?(?:class|struct)\s+(?P<name>\w+)\s*(?:[:{]|$)"),
+        (
+            "function",
+            r"^(?:[\w*&:<>,]+\s+)+[*&]*(?:\w+::)*(?P<name>~?\w+)\s*\([^;]*\)\s*"
+            r"(?:const\s*)?(?:\{.*)?$",
+        ),
+    ],
+    "LUA": [
+        (
+            "function",
+            r"^\s*(?:local\s+)?function\s+(?:[\w.]+[.:])?(?P<name>\w+)\s*\(",
+        )
+    ],
+    "PERL": [("function", r"^\s*sub\s+(?P<name>\w+)")],
+}
+for _alias, _language in {
+    "TS": "JS",
+    "CSHARP": "JAVA",
+    "SCALA": "KOTLIN",
+    "SWIFT": "KOTLIN",
+    "CPP": "C",
+}.items():
+    _DEFINITION_PATTERNS[_alias] = _DEFINITION_PATTERNS[_language]
+_DEFINITION_PATTERNS = {
+    language: [(kind, re.compile(pattern)) for kind, pattern in patterns]
+    for language, patterns in _DEFINITION_PATTERNS.items()
+}
+_CALL = re.compile(r"(?<![\w$])([A-Za-z_$][\w$]*)\s*\(")
+# words followed by a parenthesis that are not calls
+_NOT_CALLS = frozenset(
+    """if elif else for foreach while switch case catch return function func fn def sub
+    sizeof typeof new delete throw throws await yield assert print super this self and
+    or not in is do try with using lock fixed when match synchronized""".split()
+)
+
+
+def _enclosing(definitions: List[Definition], line: int) -> Optional[Definition]:
+    """Innermost definition whose lines contain the line"""
+    enclosing = None
+    for definition in definitions:
+        if definition.line <= line <= definition.end_line:
+            if enclosing is None or definition.line >= enclosing.line:
+                enclosing = definition
+    return enclosing
+
+
+def _extract_with_patterns(
+    content: str, patterns: List[Tuple[str, re.Pattern]]
+) -> Tuple[List[Definition], List[Reference]]:
+    lines = content.split("\n")
+    found = []
+    for line_no, line in enumerate(lines, start=1):
+        for kind, pattern in patterns:
+            match = pattern.match(line)
+            if match is None or match.group("name") in _NOT_CALLS:
+                continue
+            indent = len(line) - len(line.lstrip())
+            owner = match.groupdict().get("owner")
+            found.append((line_no, indent, kind, match.group("name"), owner))
+            break
+    definitions = []
+    for i, (line_no, indent, kind, name, owner) in enumerate(found):
+        # a definition ends before the next one that is not nested in it
+        end_line = len(lines) if lines[-1] else len(lines) - 1
+        for next_line_no, next_indent, *_ in found[i + 1 :]:
+            if next_indent <= indent:
+                end_line = next_line_no - 1
+                break
+        parent = _enclosing(definitions, line_no)
+        if owner is not None:
+            qualname = f"{owner}.{name}"
+        elif parent is not None and parent.kind == "class":
+            qualname = f"{parent.qualname}.{name}"
+            kind = "method" if kind == "function" else kind
+        else:
+            qualname = name
+            kind = "function" if kind == "method" else kind
+        definitions.append(Definition(name, qualname, kind, line_no, end_line))
+    defined_at = {(definition.line, definition.name) for definition in definitions}
+    references = []
+    for line_no, line in enumerate(lines, start=1):
+        for name in _CALL.findall(line):
+            if name in _NOT_CALLS or (line_no, name) in defined_at:
+                continue
+            caller = _enclosing(definitions, line_no)
+            references.append(
+                Reference(name, line_no, caller.qualname if caller else "")
+            )
+    return definitions, references
+
+
+def extract_symbols(
+    content: str, language: str
+) -> Tuple[List[Definition], List[Reference]]:
+    """
+    Definitions and call references of a file, `language` is a name of the chunking
+    module (eg: "PYTHON"). Languages without definitions (eg: markdown) have none.
+    """
+    if language == "PYTHON":
+        try:
+            tree = ast.parse(content)
+        except (SyntaxError, ValueError):
+            # eg: python 2 files, the patterns of the other languages do not apply
+            return [], []
+        visitor = _PythonVisitor()
+        visitor.visit(tree)
+        return visitor.definitions, visitor.references
+    patterns = _DEFINITION_PATTERNS.get(language)
+    if patterns is None:
+        return [], []
+    return _extract_with_patterns(content, patterns)
+
+
+def chunk_symbols(definitions: List[Definition], start_line: int, end_line: int):
+    """Names of the definitions that start in the given lines, eg: of a chunk"""
+    return sorted(
+        {
+            definition.name
+            for definition in definitions
+            if start_line <= definition.line <= end_line
+        }
+    )
+
+
+_NAME = r"`?(?P<name>[A-Za-z_$][\w$]*(?:(?:\.|::|#)[A-Za-z_$][\w$]*)*)(?:\(\))?`?"
+_KIND = r"(?:the\s+)?(?:(?:function|method|class|def|symbol)\s+)?"
+_LOOKUP_QUERIES = [
+    (
+        "definition",
+        rf"where\s+(?:is|are|'s)\s+{_KIND}{_NAME}\s+(?:defined|declared|implemented)",
+    ),
+    (
+        "definition",
+        rf"(?:find|show|go\s+to)\s+(?:me\s+)?(?:the\s+)?(?:definition|declaration)\s+"
+        rf"of\s+{_KIND}{_NAME}",
+    ),
+    (
+        "usage",
+        rf"(?:who|what|which\s+(?:functions?|methods?|files?|code))\s+"
+        rf"(?:calls?|uses?|invokes?)\s+{_KIND}{_NAME}",
+    ),
+    (
+        "usage",
+        rf"where\s+(?:is|are)\s+{_KIND}{_NAME}\s+(?:called|used|invoked|referenced)",
+    ),
+    (
+        "usage",
+        rf"(?:find|show|list)\s+(?:me\s+)?(?:all\s+)?(?:the\s+)?"
+        rf"(?:callers|usages|uses|references|call\s+sites)\s+(?:of|to|for)\s+{_NAME}",
+    ),
+]
+_LOOKUP_QUERIES = [
+    (kind, re.compile(rf"\s*{pattern}\s*[?.!]*\s*", re.IGNORECASE))
+    for kind, pattern in _LOOKUP_QUERIES
+]
+
+
+def parse_lookup(query: str) -> Optional[Tuple[str, str]]:
+    """("definition" | "usage", symbol) of a lookup question, None for others"""
+    for kind, pattern in _LOOKUP_QUERIES:
+        match = pattern.fullmatch(query)
+        if match is not None:
+            return kind, re.sub(r"::|#", ".", match.group("name"))
+    return None
+
+
+class SymbolIndex:
+    """
+    Definitions and references sorted by name: those of `names[i]` are the rows
+    `def_indptr[i]:def_indptr[i + 1]` (`ref_indptr` for the references) of the columns.
+    Paths are stored once, the rows refer to them by position.
+    """
+
+    def __init__(
+        self,
+        names: np.ndarray,
+        paths: np.ndarray,
+        def_indptr: np.ndarray,
+        def_qualnames: np.ndarray,
+        def_kinds: np.ndarray,
+        def_paths: np.ndarray,
+        def_lines: np.ndarray,
+        def_end_lines: np.ndarray,
+        ref_indptr: np.ndarray,
+        ref_callers: np.ndarray,
+        ref_paths: np.ndarray,
+        ref_lines: np.ndarray,
+    ):
+        self.names = names
+        self.paths = paths
+        self.def_indptr = def_indptr
+        self.def_qualnames = def_qualnames
+        self.def_kinds = def_kinds
+        self.def_paths = def_paths
+        self.def_lines = def_lines
+        self.def_end_lines = def_end_lines
+        self.ref_indptr = ref_indptr
+        self.ref_callers = ref_callers
+        self.ref_paths = ref_paths
+        self.ref_lines = ref_lines
+        self._lower_names = None
+
+    def __len__(self) -> int:
+        return len(self.def_qualnames)
+
+    def _name_ids(self, name: str) -> List[int]:
+        i = int(np.searchsorted(self.names, name))
+        if i < len(self.names) and self.names[i] == name:
+            return [i]
+        # eg: "where is batchinsert defined"
+        if self._lower_names is None:
+            self._lower_names = np.char.lower(self.names)
+        return np.flatnonzero(self._lower_names == name.lower()).tolist()
+
+    def definitions(self, symbol: str) -> List[dict]:
+        """Definitions of a name, or of a qualified name (eg: "Class.method")"""
+        name = symbol.split(".")[-1]
+        definitions = []
+        for name_id in self._name_ids(name):
+            for row in range(self.def_indptr[name_id], self.def_indptr[name_id + 1]):
+                qualname = str(self.def_qualnames[row])
+                if "." in symbol and not (
+                    qualname.lower() == symbol.lower()
+                    or qualname.lower().endswith(f".{symbol.lower()}")
+                ):
+                    continue
+                definitions.append(
+                    {
+                        "name": str(self.names[name_id]),
+                        "qualname": qualname,
+                        "kind": KINDS[self.def_kinds[row]],
+                        "path": str(self.paths[self.def_paths[row]]),
+                        "line": int(self.def_lines[row]),
+                        "end_line": int(self.def_end_lines[row]),
+                    }
+                )
+        return definitions
+
+    def references(self, symbol: str) -> List[dict]:
+        """Call sites of a name (calls are matched by name, the receiver is unknown)"""
+        references = []
+        for name_id in self._name_ids(symbol.split(".")[-1]):
+            for row in range(self.ref_indptr[name_id], self.ref_indptr[name_id + 1]):
+                references.append(
+                    {
+                        "name": str(self.names[name_id]),
+                        "caller": str(self.ref_callers[row]),
+                        "path": str(self.paths[self.ref_paths[row]]),
+                        "line": int(self.ref_lines[row]),
+                    }
+                )
+        return references
+
+    def save(self, path: str):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_path = f"{path}.tmp.npz"
+        np.savez_compressed(
+            tmp_path,
+            names=self.names,
+            paths=self.paths,
+            def_indptr=self.def_indptr,
+            def_qualnames=self.def_qualnames,
+            def_kinds=self.def_kinds,
+            def_paths=self.def_paths,
+            def_lines=self.def_lines,
+            def_end_lines=self.def_end_lines,
+            ref_indptr=self.ref_indptr,
+            ref_callers=self.ref_callers,
+            ref_paths=self.ref_paths,
+            ref_lines=self.ref_lines,
+        )
+        # readers never see a partially written index
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> "SymbolIndex":
+        with np.load(path) as data:
+            return cls(**{name: data[name] for name in data.files})
+
+
+class SymbolIndexBuilder:
+    """Accumulates the symbols of files (optionally on top of an existing index)"""
+
+    def __init__(self):
+        self.paths = []
+        self.definitions = []
+        self.references = []
+
+    def add_file(
+        self, path: str, definitions: List[Definition], references: List[Reference]
+    ):
+        path_id = len(self.paths)
+        self.paths.append(path)
+        self.definitions.extend(
+            (d.name, d.qualname, KINDS.index(d.kind), path_id, d.line, d.end_line)
+            for d in definitions
+        )
+        self.references.extend((r.name, r.caller, path_id, r.line) for r in references)
+
+    def add_index(self, index: SymbolIndex, drop_paths: Iterable[str] = ()):
+        """Copies the symbols of `index`, except the ones of `drop_paths`"""
+        drop_paths = set(drop_paths)
+        path_ids = {}
+        for old_id, path in enumerate(index.paths.tolist()):
+            if path not in drop_paths:
+                path_ids[old_id] = len(self.paths)
+                self.paths.append(path)
+        names = index.names.tolist()
+        def_names = np.repeat(np.arange(len(names)), np.diff(index.def_indptr))
+        for row, path_id in enumerate(index.def_paths.tolist()):
+            if path_id in path_ids:
+                self.definitions.append(
+                    (
+                        names[def_names[row]],
+                        str(index.def_qualnames[row]),
+                        int(index.def_kinds[row]),
+                        path_ids[path_id],
+                        int(index.def_lines[row]),
+                        int(index.def_end_lines[row]),
+                    )
+                )
+        ref_names = np.repeat(np.arange(len(names)), np.diff(index.ref_indptr))
+        for row, path_id in enumerate(index.ref_paths.tolist()):
+            if path_id in path_ids:
+                self.references.append(
+                    (
+                        names[ref_names[row]],
+                        str(index.ref_callers[row]),
+                        path_ids[path_id],
+                        int(index.ref_lines[row]),
+                    )
+                )
+
+    def build(self) -> SymbolIndex:
+        names = sorted(
+            {row[0] for row in self.definitions} | {row[0] for row in self.references}
+        )
+        name_ids = {name: i for i, name in enumerate(names)}
+        definitions = sorted(
+            self.definitions, key=lambda row: (name_ids[row[0]], row[3], row[4])
+        )
+        references = sorted(
+            self.references, key=lambda row: (name_ids[row[0]], row[2], row[3])
+        )
+
+        def indptr(rows) -> np.ndarray:
+            counts = np.bincount(
+                np.array([name_ids[row[0]] for row in rows], dtype=np.int64),
+                minlength=len(names),
+            )
+            return np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+
+        def column(rows, i: int, dtype) -> np.ndarray:
+            return np.array([row[i] for row in rows], dtype=dtype)
+
+        return SymbolIndex(
+            names=np.array(names, dtype=str),
+            paths=np.array(self.paths, dtype=str),
+            def_indptr=indptr(definitions),
+            def_qualnames=column(definitions, 1, str),
+            def_kinds=column(definitions, 2, np.uint8),
+            def_paths=column(definitions, 3, np.uint32),
+            def_lines=column(definitions, 4, np.uint32),
+            def_end_lines=column(definitions, 5, np.uint32),
+            ref_indptr=indptr(references),
+            ref_callers=column(references, 1, str),
+            ref_paths=column(references, 2, np.uint32),
+            ref_lines=column(references, 3, np.uint32),
+        )
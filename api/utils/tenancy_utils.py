@@ -0,0 +1,54 @@
+"""
+Migration of the per-repo collections to the shared collections of the `Tenancy` config:
+the points are copied with their vectors, so nothing is re-embedded.
+"""
+import os
+import shutil
+import time
+
+from utils.data_utils import _load_points, _read_ingest_state
+from utils.injectors import symbol_index_path, vector_store_instance
+from utils.vector_utils import _rekey_points, repo_collection_name
+
+
+def migrate_to_shared(
+    collection_name: str, repo_url: str, delete_source: bool = False
+) -> dict:
+    """
+    Copies the per-repo collection to the tenant of the repo in the shared collections
+    (the url gives the owner the per-repo name lacks). The source collection is kept
+    unless delete_source, searches read the tenant once this returns.
+    """
+    started = time.perf_counter()
+    vector_store = vector_store_instance()
+    repo_name = repo_collection_name(repo_url)
+    commit = _read_ingest_state(collection_name).get("commit")
+    if vector_store.collection_exists(repo_name):
+        # the tenant is replaced, eg: by a migration run again
+        vector_store.delete_collection(repo_name)
+    count = _load_points(
+        repo_name,
+        (
+            _rekey_points(repo_name, points)
+            for points in vector_store.scroll_points(collection_name)
+        ),
+        commit,
+    )
+    source_symbols = symbol_index_path(collection_name)
+    if os.path.exists(source_symbols):
+        # the symbol index only depends on the files, it is reused as is
+        os.makedirs(os.path.dirname(symbol_index_path(repo_name)), exist_ok=True)
+        shutil.copyfile(source_symbols, symbol_index_path(repo_name))
+    if delete_source:
+        vector_store.delete_collection(collection_name)
+    seconds = time.perf_counter() - started
+    print(
+        f"Migrated {count} points of {collection_name} to {repo_name} in {seconds:.2f}s"
+    )
+    return {
+        "collection": collection_name,
+        "repo": repo_name,
+        "commit": commit,
+        "points": count,
+        "seconds": round(seconds, 3),
+    }
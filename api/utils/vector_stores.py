@@ -0,0 +1,1108 @@
+"""
+Vector store backends: the Qdrant server, or an embedded store of memory-mapped matrices
+searched with NumPy (no network hop, for deployments of many small repos).
+Points are (id, vector, payload) with the payload {"metadata": ..., "page_content": ...}.
+"""
+import asyncio
+import functools
+import json
+import os
+import re
+import shutil
+import threading
+import zlib
+from concurrent.futures import Executor
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+from langchain_core.documents.base import Document
+from qdrant_client.models import Distance, VectorParams
+from qdrant_client.http.models import (
+    PointStruct,
+    Filter,
+    FieldCondition,
+    MatchAny,
+    MatchValue,
+    FilterSelector,
+    PayloadSelectorInclude,
+    PayloadSchemaType,
+    HnswConfigDiff,
+    ScalarQuantization,
+    ScalarQuantizationConfig,
+    ScalarType,
+    QuantizationSearchParams,
+    SearchParams,
+    VectorParamsDiff,
+    CollectionParamsDiff,
+    Disabled,
+)
+
+from utils.rerank import mmr_rerank
+
+# a point as given to upsert
+Point = Tuple[str, List[float], dict]
+
+_PATH_KEY = "metadata.file_level_metadata.path"
+# payload of the points in shared collections: the tenant ("owner/name") they are
+# partitioned by, and "owner/name@commit" of the last completed ingest
+_REPO_KEY = "repo"
+_REPO_ID_KEY = "repo_id"
+# candidates fetched for a maximal marginal relevance search (same as langchain)
+_MMR_FETCH_K = 20
+_MMR_LAMBDA = 0.5
+
+
+def _document(collection_name: str, point_id: str, payload: dict) -> Document:
+    metadata = dict(payload.get("metadata") or {})
+    metadata["_id"] = point_id
+    metadata["_collection_name"] = collection_name
+    return Document(page_content=payload.get("page_content"), metadata=metadata)
+
+
+def _get_path(payload: dict, key: str):
+    for part in key.split("."):
+        if not isinstance(payload, dict):
+            return None
+        payload = payload.get(part)
+    return payload
+
+
+def _project(payload: dict, fields: Optional[List[str]]) -> dict:
+    """The given (dotted) fields of the payload, all of it when fields is None"""
+    if fields is None:
+        return payload
+    projected = {}
+    for field in fields:
+        value = _get_path(payload, field)
+        if value is None:
+            continue
+        *parents, leaf = field.split(".")
+        node = projected
+        for part in parents:
+            node = node.setdefault(part, {})
+        node[leaf] = value
+    return projected
+
+
+class VectorStore:
+    """
+    Interface of the backends, one collection per repo. The async methods run the sync
+    ones in the executor unless the backend has a native async client.
+    """
+
+    def __init__(self, dim: int = 256, executor: Optional[Executor] = None):
+        self.dim = dim
+        self.executor = executor
+
+    def collection_exists(self, collection_name: str) -> bool:
+        raise NotImplementedError
+
+    def list_collections(self) -> List[str]:
+        raise NotImplementedError
+
+    def ensure_collection(self, collection_name: str):
+        """Creates the collection if needed"""
+        raise NotImplementedError
+
+    def migrate_collection(self, collection_name: str):
+        """Applies the configured profile to an existing collection"""
+        raise NotImplementedError
+
+    def count(self, collection_name: str) -> int:
+        raise NotImplementedError
+
+    def upsert(self, collection_name: str, points: List[Point]):
+        raise NotImplementedError
+
+    def tag_commit(self, collection_name: str, commit: str):
+        """Records the commit the stored points were ingested from"""
+
+    def existing_ids(self, collection_name: str, ids: List[str]) -> set:
+        """The ids of the list that are stored"""
+        raise NotImplementedError
+
+    def scroll(
+        self, collection_name: str, payload_fields: Optional[List[str]] = None
+    ) -> Iterator[Tuple[str, dict]]:
+        """(id, payload restricted to payload_fields) of every point"""
+        raise NotImplementedError
+
+    def scroll_points(
+        self, collection_name: str, batch_size: int = 1000
+    ) -> Iterator[List[Point]]:
+        """Batches of every point, with its vector and whole payload"""
+        raise NotImplementedError
+
+    def delete_paths(self, collection_name: str, paths: Iterable[str]):
+        """Deletes the points of the given file paths"""
+        raise NotImplementedError
+
+    def delete_collection(self, collection_name: str):
+        raise NotImplementedError
+
+    def retrieve(self, collection_name: str, ids: List[str]) -> Dict[str, Document]:
+        raise NotImplementedError
+
+    def search(
+        self,
+        collection_name: str,
+        vector: List[float],
+        k: int,
+        search_type: str = "similarity",
+    ) -> List[Tuple[Document, float]]:
+        """Top k docs by cosine similarity, best first ("mmr" diversifies them)"""
+        raise NotImplementedError
+
+    def search_candidates(
+        self,
+        collection_name: str,
+        vector: List[float],
+        k: int,
+        hnsw_ef: Optional[int] = None,
+    ) -> Tuple[List[Document], np.ndarray]:
+        """
+        Approximate top k docs and their stored vectors (k, dim), the first stage of a
+        two-stage search: cheaper than `search`, meant to be oversampled and reranked
+        """
+        raise NotImplementedError
+
+    def ping(self):
+        """Raises if the store is not usable"""
+        raise NotImplementedError
+
+    async def _run(self, function, *args, **kwargs):
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, functools.partial(function, *args, **kwargs)
+        )
+
+    async def asearch(
+        self,
+        collection_name: str,
+        vector: List[float],
+        k: int,
+        search_type: str = "similarity",
+    ) -> List[Tuple[Document, float]]:
+        return await self._run(self.search, collection_name, vector, k, search_type)
+
+    async def asearch_many(
+        self,
+        collection_names: List[str],
+        vector: List[float],
+        k: int,
+        search_type: str = "similarity",
+    ) -> List[Tuple[Document, float]]:
+        """Top k docs of several collections, searched concurrently"""
+        if len(collection_names) == 1:
+            return await self.asearch(collection_names[0], vector, k, search_type)
+        results = await asyncio.gather(
+            *(
+                self.asearch(collection_name, vector, k, search_type)
+                for collection_name in collection_names
+            )
+        )
+        merged = [result for repo_results in results for result in repo_results]
+        return sorted(merged, key=lambda result: result[1], reverse=True)[:k]
+
+    async def asearch_candidates(
+        self,
+        collection_name: str,
+        vector: List[float],
+        k: int,
+        hnsw_ef: Optional[int] = None,
+    ) -> Tuple[List[Document], np.ndarray]:
+        return await self._run(
+            self.search_candidates, collection_name, vector, k, hnsw_ef
+        )
+
+    async def aretrieve(
+        self, collection_name: str, ids: List[str]
+    ) -> Dict[str, Document]:
+        return await self._run(self.retrieve, collection_name, ids)
+
+    async def aclose(self):
+        pass
+
+
+class QdrantVectorStore(VectorStore):
+    """
+    Collections are created with the performance profile of the `Collection` section of
+    the config. Without an async client (eg: in-process Qdrant) the sync client is used
+    from the executor.
+    With shared_collections > 0 the repos ("owner/name") are tenants of that many
+    physical collections `{shared_prefix}_{i}`: their points carry the indexed `repo`
+    payload every operation filters on, and the HNSW graph is built per tenant. Names
+    without an owner are physical collections (the shared ones, or per-repo collections
+    created before).
+    """
+
+    def __init__(
+        self,
+        client,
+        async_client=None,
+        vector_name: str = "embeddings",
+        collection_config: Optional[dict] = None,
+        dim: int = 256,
+        executor: Optional[Executor] = None,
+        shared_collections: int = 0,
+        shared_prefix: str = "repos",
+    ):
+        super().__init__(dim, executor)
+        self.client = client
+        self.async_client = async_client
+        self.vector_name = vector_name
+        self.collection_config = collection_config or {}
+        self.shared_collections = shared_collections
+        self.shared_prefix = shared_prefix
+
+    def _is_shared(self, physical_name: str) -> bool:
+        return physical_name in {
+            f"{self.shared_prefix}_{i}" for i in range(self.shared_collections)
+        }
+
+    def _target(self, collection_name: str) -> Tuple[str, Optional[Filter]]:
+        """The physical collection of a repo and the filter of its points in it"""
+        if not self.shared_collections or "/" not in collection_name:
+            return collection_name, None
+        shard = zlib.crc32(collection_name.encode("utf-8")) % self.shared_collections
+        return f"{self.shared_prefix}_{shard}", Filter(
+            must=[
+                FieldCondition(key=_REPO_KEY, match=MatchValue(value=collection_name))
+            ]
+        )
+
+    def _hnsw_config(self, shared: bool = False) -> HnswConfigDiff:
+        m = self.collection_config.get("hnsw_m", 16)
+        ef_construct = self.collection_config.get("hnsw_ef_construct", 100)
+        if shared:
+            # no global graph, one graph per value of the indexed repo payload: a
+            # filtered search stays an HNSW search however small the tenant is
+            return HnswConfigDiff(m=0, payload_m=m, ef_construct=ef_construct)
+        return HnswConfigDiff(m=m, ef_construct=ef_construct)
+
+    def _quantization_config(self):
+        """Scalar int8 quantization of the profile, None if it is disabled"""
+        if self.collection_config.get("quantization", "int8") != "int8":
+            return None
+        return ScalarQuantization(
+            scalar=ScalarQuantizationConfig(
+                type=ScalarType.INT8,
+                quantile=self.collection_config.get("quantization_quantile", 0.99),
+                # the quantized vectors are what the HNSW search reads
+                always_ram=True,
+            )
+        )
+
+    def search_params(self) -> SearchParams:
+        """Search-time parameters of the collection profile"""
+        quantization = None
+        if self._quantization_config() is not None:
+            quantization = QuantizationSearchParams(
+                rescore=self.collection_config.get("rescore", True),
+                oversampling=self.collection_config.get("oversampling", 2.0),
+            )
+        return SearchParams(
+            hnsw_ef=self.collection_config.get("search_hnsw_ef", 64),
+            quantization=quantization,
+        )
+
+    def _ensure_payload_indexes(self, physical_name: str):
+        indexed = self.client.get_collection(physical_name).payload_schema or {}
+        field_names = list(self.collection_config.get("payload_indexes", []))
+        if self._is_shared(physical_name):
+            # the tenant key first, the per-tenant graphs are built on it
+            field_names = [_REPO_KEY, _REPO_ID_KEY, *field_names]
+        for field_name in field_names:
+            if field_name not in indexed:
+                print(f"Creating payload index on {field_name} : {physical_name}")
+                self.client.create_payload_index(
+                    collection_name=physical_name,
+                    field_name=field_name,
+                    field_schema=PayloadSchemaType.KEYWORD,
+                )
+
+    def collection_exists(self, collection_name: str) -> bool:
+        physical_name, repo_filter = self._target(collection_name)
+        if not self.client.collection_exists(physical_name):
+            return False
+        return repo_filter is None or self.count(collection_name) > 0
+
+    def list_collections(self) -> List[str]:
+        """The physical collections"""
+        return [
+            collection.name for collection in self.client.get_collections().collections
+        ]
+
+    def ensure_collection(self, collection_name: str):
+        physical_name, _ = self._target(collection_name)
+        if not self.client.collection_exists(physical_name):
+            print(
+                f"Collection does not exist, hence creating collection : {physical_name}"
+            )
+            self.client.create_collection(
+                collection_name=physical_name,
+                vectors_config={
+                    self.vector_name: VectorParams(
+                        size=self.dim,
+                        distance=Distance.COSINE,
+                        on_disk=self.collection_config.get("on_disk_vectors", True),
+                    )
+                },
+                hnsw_config=self._hnsw_config(self._is_shared(physical_name)),
+                quantization_config=self._quantization_config(),
+                on_disk_payload=self.collection_config.get("on_disk_payload", True),
+            )
+        self._ensure_payload_indexes(physical_name)
+
+    def migrate_collection(self, collection_name: str):
+        # the HNSW graph and the quantized vectors are rebuilt by the optimizer in the
+        # background
+        physical_name, _ = self._target(collection_name)
+        self.client.update_collection(
+            collection_name=physical_name,
+            vectors_config={
+                self.vector_name: VectorParamsDiff(
+                    on_disk=self.collection_config.get("on_disk_vectors", True)
+                )
+            },
+            hnsw_config=self._hnsw_config(self._is_shared(physical_name)),
+            quantization_config=self._quantization_config() or Disabled.DISABLED,
+            collection_params=CollectionParamsDiff(
+                on_disk_payload=self.collection_config.get("on_disk_payload", True)
+            ),
+        )
+        self._ensure_payload_indexes(physical_name)
+
+    def count(self, collection_name: str) -> int:
+        physical_name, repo_filter = self._target(collection_name)
+        return self.client.count(
+            physical_name, count_filter=repo_filter, exact=True
+        ).count
+
+    def upsert(self, collection_name: str, points: List[Point]):
+        physical_name, repo_filter = self._target(collection_name)
+        self.client.upsert(
+            collection_name=physical_name,
+            points=[
+                PointStruct(
+                    id=point_id,
+                    payload=(
+                        payload
+                        if repo_filter is None
+                        else {**payload, _REPO_KEY: collection_name}
+                    ),
+                    vector={self.vector_name: vector},
+                )
+                for point_id, vector, payload in points
+            ],
+            wait=False,
+        )
+
+    def tag_commit(self, collection_name: str, commit: str):
+        physical_name, repo_filter = self._target(collection_name)
+        self.client.set_payload(
+            collection_name=physical_name,
+            payload={_REPO_ID_KEY: f"{collection_name}@{commit}"},
+            points=FilterSelector(filter=repo_filter or Filter()),
+        )
+
+    def existing_ids(self, collection_name: str, ids: List[str]) -> set:
+        # the ids are derived from the repo name, unique across the tenants
+        physical_name, _ = self._target(collection_name)
+        return {
+            str(point.id)
+            for point in self.client.retrieve(
+                collection_name=physical_name,
+                ids=ids,
+                with_payload=False,
+                with_vectors=False,
+            )
+        }
+
+    def scroll(
+        self,
+        collection_name: str,
+        payload_fields: Optional[List[str]] = None,
+        batch_size: int = 1000,
+    ) -> Iterator[Tuple[str, dict]]:
+        physical_name, repo_filter = self._target(collection_name)
+        with_payload = True
+        if payload_fields is not None:
+            with_payload = PayloadSelectorInclude(include=payload_fields)
+        offset = None
+        while True:
+            points, offset = self.client.scroll(
+                collection_name=physical_name,
+                scroll_filter=repo_filter,
+                limit=batch_size,
+                offset=offset,
+                with_payload=with_payload,
+                with_vectors=False,
+            )
+            for point in points:
+                yield str(point.id), point.payload or {}
+            if offset is None:
+                break
+
+    def scroll_points(
+        self, collection_name: str, batch_size: int = 1000
+    ) -> Iterator[List[Point]]:
+        physical_name, repo_filter = self._target(collection_name)
+        offset = None
+        while True:
+            points, offset = self.client.scroll(
+                collection_name=physical_name,
+                scroll_filter=repo_filter,
+                limit=batch_size,
+                offset=offset,
+                with_payload=True,
+                with_vectors=[self.vector_name],
+            )
+            if points:
+                yield [
+                    (str(point.id), point.vector[self.vector_name], point.payload or {})
+                    for point in points
+                ]
+            if offset is None:
+                break
+
+    def delete_paths(
+        self, collection_name: str, paths: Iterable[str], batch_size: int = 500
+    ):
+        physical_name, repo_filter = self._target(collection_name)
+        paths = list(paths)
+        for i in range(0, len(paths), batch_size):
+            print(f"Deleting points of {len(paths[i : i + batch_size])} files")
+            self.client.delete(
+                collection_name=physical_name,
+                points_selector=FilterSelector(
+                    filter=Filter(
+                        must=[
+                            FieldCondition(
+                                key=_PATH_KEY,
+                                match=MatchAny(any=paths[i : i + batch_size]),
+                            ),
+                            *(repo_filter.must if repo_filter is not None else []),
+                        ]
+                    )
+                ),
+            )
+
+    def delete_collection(self, collection_name: str):
+        physical_name, repo_filter = self._target(collection_name)
+        if repo_filter is None:
+            self.client.delete_collection(physical_name)
+        elif self.client.collection_exists(physical_name):
+            self.client.delete(
+                collection_name=physical_name,
+                points_selector=FilterSelector(filter=repo_filter),
+            )
+
+    def _documents(self, collection_name: str, records) -> Dict[str, Document]:
+        return {
+            str(record.id): _document(collection_name, str(record.id), record.payload)
+            for record in records
+        }
+
+    def retrieve(self, collection_name: str, ids: List[str]) -> Dict[str, Document]:
+        physical_name, _ = self._target(collection_name)
+        return self._documents(
+            collection_name,
+            self.client.retrieve(
+                collection_name=physical_name,
+                ids=ids,
+                with_payload=True,
+                with_vectors=False,
+            ),
+        )
+
+    def _search_kwargs(
+        self, collection_name: str, vector: List[float], k: int, search_type: str
+    ) -> dict:
+        physical_name, repo_filter = self._target(collection_name)
+        return {
+            "collection_name": physical_name,
+            "query_vector": (self.vector_name, vector),
+            "query_filter": repo_filter,
+            "search_params": self.search_params(),
+            "limit": max(k, _MMR_FETCH_K) if search_type == "mmr" else k,
+            "with_payload": True,
+            "with_vectors": search_type == "mmr",
+        }
+
+    def _scored_documents(
+        self,
+        collection_name: str,
+        vector: List[float],
+        k: int,
+        search_type: str,
+        results,
+    ) -> List[Tuple[Document, float]]:
+        if search_type == "mmr" and results:
+            selected, _ = mmr_rerank(
+                np.asarray(vector),
+                np.asarray([result.vector.get(self.vector_name) for result in results]),
+                k=k,
+                lambda_mult=_MMR_LAMBDA,
+            )
+            results = [results[i] for i in selected]
+        return [
+            (_document(collection_name, str(result.id), result.payload), result.score)
+            for result in results
+        ]
+
+    def _candidate_kwargs(
+        self,
+        collection_name: str,
+        vector: List[float],
+        k: int,
+        hnsw_ef: Optional[int],
+    ) -> dict:
+        kwargs = self._search_kwargs(collection_name, vector, k, "similarity")
+        search_params = kwargs["search_params"]
+        if hnsw_ef is not None:
+            search_params.hnsw_ef = hnsw_ef
+        if search_params.quantization is not None:
+            # ranked on the quantized vectors only, the rerank rescores the candidates
+            search_params.quantization = QuantizationSearchParams(rescore=False)
+        kwargs["with_vectors"] = [self.vector_name]
+        return kwargs
+
+    def _candidates(
+        self, collection_name: str, results
+    ) -> Tuple[List[Document], np.ndarray]:
+        documents = [
+            _document(collection_name, str(result.id), result.payload)
+            for result in results
+        ]
+        vectors = np.asarray(
+            [result.vector[self.vector_name] for result in results], dtype=np.float32
+        )
+        return documents, vectors.reshape(len(results), self.dim)
+
+    def search_candidates(
+        self,
+        collection_name: str,
+        vector: List[float],
+        k: int,
+        hnsw_ef: Optional[int] = None,
+    ) -> Tuple[List[Document], np.ndarray]:
+        results = self.client.search(
+            **self._candidate_kwargs(collection_name, vector, k, hnsw_ef)
+        )
+        return self._candidates(collection_name, results)
+
+    async def asearch_candidates(
+        self,
+        collection_name: str,
+        vector: List[float],
+        k: int,
+        hnsw_ef: Optional[int] = None,
+    ) -> Tuple[List[Document], np.ndarray]:
+        if self.async_client is None:
+            return await super().asearch_candidates(collection_name, vector, k, hnsw_ef)
+        results = await self.async_client.search(
+            **self._candidate_kwargs(collection_name, vector, k, hnsw_ef)
+        )
+        return self._candidates(collection_name, results)
+
+    def search(
+        self,
+        collection_name: str,
+        vector: List[float],
+        k: int,
+        search_type: str = "similarity",
+    ) -> List[Tuple[Document, float]]:
+        results = self.client.search(
+            **self._search_kwargs(collection_name, vector, k, search_type)
+        )
+        return self._scored_documents(collection_name, vector, k, search_type, results)
+
+    async def asearch(
+        self,
+        collection_name: str,
+        vector: List[float],
+        k: int,
+        search_type: str = "similarity",
+    ) -> List[Tuple[Document, float]]:
+        if self.async_client is None:
+            return await super().asearch(collection_name, vector, k, search_type)
+        results = await self.async_client.search(
+            **self._search_kwargs(collection_name, vector, k, search_type)
+        )
+        return self._scored_documents(collection_name, vector, k, search_type, results)
+
+    async def aretrieve(
+        self, collection_name: str, ids: List[str]
+    ) -> Dict[str, Document]:
+        if self.async_client is None:
+            return await super().aretrieve(collection_name, ids)
+        physical_name, _ = self._target(collection_name)
+        return self._documents(
+            collection_name,
+            await self.async_client.retrieve(
+                collection_name=physical_name,
+                ids=ids,
+                with_payload=True,
+                with_vectors=False,
+            ),
+        )
+
+    def ping(self):
+        self.client.get_collections()
+
+    async def aclose(self):
+        if self.async_client is not None:
+            await self.async_client.close()
+
+
+class _LocalRows(NamedTuple):
+    """
+    Consistent view of the rows of a collection for a scan. Upserts only append to the
+    lists and a compaction rebinds new ones (and a new matrix), so the view stays valid
+    """
+
+    matrix: np.ndarray
+    alive: np.ndarray
+    ids: List[str]
+    payloads: List[dict]
+
+
+class _LocalCollection:
+    """
+    One collection on disk:
+        vectors.bin  rows of unit vectors, memory-mapped: float32, or int8 followed by the
+                     float32 scale of the row (max |component| / 127)
+        rows.jsonl   {"id", "payload"} of each row, the payload sidecar
+        deleted.txt  rows deleted since the last compaction
+        meta.json    dim and dtype
+    Files are append-only: an upsert of a stored id appends a new row and the latest row
+    of an id wins. Dead rows are dropped when the collection is compacted.
+    """
+
+    def __init__(self, path: str, dim: int, dtype: str):
+        self.path = path
+        self.lock = threading.RLock()
+        meta_path = os.path.join(path, "meta.json")
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                meta = json.load(f)
+            dim, dtype = meta["dim"], meta["dtype"]
+        else:
+            os.makedirs(path, exist_ok=True)
+            with open(meta_path, "w") as f:
+                json.dump({"dim": dim, "dtype": dtype}, f)
+        self.dim = dim
+        self.dtype = np.dtype(dtype)
+        if self.dtype == np.int8:
+            # a scale per row, so every vector uses the whole int8 range
+            self.row_dtype = np.dtype(
+                [("vector", np.int8, (dim,)), ("scale", np.float32)]
+            )
+        else:
+            self.row_dtype = np.dtype((np.float32, (dim,)))
+        self._load()
+
+    def _file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    def _load(self):
+        self.ids: List[str] = []
+        self.payloads: List[dict] = []
+        rows_path = self._file("rows.jsonl")
+        valid_bytes = 0
+        if os.path.exists(rows_path):
+            with open(rows_path, "rb") as f:
+                for line in f:
+                    try:
+                        row = json.loads(line)
+                    except ValueError:
+                        # torn write of the last row
+                        break
+                    self.ids.append(row["id"])
+                    self.payloads.append(row["payload"])
+                    valid_bytes += len(line)
+        vectors_path = self._file("vectors.bin")
+        row_bytes = self.row_dtype.itemsize
+        num_vectors = (
+            os.path.getsize(vectors_path) // row_bytes
+            if os.path.exists(vectors_path)
+            else 0
+        )
+        self.num_rows = min(len(self.ids), num_vectors)
+        # drop the tail of an interrupted upsert, so the next rows line up
+        with open(vectors_path, "ab") as f:
+            f.truncate(self.num_rows * row_bytes)
+        with open(rows_path, "ab") as f:
+            f.truncate(valid_bytes)
+        if len(self.ids) > self.num_rows:
+            del self.ids[self.num_rows :], self.payloads[self.num_rows :]
+            self._rewrite_rows()
+        self.alive = np.zeros(max(self.num_rows, 1024), dtype=bool)
+        self.row_of: Dict[str, int] = {}
+        for row, point_id in enumerate(self.ids):
+            self._set_row(point_id, row)
+        deleted_path = self._file("deleted.txt")
+        if os.path.exists(deleted_path):
+            with open(deleted_path) as f:
+                for line in f:
+                    if line.strip().isdigit() and int(line) < self.num_rows:
+                        self._kill_row(int(line))
+        self._matrix = None
+
+    def _rewrite_rows(self):
+        with open(self._file("rows.jsonl"), "w") as f:
+            for point_id, payload in zip(self.ids, self.payloads):
+                f.write(json.dumps({"id": point_id, "payload": payload}) + "\n")
+
+    def _set_row(self, point_id: str, row: int):
+        previous = self.row_of.get(point_id)
+        if previous is not None:
+            self.alive[previous] = False
+        self.row_of[point_id] = row
+        self.alive[row] = True
+
+    def _kill_row(self, row: int):
+        if self.alive[row]:
+            self.alive[row] = False
+            if self.row_of.get(self.ids[row]) == row:
+                del self.row_of[self.ids[row]]
+
+    @property
+    def num_live(self) -> int:
+        return len(self.row_of)
+
+    def _encode(self, vectors: np.ndarray) -> np.ndarray:
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors = vectors / np.where(norms == 0, 1, norms)
+        if self.dtype != np.int8:
+            return vectors.astype(np.float32)
+        scales = np.abs(vectors).max(axis=1) / 127
+        scales[scales == 0] = 1
+        encoded = np.empty(len(vectors), dtype=self.row_dtype)
+        encoded["vector"] = np.round(vectors / scales[:, None])
+        encoded["scale"] = scales
+        return encoded
+
+    @staticmethod
+    def _decode(rows: np.ndarray) -> np.ndarray:
+        # the dtype of the rows, a compaction may change the one of the collection
+        if rows.dtype.names:
+            return rows["vector"].astype(np.float32) * rows["scale"][:, None]
+        return np.asarray(rows, dtype=np.float32)
+
+    def snapshot(self) -> _LocalRows:
+        with self.lock:
+            matrix = self.matrix()
+            return _LocalRows(
+                matrix, self.alive[: len(matrix)].copy(), self.ids, self.payloads
+            )
+
+    def vectors(
+        self, rows: np.ndarray, snapshot: Optional[_LocalRows] = None
+    ) -> np.ndarray:
+        """float32 vectors of the given rows (of the snapshot, if given)"""
+        matrix = snapshot.matrix if snapshot is not None else self.matrix()
+        return self._decode(matrix[rows])
+
+    def scores(
+        self, query: np.ndarray, block_size: int, snapshot: _LocalRows
+    ) -> np.ndarray:
+        """
+        Cosine similarity of the unit query with every row of the snapshot, -inf for the
+        dead rows
+        """
+        matrix, alive = snapshot.matrix, snapshot.alive
+        scores = np.empty(len(matrix), dtype=np.float32)
+        for start in range(0, len(matrix), block_size):
+            block = matrix[start : start + block_size]
+            if block.dtype.names:
+                # upcast one block at a time, never the whole matrix
+                vectors = block["vector"].astype(np.float32)
+                scores[start : start + len(block)] = (vectors @ query) * block["scale"]
+            else:
+                scores[start : start + len(block)] = block @ query
+        scores[~alive] = -np.inf
+        return scores
+
+    def matrix(self) -> np.ndarray:
+        """Memory-mapped view of the rows, re-mapped after appends"""
+        with self.lock:
+            if self._matrix is None or len(self._matrix) != self.num_rows:
+                self._matrix = (
+                    np.memmap(
+                        self._file("vectors.bin"),
+                        dtype=self.row_dtype,
+                        mode="r",
+                        shape=(self.num_rows,),
+                    )
+                    if self.num_rows
+                    else np.zeros(0, dtype=self.row_dtype)
+                )
+            return self._matrix
+
+    def upsert(self, points: List[Point]):
+        vectors = self._encode(
+            np.asarray([vector for _, vector, _ in points], dtype=np.float32)
+        )
+        with self.lock:
+            # vectors first: on load, rows without a vector are dropped
+            with open(self._file("vectors.bin"), "ab") as f:
+                f.write(vectors.tobytes())
+            with open(self._file("rows.jsonl"), "a") as f:
+                f.write(
+                    "".join(
+                        json.dumps({"id": point_id, "payload": payload}) + "\n"
+                        for point_id, _, payload in points
+                    )
+                )
+            if self.num_rows + len(points) > len(self.alive):
+                grow_by = max(len(self.alive), len(points))
+                self.alive = np.concatenate([self.alive, np.zeros(grow_by, dtype=bool)])
+            for point_id, _, payload in points:
+                self.ids.append(point_id)
+                self.payloads.append(payload)
+                self._set_row(point_id, self.num_rows)
+                self.num_rows += 1
+
+    def delete_rows(self, rows: List[int]):
+        with self.lock:
+            with open(self._file("deleted.txt"), "a") as f:
+                f.write("".join(f"{row}\n" for row in rows))
+            for row in rows:
+                self._kill_row(row)
+
+    def rewrite(self, dtype: Optional[str] = None):
+        """Rewrites the live rows (in dtype), dropping the dead ones"""
+        with self.lock:
+            live_rows = np.flatnonzero(self.alive[: self.num_rows])
+            vectors = self.vectors(live_rows)
+            ids = [self.ids[row] for row in live_rows]
+            payloads = [self.payloads[row] for row in live_rows]
+            new_path = self.path + ".rewrite"
+            shutil.rmtree(new_path, ignore_errors=True)
+            rewritten = _LocalCollection(new_path, self.dim, dtype or self.dtype.name)
+            if ids:
+                rewritten.upsert(list(zip(ids, vectors, payloads)))
+            old_path = self.path + ".old"
+            self._matrix = None
+            os.replace(self.path, old_path)
+            os.replace(new_path, self.path)
+            shutil.rmtree(old_path, ignore_errors=True)
+            self.dtype, self.row_dtype = rewritten.dtype, rewritten.row_dtype
+            self._load()
+
+
+class LocalVectorStore(VectorStore):
+    """
+    Embedded backend: a collection is a memory-mapped matrix of unit vectors under
+    `path`, searched by blocks of `block_size` rows with a NumPy matmul and argpartition.
+    """
+
+    def __init__(
+        self,
+        path: str = "cache/vectors",
+        dtype: str = "float32",
+        dim: int = 256,
+        block_size: int = 65536,
+        compact_min_dead_rows: int = 10000,
+        executor: Optional[Executor] = None,
+    ):
+        super().__init__(dim, executor)
+        if dtype not in ("float32", "int8"):
+            raise ValueError(f"Unsupported dtype of the local vector store: {dtype}")
+        self.path = path
+        self.dtype = dtype
+        self.block_size = block_size
+        self.compact_min_dead_rows = compact_min_dead_rows
+        self.collections: Dict[str, _LocalCollection] = {}
+        self.lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+
+    def _collection_path(self, collection_name: str) -> str:
+        if not re.fullmatch(r"[\w][\w.-]*", collection_name):
+            raise ValueError(f"Invalid collection name: {collection_name}")
+        return os.path.join(self.path, collection_name)
+
+    def _collection(
+        self, collection_name: str, create: bool = False
+    ) -> Optional[_LocalCollection]:
+        with self.lock:
+            collection = self.collections.get(collection_name)
+            if collection is None:
+                path = self._collection_path(collection_name)
+                if not create and not os.path.exists(os.path.join(path, "meta.json")):
+                    return None
+                collection = _LocalCollection(path, self.dim, self.dtype)
+                self.collections[collection_name] = collection
+            return collection
+
+    def _existing(self, collection_name: str) -> _LocalCollection:
+        collection = self._collection(collection_name)
+        if collection is None:
+            raise ValueError(f"Collection {collection_name} not found")
+        return collection
+
+    def collection_exists(self, collection_name: str) -> bool:
+        return self._collection(collection_name) is not None
+
+    def list_collections(self) -> List[str]:
+        return sorted(
+            name
+            for name in os.listdir(self.path)
+            if os.path.exists(os.path.join(self.path, name, "meta.json"))
+        )
+
+    def ensure_collection(self, collection_name: str):
+        if not self.collection_exists(collection_name):
+            print(
+                f"Collection does not exist, hence creating collection : {collection_name}"
+            )
+            self._collection(collection_name, create=True)
+
+    def migrate_collection(self, collection_name: str):
+        # converts to the configured dtype and drops the dead rows
+        self._existing(collection_name).rewrite(self.dtype)
+
+    def _compact_if_needed(self, collection: _LocalCollection):
+        num_dead = collection.num_rows - collection.num_live
+        if num_dead >= max(self.compact_min_dead_rows, collection.num_live):
+            print(f"Compacting {collection.path}: {num_dead} dead rows")
+            collection.rewrite()
+
+    def count(self, collection_name: str) -> int:
+        return self._existing(collection_name).num_live
+
+    def upsert(self, collection_name: str, points: List[Point]):
+        if points:
+            collection = self._existing(collection_name)
+            collection.upsert(points)
+            self._compact_if_needed(collection)
+
+    def existing_ids(self, collection_name: str, ids: List[str]) -> set:
+        row_of = self._existing(collection_name).row_of
+        return {point_id for point_id in ids if point_id in row_of}
+
+    def scroll(
+        self, collection_name: str, payload_fields: Optional[List[str]] = None
+    ) -> Iterator[Tuple[str, dict]]:
+        collection = self._existing(collection_name)
+        with collection.lock:
+            snapshot = collection.snapshot()
+            rows = sorted(collection.row_of.values())
+        for row in rows:
+            payload = _project(snapshot.payloads[row], payload_fields)
+            yield snapshot.ids[row], payload
+
+    def scroll_points(
+        self, collection_name: str, batch_size: int = 1000
+    ) -> Iterator[List[Point]]:
+        collection = self._existing(collection_name)
+        with collection.lock:
+            snapshot = collection.snapshot()
+            rows = np.asarray(sorted(collection.row_of.values()), dtype=np.int64)
+        for start in range(0, len(rows), batch_size):
+            batch_rows = rows[start : start + batch_size]
+            vectors = collection.vectors(batch_rows, snapshot)
+            yield [
+                (snapshot.ids[row], vector, snapshot.payloads[row])
+                for row, vector in zip(batch_rows, vectors)
+            ]
+
+    def delete_paths(self, collection_name: str, paths: Iterable[str]):
+        collection = self._existing(collection_name)
+        paths = set(paths)
+        with collection.lock:
+            rows = [
+                row
+                for row in collection.row_of.values()
+                if _get_path(collection.payloads[row], _PATH_KEY) in paths
+            ]
+            print(f"Deleting {len(rows)} points of {len(paths)} files")
+            collection.delete_rows(rows)
+        self._compact_if_needed(collection)
+
+    def delete_collection(self, collection_name: str):
+        collection = self._existing(collection_name)
+        with self.lock, collection.lock:
+            collection._matrix = None
+            shutil.rmtree(collection.path)
+            del self.collections[collection_name]
+
+    def retrieve(self, collection_name: str, ids: List[str]) -> Dict[str, Document]:
+        collection = self._existing(collection_name)
+        with collection.lock:
+            rows = {
+                point_id: collection.row_of[point_id]
+                for point_id in ids
+                if point_id in collection.row_of
+            }
+            payloads = {
+                point_id: collection.payloads[row] for point_id, row in rows.items()
+            }
+        return {
+            point_id: _document(collection_name, point_id, payload)
+            for point_id, payload in payloads.items()
+        }
+
+    @staticmethod
+    def _top_rows(scores: np.ndarray, k: int) -> np.ndarray:
+        """Rows of the k best finite scores, best first"""
+        k = min(k, int(np.isfinite(scores).sum()))
+        if k <= 0:
+            return np.empty(0, dtype=np.int64)
+        top = np.argpartition(-scores, k - 1)[:k]
+        return top[np.argsort(-scores[top])]
+
+    def search(
+        self,
+        collection_name: str,
+        vector: List[float],
+        k: int,
+        search_type: str = "similarity",
+    ) -> List[Tuple[Document, float]]:
+        collection = self._existing(collection_name)
+        query = np.asarray(vector, dtype=np.float32)
+        query = query / (np.linalg.norm(query) or 1)
+        # ids, payloads and vectors of the same rows, even if a compaction runs meanwhile
+        snapshot = collection.snapshot()
+        scores = collection.scores(query, self.block_size, snapshot)
+        top = self._top_rows(
+            scores, max(k, _MMR_FETCH_K) if search_type == "mmr" else k
+        )
+        if not len(top):
+            return []
+        if search_type == "mmr":
+            selected, _ = mmr_rerank(
+                query, collection.vectors(top, snapshot), k=k, lambda_mult=_MMR_LAMBDA
+            )
+            top = top[selected]
+        return [
+            (
+                _document(collection_name, snapshot.ids[row], snapshot.payloads[row]),
+                float(scores[row]),
+            )
+            for row in top
+        ]
+
+    def search_candidates(
+        self,
+        collection_name: str,
+        vector: List[float],
+        k: int,
+        hnsw_ef: Optional[int] = None,
+    ) -> Tuple[List[Document], np.ndarray]:
+        # the scan is already exhaustive, hnsw_ef does not apply
+        collection = self._existing(collection_name)
+        query = np.asarray(vector, dtype=np.float32)
+        query = query / (np.linalg.norm(query) or 1)
+        snapshot = collection.snapshot()
+        top = self._top_rows(collection.scores(query, self.block_size, snapshot), k)
+        documents = [
+            _document(collection_name, snapshot.ids[row], snapshot.payloads[row])
+            for row in top
+        ]
+        return documents, collection.vectors(top, snapshot).reshape(len(top), self.dim)
+
+    def ping(self):
+        if not os.access(self.path, os.W_OK):
+            raise Exception(f"{self.path} is not writable")
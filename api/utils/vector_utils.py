@@ -1,66 +1,202 @@
-from typing import List
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+import hashlib
+import itertools
+import queue
+import re
+import threading
+import time
 import uuid
 
-from langchain_community.vectorstores import Qdrant
 from langchain_core.documents.base import Document
-from qdrant_client.models import Distance, VectorParams
-from qdrant_client.http.models import PointStruct
 
+from utils import metrics
 from utils.custom_classes import RepoFile
 from utils.injectors import (
     embeddings_model_instance,
-    qdrant_client_instance,
+    vector_store_instance,
     config_instance,
 )
+from utils.vector_stores import Point
+
+# marks the end of the stream of chunk batches
+_END_OF_BATCHES = object()
+# namespace of the deterministic point ids
+_POINT_ID_NAMESPACE = uuid.UUID("6f1c5d2e-3b7a-4c8e-9f21-0d4a5b6c7e8f")
+
+
+def repo_collection_name(repo_url: str) -> str:
+    """
+    Name the repo is stored under: its name, or "owner/name" when the repos are tenants
+    of shared collections (repos of the same name from different owners would collide)
+    """
+    parts = re.split(r"[/:]", repo_url.rstrip("/"))
+    if not config_instance().get("Tenancy", {}).get("shared_collections", 0):
+        return parts[-1].split(".")[0]
+    owner = parts[-2] if len(parts) > 1 and parts[-2] else "local"
+    return f"{owner}/{parts[-1].removesuffix('.git')}"
 
 
 def _is_collection_exists(repo_dir: str):
-    qdrant_client = qdrant_client_instance()
-    return qdrant_client.collection_exists(repo_dir)
+    return vector_store_instance().collection_exists(repo_dir)
+
+
+def _get_stored_blob_shas(repo_name: str) -> Dict[str, str]:
+    """Maps the path of every ingested file to the git blob SHA it was ingested from"""
+    blob_shas = {}
+    for _, payload in vector_store_instance().scroll(
+        repo_name, payload_fields=["metadata.file_level_metadata"]
+    ):
+        file_metadata = payload.get("metadata", {}).get("file_level_metadata") or {}
+        if file_metadata.get("path"):
+            blob_shas[file_metadata["path"]] = file_metadata.get("blob_sha")
+    return blob_shas
+
+
+def _iter_stored_chunks(repo_name: str) -> Iterator[Tuple[str, str, str]]:
+    """(point id, path, content) of every stored chunk"""
+    for point_id, payload in vector_store_instance().scroll(
+        repo_name,
+        payload_fields=["page_content", "metadata.file_level_metadata.path"],
+    ):
+        file_metadata = payload.get("metadata", {}).get("file_level_metadata") or {}
+        yield point_id, file_metadata.get("path"), payload.get("page_content", "")
+
+
+def _delete_file_points(repo_name: str, paths: Iterable[str]):
+    """Deletes all the chunks that belong to the given file paths"""
+    vector_store_instance().delete_paths(repo_name, paths)
+
+
+def _point_id(repo_name: str, chunk_doc: Document) -> str:
+    """Deterministic id from repo/path/chunk_no/content-hash, so re-upserts are idempotent"""
+    path = chunk_doc.metadata.get("file_level_metadata", {}).get("path")
+    chunk_no = chunk_doc.metadata.get("chunk_level_metadata", {}).get("chunk_no")
+    content_hash = hashlib.sha256(chunk_doc.page_content.encode("utf-8")).hexdigest()
+    return str(
+        uuid.uuid5(_POINT_ID_NAMESPACE, f"{repo_name}/{path}/{chunk_no}/{content_hash}")
+    )
+
+
+def _rekey_points(repo_name: str, points: List[Point]) -> List[Point]:
+    """The points with the ids they get when ingested under repo_name"""
+    return [
+        (
+            _point_id(
+                repo_name,
+                Document(
+                    page_content=payload.get("page_content") or "",
+                    metadata=payload.get("metadata") or {},
+                ),
+            ),
+            vector,
+            payload,
+        )
+        for _, vector, payload in points
+    ]
+
+
+def migrate_collection(repo_name: str):
+    """Applies the collection profile of the config to an existing collection"""
+    print(f"Migrating collection to the configured profile : {repo_name}")
+    vector_store_instance().migrate_collection(repo_name)
+
+
+def migrate_collections(repo_names: Optional[List[str]] = None) -> List[str]:
+    """Migrates the given collections, all of them by default"""
+    if repo_names is None:
+        repo_names = vector_store_instance().list_collections()
+    for repo_name in repo_names:
+        migrate_collection(repo_name)
+    return repo_names
+
+
+def _filter_stored_chunks(repo_name: str, chunked_docs: List[Document]):
+    """Drops the chunks whose point already exists, used to resume an interrupted ingest"""
+    ids = [_point_id(repo_name, chunk_doc) for chunk_doc in chunked_docs]
+    stored = vector_store_instance().existing_ids(repo_name, ids)
+    return [
+        chunk_doc
+        for chunk_doc, point_id in zip(chunked_docs, ids)
+        if point_id not in stored
+    ]
+
+
+class _ParallelUpserter:
+    """
+    Sends batches of points to the vector store on `concurrency` threads (Qdrant
+    upserts are sent with wait=False).
+    At most 2 * concurrency batches are in flight; a failed batch is retried with
+    exponential backoff, and since point ids are deterministic a retry never duplicates.
+    """
+
+    def __init__(
+        self,
+        repo_name: str,
+        concurrency: int = 4,
+        max_retries: int = 3,
+        retry_backoff: float = 0.5,
+    ):
+        self.repo_name = repo_name
+        self.max_in_flight = 2 * concurrency
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.executor = ThreadPoolExecutor(
+            max_workers=concurrency, thread_name_prefix="upsert"
+        )
+        self.in_flight = deque()
+
+    def _upsert(self, points: List[Point]):
+        for attempt in range(self.max_retries + 1):
+            try:
+                with metrics.span("ingest", "upsert"):
+                    vector_store_instance().upsert(self.repo_name, points)
+                return
+            except Exception as e:
+                if attempt == self.max_retries:
+                    raise
+                print(f"Upsert failed ({e}), retrying..")
+                time.sleep(self.retry_backoff * 2**attempt)
+
+    def submit(self, points: List[Point]):
+        while len(self.in_flight) >= self.max_in_flight:
+            # backpressure, also surfaces the failure of an earlier batch
+            self.in_flight.popleft().result()
+        self.in_flight.append(self.executor.submit(self._upsert, points))
+
+    def close(self):
+        try:
+            while self.in_flight:
+                self.in_flight.popleft().result()
+        finally:
+            self.executor.shutdown(wait=True, cancel_futures=True)
 
 
 def _batch_insert(
     chunked_docs: List[Document],
     custom_chunk_embeddings: List,
     repo_name: str,
+    upserter: _ParallelUpserter,
     batch_size: int = 500,
 ):
-    points = []
-    qdrant_client = qdrant_client_instance()
-    config = config_instance()
-    # wrap chunks as PointStruct objects
-    for chunk_doc, custom_chunk_embedding in zip(chunked_docs, custom_chunk_embeddings):
-        points.append(
-            PointStruct(
-                id=uuid.uuid4().hex,
-                payload={
-                    "metadata": chunk_doc.metadata,
-                    "page_content": chunk_doc.page_content,
-                },
-                vector={
-                    config.get("VectorStore").get(
-                        "vector_col_name"
-                    ): custom_chunk_embedding
-                },
-            )
-        )
-    # create collection if not exist
-    if not qdrant_client.collection_exists(repo_name):
-        print(f"Collection does not exist, hence creating collection : {repo_name}")
-        qdrant_client.recreate_collection(
-            collection_name=repo_name,
-            vectors_config={
-                config.get("VectorStore").get("vector_col_name"): VectorParams(
-                    size=256, distance=Distance.COSINE
-                )
+    # wrap chunks as (id, vector, payload) points
+    points = (
+        (
+            _point_id(repo_name, chunk_doc),
+            custom_chunk_embedding,
+            {
+                "metadata": chunk_doc.metadata,
+                "page_content": chunk_doc.page_content,
             },
         )
-    # insert in batches
-    for i in range(0, len(points), batch_size):
-        print(f"Inserting {i}-{i+batch_size} points")
-        qdrant_client.upsert(
-            collection_name=repo_name, points=points[i : i + batch_size]
+        for chunk_doc, custom_chunk_embedding in zip(
+            chunked_docs, custom_chunk_embeddings
         )
+    )
+    # insert in batches
+    while batch := list(itertools.islice(points, batch_size)):
+        upserter.submit(batch)
 
 
 def _update_custom_embeddings(chunked_docs: List[Document]) -> List[List]:
@@ -79,36 +215,115 @@ def _update_custom_embeddings(chunked_docs: List[Document]) -> List[List]:
     return custom_chunk_embeddings
 
 
+def _iter_chunk_batches(
+    repo_files: Iterable[RepoFile], batch_size: int
+) -> Iterator[List[Document]]:
+    """Regroups the chunks of the streamed files into fixed-size batches"""
+    batch = []
+    for repo_file in repo_files:
+        batch.extend(repo_file.get("chunks", []))
+        while len(batch) >= batch_size:
+            yield batch[:batch_size]
+            batch = batch[batch_size:]
+    if batch:
+        yield batch
+
+
+def _put_until_stopped(batch_queue: queue.Queue, item, stop: threading.Event) -> bool:
+    while not stop.is_set():
+        try:
+            batch_queue.put(item, timeout=0.5)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _produce_batches(
+    batches: Iterator[List[Document]], batch_queue: queue.Queue, stop: threading.Event
+):
+    """Runs the file pipeline in a background thread; a full queue blocks it (backpressure)"""
+    try:
+        for batch in batches:
+            if not _put_until_stopped(batch_queue, batch, stop):
+                return
+    except Exception as e:
+        _put_until_stopped(batch_queue, e, stop)
+        return
+    _put_until_stopped(batch_queue, _END_OF_BATCHES, stop)
+
+
 def embed_and_store(
-    repo_files: List[RepoFile],
+    repo_files: Iterable[RepoFile],
+    repo_name: str,
     insert_custom_embeddings: bool = False,
+    resume: bool = False,
 ) -> bool:
+    """
+    Embeds and upserts the chunks of the streamed files batch by batch, so memory stays
+    bounded by `batch_size * queue_size` chunks and upserts start while later files are
+    still being read.
+    With resume, chunks that are already stored (eg: by an interrupted ingest) are skipped
+    before being embedded.
+    """
     # Using repo name as the collection name
-    chunked_docs = []
-    repo_name = repo_files[0].get("repo_name")
-    config = config_instance()
-    for repo_file in repo_files:
-        chunked_docs.extend(repo_file.get("chunks"))
+    ingest_config = config_instance().get("Ingest", {})
+    batch_queue = queue.Queue(maxsize=ingest_config.get("queue_size", 4))
+    stop = threading.Event()
+    producer = threading.Thread(
+        target=_produce_batches,
+        args=(
+            _iter_chunk_batches(repo_files, ingest_config.get("batch_size", 256)),
+            batch_queue,
+            stop,
+        ),
+        daemon=True,
+    )
+    producer.start()
+    if insert_custom_embeddings:
+        print("Using custom embeddings..")
+    num_chunks = 0
+    upserter = None
     try:
-        if insert_custom_embeddings:
-            print("Using custom embeddings..")
-            custom_chunk_embeddings = _update_custom_embeddings(chunked_docs)
+        vector_store_instance().ensure_collection(repo_name)
+        upserter = _ParallelUpserter(
+            repo_name,
+            concurrency=ingest_config.get("upsert_concurrency", 4),
+            max_retries=ingest_config.get("upsert_retries", 3),
+        )
+        while True:
+            chunked_docs = batch_queue.get()
+            if chunked_docs is _END_OF_BATCHES:
+                break
+            if isinstance(chunked_docs, Exception):
+                raise chunked_docs
+            if resume:
+                chunked_docs = _filter_stored_chunks(repo_name, chunked_docs)
+                if not chunked_docs:
+                    continue
+            with metrics.span("ingest", "embed"):
+                if insert_custom_embeddings:
+                    chunk_embeddings = _update_custom_embeddings(chunked_docs)
+                else:
+                    chunk_embeddings = embeddings_model_instance().embed_documents(
+                        [chunk_doc.page_content for chunk_doc in chunked_docs]
+                    )
             _batch_insert(
                 chunked_docs=chunked_docs,
-                custom_chunk_embeddings=custom_chunk_embeddings,
+                custom_chunk_embeddings=chunk_embeddings,
                 repo_name=repo_name,
+                upserter=upserter,
             )
-        else:
-            print("Using langchain to create embeddings..")
-            Qdrant.from_documents(
-                documents=chunked_docs,
-                embedding=embeddings_model_instance(),
-                vector_name=config.get("VectorStore").get("vector_col_name"),
-                url=config_instance().get("VectorStore").get("url"),
-                collection_name=repo_name,
-                prefer_grpc=True,
-            )
+            num_chunks += len(chunked_docs)
+            metrics.INGEST_CHUNKS.inc(len(chunked_docs))
+            print(f"Stored {num_chunks} chunks so far..")
+        upserter.close()
     except Exception as e:
         print(e)
         return False
+    finally:
+        stop.set()
+        producer.join()
+        if upserter is not None:
+            upserter.executor.shutdown(wait=False, cancel_futures=True)
     return True
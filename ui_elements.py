@@ -1,4 +1,5 @@
 import re
+import time
 import requests
 
 import streamlit as st
@@ -15,6 +16,21 @@ def _is_valid_url():
     return True
 
 
+def _wait_for_ingestion(job_id: str, status_box, poll_interval: float = 1.0) -> dict:
+    job = {}
+    while True:
+        response = requests.get(f"http://api:8001/ingest/{job_id}")
+        if not response or response.status_code != 200:
+            return {}
+        job = response.json()
+        if job.get("status") not in ("queued", "running"):
+            return job
+        status_box.update(
+            label=f"Ingesting data.. ({job.get('current_stage') or job.get('status')})"
+        )
+        time.sleep(poll_interval)
+
+
 def render_data_ingestion_window():
     with st.form("my_form"):
         github_url = st.text_input(
@@ -24,13 +40,15 @@ def render_data_ingestion_window():
         )
         submitted = st.form_submit_button("Upload Repository")
         if submitted and _is_valid_url():
-            response = None
-            with st.status("Ingesting data.."):
+            job = {}
+            with st.status("Ingesting data..") as status_box:
                 response = requests.post(
                     "http://api:8001/ingest",
                     json={"repo_url": github_url, "insert_custom_embeddings": False},
                 )
-            if response and response.status_code == 201:
+                if response and response.status_code == 202:
+                    job = _wait_for_ingestion(response.json()["job_id"], status_box)
+            if job.get("status") == "done":
                 st.markdown(
                     """Ingested to the VectorDB, you can check [Here](http://localhost:6333/dashboard#/collections)"""
                 )
@@ -52,7 +70,8 @@ def _update_msg_history(role, msg):
 def _display_msg(role, msg, update_history: bool = True, stream_resp: bool = False):
     if stream_resp:
         with st.chat_message(role):
-            st.write_stream(msg)
+            # write_stream returns the full text once the stream is consumed
+            msg = st.write_stream(msg)
     else:
         with st.chat_message(role):
             print(msg)
@@ -72,14 +91,17 @@ def _display_msg(role, msg, update_history: bool = True, stream_resp: bool = Fal
         _update_msg_history(role, msg)
 
 
-def _get_answer(question: int) -> str:
-    response = requests.post(
-        "http://api:8001/generate",
+def _stream_answer(question: str):
+    with requests.post(
+        "http://api:8001/generate/stream",
         json={"repo_url": st.session_state.repo_url, "query": question},
-    )
-    if response and response.status_code == 200:
-        return response.content.decode("utf-8")
-    return ""
+        stream=True,
+    ) as response:
+        if not response or response.status_code != 200:
+            yield "Sorry, Could not find the answer, Please try again."
+            return
+        for chunk in response.iter_content(chunk_size=None, decode_unicode=True):
+            yield chunk
 
 
 def _display_chat_history():
@@ -93,13 +115,10 @@ def render_chat_window():
     _display_chat_history()
     if question := st.chat_input("Ask a question.."):
         _display_msg("user", question, update_history=True, stream_resp=False)
-        answer = ""
-        with st.spinner("Retrieving answers.."):
-            answer = _get_answer(question)
-        answer = (
-            answer
-            if len(answer)
-            else "Sorry, Could not find the answer, Please try again."
+        _display_msg(
+            "assistant",
+            _stream_answer(question),
+            update_history=True,
+            stream_resp=True,
         )
-        _display_msg("assistant", answer, update_history=True, stream_resp=False)
     st.button("Clear Chat", key="clear", on_click=_clear_chat)